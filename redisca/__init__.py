@@ -1,20 +1,84 @@
 # -*- coding: utf-8 -
 
 import re
+import json
 
 from time import time
+from time import sleep
+from time import mktime
+from time import gmtime
+from time import strftime
+from calendar import timegm
 from random import randint
+from random import random
+from random import sample
+from heapq import merge
+from bisect import bisect_left
+from bisect import insort
+from fnmatch import fnmatchcase
+from threading import Lock
+from threading import RLock
+from threading import local
+from threading import Thread
 from hashlib import md5
+from uuid import uuid4
+from functools import wraps
 from sys import version_info
+from os import getpid
+from weakref import WeakSet
 from datetime import datetime
 from redis import StrictRedis
+from redis import ConnectionPool
+from redis import BlockingConnectionPool
+from redis.exceptions import ResponseError
+from redis.exceptions import WatchError
+from redis.exceptions import ConnectionError as RedisConnectionError
 from inspect import isfunction
 from inspect import ismethod
 from inspect import isbuiltin
+from struct import Struct
+from codecs import utf_8_decode
+
+try:
+	from contextvars import ContextVar
+
+except ImportError: # Python < 3.7
+	ContextVar = None
+
+try:
+	from os import register_at_fork
+
+except ImportError: # Python < 3.7
+	register_at_fork = None
+
+try:
+	from queue import Queue
+
+except ImportError: # Python 2
+	from Queue import Queue
+
+try:
+	import msgpack
+
+except ImportError:
+	msgpack = None
 
 
 PY3K = version_info[0] == 3
 EMAIL_REGEXP = re.compile(r"^[a-z0-9]+[_a-z0-9-]*(\.[_a-z0-9-]+)*@[a-z0-9]+[\.a-z0-9-]*(\.[a-z]{2,4})$")
+FORKSAFE = WeakSet() # Objects which forked() is called in child process.
+
+
+def afterfork ():
+	""" Reset process-local state of FORKSAFE objects. Called in child
+	process after fork (python 3.7+). Older pythons check pid instead. """
+
+	for obj in list(FORKSAFE):
+		obj.forked()
+
+
+if register_at_fork is not None:
+	register_at_fork(after_in_child=afterfork)
 
 
 def intid ():
@@ -27,388 +91,3686 @@ def hexid ():
 	return '%x' % intid()
 
 
-class BExpr (object):
-	EQ = '='
-	GT = '>'
-	LT = '<'
-	GE = '>='
-	LE = '<='
+def tempkey (prefix, kind):
+	""" Return collision-free name of temporary key. """
+	return ':'.join((prefix, kind, uuid4().hex))
 
-	def __init__ (self, operator, field, val):
-		assert isinstance(field, Field)
 
-		self.models = None
-		self.operator = operator
-		self.field = field
-		self.val = val
+class SnowflakeId (object):
+	""" Thread-safe unique id generator. Ids are composed of milliseconds
+	since epoch, *worker* id and per-process sequence number. Worker must
+	be distinct for each process. It is int or callable returning worker
+	id of current process (i.e. lambda: int(os.environ['WORKER_ID'])),
+	which is called again in forked processes. Generator with int worker
+	refuses to work in process forked after its creation. """
 
-		super(BExpr, self).__init__()
+	unique = True
 
-	def __len__ (self):
-		self.load()
-		return len(self.models)
+	EPOCH = 1374000000000
+	WORKER_BITS = 10
+	SEQUENCE_BITS = 12
 
-	def __getitem__ (self, key):
-		self.load()
-		return self.models[key]
+	def __init__ (self, worker):
+		self._worker = worker
+		self.forked()
+		self._inherited = False # Created in this process.
+		FORKSAFE.add(self)
 
-	def __setitem__ (self, key, value):
-		raise NotImplementedError()
+	def forked (self):
+		""" Reset process-local state. """
 
-	def __iter__ (self):
-		self.load()
-		return iter(self.models)
+		self._lock = Lock()
+		self._pid = getpid()
+		self._last = -1
+		self._seq = 0
+		self._inherited = not callable(self._worker)
+		self.worker = None
 
-	def __contains__ (self, item):
-		self.load()
-		return item in self.models
+	def __call__ (self):
+		if register_at_fork is None and self._pid != getpid():
+			self.forked()
 
-	def loaded (self):
-		return self.models is not None
+		with self._lock:
+			if self._inherited:
+				raise Exception('SnowflakeId with int worker is used in forked process, '
+					'use callable worker to get distinct worker per process')
 
-	def unload (self):
-		self.models = None
+			if self.worker is None:
+				worker = self._worker() if callable(self._worker) else self._worker
+				assert 0 <= worker < 1 << self.WORKER_BITS
+				self.worker = worker
 
-	def load (self):
-		""" Load result into expression. """
+			now = int(time() * 1000)
 
-		if self.loaded():
-			return
+			if now < self._last:
+				now = self._last # Clock moved backwards.
 
-		if self.operator == self.EQ:
-			self.models = self.field.find(self.val)
+			if now == self._last:
+				self._seq = (self._seq + 1) & ((1 << self.SEQUENCE_BITS) - 1)
 
-		elif self.operator == self.GT:
-			self.models = self.field.range(minval='(%d' % int(self.val))
+				if self._seq == 0: # Sequence overflow, wait for next ms.
+					while now <= self._last:
+						sleep(0.0001)
+						now = int(time() * 1000)
 
-		elif self.operator == self.GE:
-			self.models = self.field.range(minval=int(self.val))
+			else:
+				self._seq = 0
 
-		elif self.operator == self.LT:
-			self.models = self.field.range(maxval='(%d' % int(self.val))
+			self._last = now
 
-		elif self.operator == self.LE:
-			self.models = self.field.range(maxval='%d' % int(self.val))
+			return (now - self.EPOCH) << (self.WORKER_BITS + self.SEQUENCE_BITS) \
+				| self.worker << self.SEQUENCE_BITS | self._seq
 
-		else:
-			raise Exception('Unsupported operator type given')
 
+class BlockId (object):
+	""" Unique id generator which leases blocks of *size* ids from redis
+	counter *key* using single INCRBY per block. Leased block is dropped
+	in forked processes, so they never share ids. """
 
-class Field (object):
-	def __init__ (self, field, index=False, unique=False, new=None):
-		self.new = new
-		self.index = bool(index)
-		self.unique = bool(unique)
-		self.field = field
+	unique = True
 
-	def __get__ (self, model, owner):
-		self.owner = owner
+	def __init__ (self, key, size=1000, db=None):
+		assert size > 0
 
-		if model is None:
-			return self
+		self.key = key
+		self.size = size
+		self.db = db
 
-		val = model[self.field]
-		return None if val is None else self.from_db(val)
+		self.forked()
+		FORKSAFE.add(self)
 
-	def __set__ (self, model, value):
-		model[self.field] = None if value is None else self.to_db(value)
+	def forked (self):
+		""" Reset process-local state. """
 
-	def __lt__ (self, other):
-		return BExpr(operator=BExpr.LT, field=self, val=other)
+		self._lock = Lock()
+		self._pid = getpid()
+		self._next = 0
+		self._last = -1
 
-	def __le__ (self, other):
-		return BExpr(operator=BExpr.LE, field=self, val=other)
+	def __call__ (self):
+		if register_at_fork is None and self._pid != getpid():
+			self.forked()
 
-	def __gt__ (self, other):
-		return BExpr(operator=BExpr.GT, field=self, val=other)
+		with self._lock:
+			if self._next > self._last:
+				db = connection(self.db)
+				self._last = db.incrby(self.key, self.size)
+				self._next = self._last - self.size + 1
 
-	def __ge__ (self, other):
-		return BExpr(operator=BExpr.GE, field=self, val=other)
+			model_id = self._next
+			self._next += 1
+			return model_id
 
-	def __eq__ (self, other):
-		return BExpr(operator=BExpr.EQ, field=self, val=other)
 
-	def from_db (self, val):
+def totext (val):
+	""" Decode bytes reply (if connection does not decode responses). """
+	return val.decode('utf-8') if PY3K and type(val) is bytes else val
+
+
+class LazyData (dict):
+	""" Raw model data dict which keeps redis reply bytes values and
+	decodes them on first access. """
+
+	def __getitem__ (self, name):
+		val = dict.__getitem__(self, name)
+
+		if type(val) is bytes:
+			val = val.decode('utf-8')
+			dict.__setitem__(self, name, val)
+
 		return val
 
-	def to_db (self, val):
-		return str(val) if PY3K else unicode(val)
+	def get (self, name, default=None):
+		return self[name] if name in self else default
 
+	def items (self):
+		return [(k, self[k]) for k in self]
 
-class IndexField (Field):
-	""" Base class for fields with exact indexing. """
+	def values (self):
+		return [self[k] for k in self]
 
-	def idx_key (self, prefix, val):
-		val = self.to_db(val)
-		val = str(val) if PY3K else unicode(val)
-		return ':'.join((prefix, self.field, val))
+	def copy (self):
+		return dict(self.items())
 
-	def find (self, val, children=False):
-		assert self.index or self.unique
-		key = self.idx_key(self.owner.getprefix(), val)
-		ids = self.owner.getdb().smembers(key)
-		models = [self.owner(model_id) for model_id in ids]
 
-		if children:
-			for child in self.owner.inheritors():
-				key = self.idx_key(child.getprefix(), val)
-				ids = child.getdb().smembers(key)
-				models += [child(model_id) for model_id in ids]
+def bitoffset (model_id):
+	""" Return bitmap offset of model id. """
 
-		return models
+	try:
+		offset = int(model_id)
 
-	def choice (self, val, count=1):
-		""" Return *count* random model(s) from find() result. """
+	except ValueError:
+		offset = -1
 
-		assert self.index or self.unique
-		key = self.idx_key(self.owner.getprefix(), val)
-		ids = self.owner.getdb().srandmember(key, count)
+	if offset < 0:
+		raise Exception('Bitmap index requires non-negative integer ids')
 
-		return None if not len(ids) else \
-			[self.owner(model_id) for model_id in ids]
+	return offset
 
-	def save_idx (self, model, pipe=None):
-		prev_idx_val = self.prev_idx_val(model)
 
-		if prev_idx_val == model[self.field]:
-			return # Nothing to do.
+def bits (data, base=0):
+	""" Return offsets of set bits of bitmap *data* which starts with
+	byte number *base*. """
 
-		idx_key = self.idx_key(model.getprefix(), model[self.field])
+	offsets = []
 
-		if self.unique:
-			ids = model.getdb().smembers(idx_key)
+	for n, byte in enumerate(bytearray(data)):
+		if byte:
+			for bit in range(8):
+				if byte & (0x80 >> bit):
+					offsets.append((base + n) * 8 + bit)
 
-			if len(ids):
-				ids.discard(bytes(model._id, 'utf-8') if PY3K else model._id)
+	return offsets
 
-				if len(ids):
-					raise Exception('Duplicate key error')
 
-		prev_idx_key = self.idx_key(model.getprefix(), prev_idx_val)
-		pipe.srem(prev_idx_key, model._id)
-		pipe.sadd(idx_key, model._id)
+def iterbits (db, key, chunk=4096, ttl=None):
+	""" Iterate over offsets of set bits of bitmap *key* reading it by
+	*chunk* bytes. BITPOS is used to skip empty ranges. Expire of
+	temporary *key* is refreshed to *ttl* before each chunk. """
 
-	def del_idx (self, model, pipe=None):
-		prev_idx_val = self.prev_idx_val(model)
-		prev_idx_key = self.idx_key(model.getprefix(), prev_idx_val)
-		pipe.srem(prev_idx_key, model._id)
+	pos = 0
 
-	def prev_idx_val (self, model):
-		""" Get previously indexed value. """
+	while True:
+		if ttl is not None:
+			db.expire(key, ttl)
 
-		if not model.exists():
-			return None
+		offset = db.bitpos(key, 1, pos)
 
-		elif model.loaded() and self.field in model._data:
-			return model._data[self.field]
+		if offset < 0:
+			return
 
-		else:
-			prev_val = model.getdb().hget(model.getkey(), self.field)
+		pos = offset // 8
+		data = db.getrange(key, pos, pos + chunk - 1)
 
-			return prev_val.decode('utf-8') \
-				if PY3K and prev_val is not None \
-					else prev_val
+		for offset in bits(data, pos):
+			yield offset
 
+		if len(data) < chunk:
+			return
 
-class RangeIndexField (Field):
-	""" Base class for fields with range indexing. """
+		pos += chunk
 
-	def idx_key (self, prefix):
-		return ':'.join((prefix, self.field))
 
-	def find (self, val, children=False):
-		return self.range(
-			minval=val,
-			maxval=val,
-			children=children,
-		)
+def chunks (items, size):
+	""" Iterate over lists of at most *size* items. """
 
-	def range (self, minval='-inf', maxval='+inf', start=None, num=None, children=False):
-		assert self.index or self.unique
+	batch = []
 
-		if num is not None and start is None:
-			start = 0
+	for item in items:
+		batch.append(item)
 
-		key = self.idx_key(self.owner.getprefix())
-		db = self.owner.getdb()
+		if len(batch) == size:
+			yield batch
+			batch = []
 
-		if type(minval) is not str:
-			minval = self.to_db(minval)
+	if len(batch):
+		yield batch
 
-		if type(maxval) is not str:
-			maxval = self.to_db(maxval)
 
-		ids = db.zrangebyscore(key, minval, maxval, start=start, num=num)
-		models = [self.owner(model_id) for model_id in ids]
+def drain (db, key, pop, ttl=60):
+	""" Iterate over lists of ids returned by pop() from temporary *key*
+	until it is empty. Key ttl is refreshed before each pop, so slow
+	consumers are not cut short. Key is deleted if iteration stops. """
 
-		if children:
-			for child in self.owner.inheritors():
-				key = self.idx_key(child.getprefix())
-				db = child.getdb()
-				ids = db.zrangebyscore(key, minval, maxval, start=start, num=num)
-				models += [child(model_id) for model_id in ids]
+	try:
+		while True:
+			db.expire(key, ttl)
+			ids = pop()
 
-		return models
+			if not len(ids):
+				return
 
-	def save_idx (self, model, pipe=None):
-		key = self.idx_key(model.getprefix())
-		val = model[self.field]
+			yield [totext(i) for i in ids]
 
-		if self.unique:
-			models = self.find(val, val)
+	finally:
+		db.delete(key)
 
-			if len(models) > 1 or len(models) == 1 and models[0] is not model:
-				raise Exception('Duplicate key error')
 
-		pipe.zadd(key, **{
-			model._id: self.to_db(val)
-		})
+def evalscript (db, script, keys, args, emulation):
+	""" Run Lua *script* (or queue it if *db* is pipeline). In-process
+	engine (see MemoryRedis) calls python *emulation* of script with
+	engine, keys and args instead. """
 
-	def del_idx (self, model, pipe=None):
-		key = self.idx_key(model.getprefix())
-		pipe.zrem(key, model._id)
+	if isinstance(db, (MemoryRedis, MemoryPipeline)):
+		return db.emulate(emulation, keys, args)
 
+	return db.register_script(script)(keys=keys, args=args, client=db)
 
-class Bool (IndexField):
-	def to_db (self, val):
-		return 1 if (val and val != '0') else 0
 
-	def from_db (self, val):
-		return val == '1' or val == 1
+def fanout (classes, query, many=False):
+	""" Call query(cls, pipe) for each of model *classes* using single
+	pipeline per connection. Return list of replies in classes order. If
+	*many* query may queue any number of commands and list of their
+	replies is returned for each class. """
 
+	pipes = dict()
+	replies = [None] * len(classes)
 
-class String (IndexField):
-	def __init__ (self, minlen=None, maxlen=None, **kw):
-		super(String, self).__init__(**kw)
+	for n, cls in enumerate(classes):
+		db = cls.getdb()
 
-		if minlen is not None and maxlen is not None:
-			assert minlen < maxlen
+		if id(db) not in pipes:
+			pipes[id(db)] = (db.pipeline(transaction=False), [])
 
-		self.minlen = minlen
-		self.maxlen = maxlen
+		pipe, batch = pipes[id(db)]
+		size = len(pipe)
+		query(cls, pipe)
+		batch.append((n, len(pipe) - size))
 
-	def __set__ (self, model, value):
-		if value is not None:
-			value = str(value) if PY3K else unicode(value)
+	for pipe, batch in pipes.values():
+		reply = iter(pipe.execute())
 
-			if self.minlen is not None and len(value) < self.minlen:
-				raise Exception('Minimal length check failed')
+		for n, size in batch:
+			replies[n] = [next(reply) for i in range(size)]
 
-			if self.maxlen is not None and len(value) > self.maxlen:
-				raise Exception('Maximum length check failed')
+	return replies if many else [reply[0] for reply in replies]
 
-		model[self.field] = value
 
+class ContextLocal (object):
+	""" Value storage which is local to current context (contextvars) or
+	thread if contextvars are not available. """
 
-class Email (IndexField):
-	def __set__ (self, model, value):
-		if value is not None:
-			value = value.lower()
+	def __init__ (self, name):
+		if ContextVar is not None:
+			self._var = ContextVar(name, default=None)
 
-			if EMAIL_REGEXP.match(value) == None:
-				raise Exception('Email validation failed')
+		else:
+			self._local = local()
 
-		return super(Email, self).__set__(model, value)
+	def get (self):
+		if ContextVar is not None:
+			return self._var.get()
 
-	def idx_key (self, prefix, val):
-		if val is not None:
-			val = val.lower()
+		return getattr(self._local, 'value', None)
 
-		return super(Email, self).idx_key(prefix, val)
+	def set (self, value):
+		if ContextVar is not None:
+			self._var.set(value)
 
-	def find (self, val, children=False):
-		if val is not None:
-			val = val.lower()
+		else:
+			self._local.value = value
 
-		return super(Email, self).find(val, children)
 
-	def choice (self, val, count=1):
-		if val is not None:
-			val = val.lower()
+class Metrics (object):
+	""" Thread-safe named counters. """
 
-		return super(Email, self).choice(val, count)
+	def __init__ (self):
+		self._lock = Lock()
+		self._counters = dict()
 
+	def incr (self, name, n=1):
+		with self._lock:
+			self._counters[name] = self._counters.get(name, 0) + n
 
-class Integer (RangeIndexField):
-	def __init__ (self, minval=None, maxval=None, **kw):
-		super(Integer, self).__init__(**kw)
+	def get (self, name):
+		return self._counters.get(name, 0)
 
-		if minval is not None and maxval is not None:
-			assert minval < maxval
+	def snapshot (self):
+		""" Return copy of all counters. """
 
-		self.minval = minval
-		self.maxval = maxval
+		with self._lock:
+			return self._counters.copy()
 
-	def __set__ (self, model, value):
-		if value is not None:
-			value = int(value)
+	def setmax (self, name, value):
+		""" Set counter to *value* if it is greater. """
 
-			if self.minval is not None and value < self.minval:
-				raise Exception('Minimal value check failed')
+		with self._lock:
+			if value > self._counters.get(name, 0):
+				self._counters[name] = value
 
-			if self.maxval is not None and value > self.maxval:
-				raise Exception('Maximum value check failed')
+	def reset (self, prefix=''):
+		""" Reset all counters (or ones with names starting with *prefix*). """
 
-		model[self.field] = value
+		with self._lock:
+			self._counters = dict((k, v) for (k, v) in self._counters.items() \
+				if prefix and not k.startswith(prefix))
 
-	def to_db (self, val):
-		return int(val)
 
-	def from_db (self, val):
-		return int(val)
+class ConflictError (Exception):
+	""" Versioned model was changed concurrently (and retries are over). """
+	pass
 
 
-class DateTime (RangeIndexField):
-	def to_db (self, val):
-		return int(val.strftime('%s') if type(val) is datetime else val)
+METRICS = Metrics() # Module-wide counters.
 
-	def from_db (self, val):
-		return datetime.fromtimestamp(int(val))
 
+class PoolMetrics (object):
+	""" Connection pool mixin which counts checkouts, checkout wait time
+	(total and max seconds, including timed out checkouts), connections
+	in use, created connections (churn) and checkout timeouts. Counters
+	are kept by pool itself (see Pools.metrics()) under its own lock, so
+	checkouts of different pools never contend. """
 
-class MD5Pass (String):
-	def __set__ (self, model, value):
-		super(MD5Pass, self).__set__(model, value)
+	COUNTERS = ('checkouts', 'wait', 'wait_max', 'in_use', 'created', 'timeouts')
 
-		if value is not None:
-			val = model[self.field]
+	def __init__ (self, name, **kw):
+		self.name = name
+		self.counters = dict.fromkeys(self.COUNTERS, 0)
+		self._counters_lock = Lock()
+		super(PoolMetrics, self).__init__(**kw)
 
-			if PY3K:
-				val = val.encode('utf-8')
+	def count (self, started=None, **counters):
+		""" Add *counters* (and wait time since *started*) at once. """
 
-			model[self.field] = md5(val).hexdigest()
+		with self._counters_lock:
+			for name, n in counters.items():
+				self.counters[name] += n
 
+			if started is not None:
+				wait = time() - started
+				self.counters['wait'] += wait
 
-class Reference (IndexField):
-	def __init__ (self, cls, **kw):
-		super(Reference, self).__init__(**kw)
-		assert issubclass(cls, Model)
-		self._cls = cls
+				if wait > self.counters['wait_max']:
+					self.counters['wait_max'] = wait
+
+	def make_connection (self):
+		self.count(created=1)
+		return super(PoolMetrics, self).make_connection()
+
+	def get_connection (self, command_name, *keys, **options):
+		started = time()
+
+		try:
+			connection = super(PoolMetrics, self).get_connection(
+				command_name, *keys, **options)
+
+		except RedisConnectionError:
+			self.count(started, timeouts=1)
+			raise
+
+		self.count(started, checkouts=1, in_use=1)
+		return connection
+
+	def release (self, connection):
+		if connection.pid == self.pid:
+			self.count(in_use=-1)
+
+		super(PoolMetrics, self).release(connection)
+
+
+class InstrumentedPool (PoolMetrics, ConnectionPool):
+	""" Unbounded connection pool with metrics (see PoolMetrics). """
+	pass
+
+
+class InstrumentedBlockingPool (PoolMetrics, BlockingConnectionPool):
+	""" Blocking connection pool with metrics (see PoolMetrics). """
+	pass
+
+
+class Pools (object):
+	""" Registry of named connection pools shared by models (see conf db).
+	Clients are created on first use, so no sockets are opened at import
+	time, and recreated in forked processes (with metrics), so
+	connections are never shared with parent process. """
+
+	def __init__ (self):
+		self._lock = Lock()
+		self._config = dict()
+		self._clients = dict()
+		self._pid = getpid()
+		FORKSAFE.add(self)
+
+	def configure (self, name='default', url=None, max_connections=None,
+			timeout=20, **kw):
+		""" Configure pool. Pool is unbounded by default, otherwise it opens
+		at most *max_connections* connections and waits *timeout* seconds
+		for free connection. Other parameters are connection ones (host,
+		port, db etc) or redis *url*. """
+
+		if max_connections is not None:
+			kw = dict(kw, max_connections=max_connections, timeout=timeout)
+
+		with self._lock:
+			self._config[name] = (url, kw)
+
+			client = self._clients.pop(name, None)
+
+		if client is not None:
+			client.connection_pool.disconnect()
+
+	def get (self, name='default'):
+		""" Return client of named pool. """
+
+		if register_at_fork is None and self._pid != getpid():
+			self.forked()
+
+		try:
+			return self._clients[name]
+
+		except KeyError:
+			pass
+
+		with self._lock:
+			if name not in self._clients:
+				if name not in self._config and name != 'default':
+					raise Exception('Unknown connection pool: %s' % name)
+
+				url, kw = self._config.get(name, (None, dict()))
+				cls = InstrumentedPool if 'max_connections' not in kw \
+					else InstrumentedBlockingPool
+
+				if url is None:
+					pool = cls(name, **kw)
+
+				else:
+					pool = cls.from_url(url, name=name, **kw)
+
+				self._clients[name] = StrictRedis(connection_pool=pool)
+
+			return self._clients[name]
+
+	def forked (self):
+		""" Forget clients (and so metrics) of parent process. """
+
+		with self._lock:
+			if self._pid != getpid():
+				self._clients = dict()
+				self._pid = getpid()
+
+	def metrics (self, name='default'):
+		""" Return counters of named pool (empty if pool is not used yet). """
+
+		client = self._clients.get(name)
+
+		if client is None:
+			return dict()
+
+		pool = client.connection_pool
+
+		with pool._counters_lock:
+			return pool.counters.copy()
+
+
+POOLS = Pools() # Named connection pools.
+
+
+class PoolClient (object):
+	""" Descriptor which resolves to client of named pool on access, i.e.
+	conf.db is client of 'default' pool created on first use. """
+
+	def __init__ (self, name='default'):
+		self.name = name
+
+	def __get__ (self, obj, owner):
+		return POOLS.get(self.name)
+
+
+def connection (db=None):
+	""" Return redis client of *db* which is client or pool name (see
+	Pools). Global conf.db is used by default. """
+
+	db = conf.db if db is None else db
+	return POOLS.get(db) if isinstance(db, (str, type(u''))) else db
+
+
+FEED_MAXLEN = 10000 # Default change feed length.
+VERSION_FIELD = '_ver' # Default version field of versioned models.
+VERSION_RETRIES = 3 # Default number of versioned save retries.
+VERSION_BACKOFF = 0.01 # Default first retry delay (seconds).
+
+BULK_SCRIPT = """
+local prefix = ARGV[1]
+local spec = cjson.decode(ARGV[2])
+local ttlkey = prefix .. ':_ttl'
+local count = 0
+
+local function bound (val)
+	if val == '-inf' or val == '+inf' or val == 'inf' then
+		return string.sub(val, 1, 1) == '-' and -math.huge or math.huge, false
+
+	elseif string.sub(val, 1, 1) == '(' then
+		return tonumber(string.sub(val, 2)), true
+	end
+
+	return tonumber(val), false
+end
+
+local function match (cond, id)
+	local kind = cond[1]
+
+	if kind == 'set' then
+		return redis.call('SISMEMBER', cond[2], id) == 1
+
+	elseif kind == 'bit' then
+		return redis.call('GETBIT', cond[2], tonumber(id)) == 1
+
+	elseif kind == 'range' then
+		local score = redis.call('ZSCORE', cond[2], id)
+
+		if not score then
+			return false
+		end
+
+		score = tonumber(score)
+		local minval, minx = bound(cond[3])
+		local maxval, maxx = bound(cond[4])
+
+		return (score > minval or score == minval and not minx) and
+			(score < maxval or score == maxval and not maxx)
+	end
+
+	for i = 2, #cond do
+		local ok = match(cond[i], id)
+
+		if ok ~= (kind == 'AND') then
+			return ok
+		end
+	end
+
+	return kind == 'AND'
+end
+
+for n, id in ipairs(spec.ids) do
+	local key = KEYS[n]
+
+	if redis.call('EXISTS', key) == 1 and match(spec.match, id) then
+		local expiring = redis.call('ZSCORE', ttlkey, id)
+		count = count + 1
+
+		for _, idx in ipairs(spec.idx) do
+			local name, kind, nonekey, new = idx[1], idx[2], idx[3], idx[4]
+			local old = redis.call('HGET', key, name)
+			local oldkey = old and (prefix .. ':' .. name .. ':' .. old) or nonekey
+
+			if kind == 'set' then
+				redis.call('SREM', oldkey, id)
+
+			elseif kind == 'bitmap' then
+				if old or redis.call('GETBIT', oldkey, tonumber(id)) == 1 then
+					redis.call('SETBIT', oldkey, tonumber(id), 0)
+				end
+
+			else
+				redis.call('ZREM', prefix .. ':' .. name, id)
+			end
+
+			if new ~= cjson.null then
+				if kind == 'set' then
+					redis.call('SADD', new, id)
+
+				elseif kind == 'bitmap' then
+					redis.call('SETBIT', new, tonumber(id), 1)
+
+				else
+					redis.call('ZADD', prefix .. ':' .. name, new, id)
+				end
+			end
+
+			if spec.delete or spec.set[name] == nil then
+				redis.call('HDEL', ttlkey .. ':' .. name, id)
+
+			elseif expiring then
+				redis.call('HSET', ttlkey .. ':' .. name, id, spec.set[name])
+			end
+		end
+
+		local fields = {}
+
+		if spec.delete then
+			fields = redis.call('HKEYS', key)
+			redis.call('DEL', key)
+			redis.call('ZREM', ttlkey, id)
+
+			for _, name in ipairs(spec.collections) do
+				redis.call('DEL', key .. ':' .. name)
+			end
+
+		else
+			for name, value in pairs(spec.set) do
+				redis.call('HSET', key, name, value)
+				table.insert(fields, name)
+			end
+
+			for _, name in ipairs(spec.unset) do
+				redis.call('HDEL', key, name)
+				table.insert(fields, name)
+			end
+
+			if spec.version ~= cjson.null then
+				redis.call('HINCRBY', key, spec.version, 1)
+			end
+		end
+
+		if spec.feed > 0 then
+			table.sort(fields)
+
+			redis.call('XADD', prefix .. ':_feed', 'MAXLEN', '~', spec.feed, '*',
+				'op', spec.delete and 'delete' or 'save', 'id', id,
+				'fields', table.concat(fields, ','))
+		end
+	end
+end
+
+return count
+"""
+
+REGISTRY = dict() # Global cls -> {id -> model} registry.
+UNIT = ContextLocal('redisca_unit') # Context-local registry if any.
+BATCH = ContextLocal('redisca_batch') # Current batch if any.
+
+
+class Unit (object):
+	""" Unit of work. Models initialized within unit are registered in
+	context-local registry (instead of global one) which is dropped on
+	exit. Use as context manager or call open() and close() directly. """
+
+	def __init__ (self):
+		self.registry = dict()
+		self._prev = None
+
+	def __enter__ (self):
+		return self.open()
+
+	def __exit__ (self, exc_type, exc_value, traceback):
+		self.close()
+
+	def open (self):
+		self._prev = UNIT.get()
+		UNIT.set(self.registry)
+		return self
+
+	def close (self):
+		UNIT.set(self._prev)
+		self._prev = None
+		self.registry.clear()
+
+
+class Batch (object):
+	""" Implicit batching context. Models load() calls are deferred and
+	resolved together by single pipeline (per connection) on first data
+	access. Writes of save() and delete() called without pipe are queued
+	into transaction pipeline (per connection) executed on exit. Queued
+	writes are dropped and touched models unloaded if exception raised. """
+
+	def __init__ (self):
+		self.reads = []
+		self.pipes = dict()
+		self.touched = []
+		self._prev = None
+
+	def __enter__ (self):
+		self._prev = BATCH.get()
+		BATCH.set(self)
+		return self
+
+	def __exit__ (self, exc_type, exc_value, traceback):
+		BATCH.set(self._prev)
+		self._prev = None
+
+		if exc_type is None:
+			self.flush()
+
+		else:
+			self.discard()
+
+	def defer (self, model):
+		""" Queue model loading. """
+		self.reads.append(model)
+
+	def resolve (self):
+		""" Load all queued models. """
+
+		models, self.reads = self.reads, []
+		hydrate(models)
+
+	def pipe (self, model):
+		""" Return write pipeline of model connection. """
+
+		db = model.getdb()
+
+		if id(db) not in self.pipes:
+			self.pipes[id(db)] = db.pipeline(transaction=True)
+
+		self.touched.append(model)
+		return self.pipes[id(db)]
+
+	def flush (self):
+		""" Execute queued writes. """
+
+		pipes, self.pipes = self.pipes, dict()
+		self.touched = []
+
+		for pipe in pipes.values():
+			if len(pipe):
+				pipe.execute()
+
+	def discard (self):
+		""" Drop queued writes and unload touched models. """
+
+		for pipe in self.pipes.values():
+			pipe.reset()
+
+		for model in self.touched:
+			model._exists = None
+			model.unload()
+
+		self.pipes = dict()
+		self.touched = []
+		self.reads = []
+
+
+def hydrate (models):
+	""" Load data of given models using single pipeline per connection. """
+
+	batches = dict()
+
+	for model in models:
+		if model.loaded():
+			continue
+
+		if model._exists is False:
+			model._data = dict()
+			continue
+
+		db = model.getdb()
+
+		if id(db) not in batches:
+			batches[id(db)] = (db.pipeline(transaction=False), [])
+
+		pipe, batch = batches[id(db)]
+		model.getstorage().load(model.__class__, model.getid(), pipe)
+		batch.append(model)
+
+	for pipe, batch in batches.values():
+		for model, raw in zip(batch, pipe.execute()):
+			model._fill(raw)
+
+
+def prefetch (models, *paths):
+	""" Load given models and models linked by dotted *paths* of Reference
+	fields (i.e. 'user.company') using one pipelined batch per level. """
+
+	models = list(models)
+	hydrate(models)
+
+	for path in paths:
+		level = models
+
+		for name in path.split('.'):
+			refs = dict()
+
+			for model in level:
+				if not isinstance(model._fields.get(name), Reference):
+					raise Exception('%s.%s is not a reference field' % (
+						model.__class__.__name__, name))
+
+				ref = getattr(model, name)
+
+				if ref is not None:
+					refs[id(ref)] = ref
+
+			level = list(refs.values())
+			hydrate(level)
+
+	return models
+
+
+class BExpr (object):
+	EQ = '='
+	GT = '>'
+	LT = '<'
+	GE = '>='
+	LE = '<='
+	AND = 'AND'
+	OR = 'OR'
+
+	def __init__ (self, operator, field, val):
+		assert isinstance(field, Field)
+
+		self.models = None
+		self.operator = operator
+		self.field = field
+		self.val = val
+		self.owner = getattr(field, 'owner', None)
+
+		super(BExpr, self).__init__()
+
+	def __len__ (self):
+		self.load()
+		return len(self.models)
+
+	def __getitem__ (self, key):
+		self.load()
+		return self.models[key]
+
+	def __setitem__ (self, key, value):
+		raise NotImplementedError()
+
+	def __iter__ (self):
+		self.load()
+		return iter(self.models)
+
+	def __contains__ (self, item):
+		self.load()
+		return item in self.models
+
+	def __and__ (self, other):
+		return BitOp(BExpr.AND, self, other)
+
+	def __or__ (self, other):
+		return BitOp(BExpr.OR, self, other)
+
+	def loaded (self):
+		return self.models is not None
+
+	def count (self):
+		""" Return result length without loading models if possible. """
+
+		if self.loaded():
+			return len(self.models)
+
+		if isinstance(self.field, RangeIndexField):
+			return self.field.count(*self.bounds())
+
+		if self.operator == self.EQ:
+			return self.field.count(self.val)
+
+		return len(self)
+
+	def bounds (self):
+		""" Return (minval, maxval) scores of range expression. """
+
+		if self.operator == self.EQ:
+			return self.val, self.val
+
+		elif self.operator == self.GT:
+			return '(%d' % int(self.val), '+inf'
+
+		elif self.operator == self.GE:
+			return int(self.val), '+inf'
+
+		elif self.operator == self.LT:
+			return '-inf', '(%d' % int(self.val)
+
+		elif self.operator == self.LE:
+			return '-inf', '%d' % int(self.val)
+
+		raise Exception('Unsupported operator type given')
+
+	def unload (self):
+		self.models = None
+
+	def condition (self):
+		""" Return JSON-serializable result membership condition which is
+		checked by bulk script (see BULK_SCRIPT match()). """
+
+		prefix = self.owner.getprefix()
+
+		if isinstance(self.field, RangeIndexField):
+			bounds = [self.field.score(b) for b in self.bounds()]
+			return ['range', self.field.idx_key(prefix)] + \
+				[str(b) if PY3K else unicode(b) for b in bounds]
+
+		if self.operator != self.EQ:
+			raise Exception('Unsupported operator type given')
+
+		return ['bit' if self.field.bitmap else 'set',
+			self.field.idx_key(prefix, self.val)]
+
+	def iterchunks (self, chunk=1000):
+		""" Iterate over lists of at most *chunk* result ids without loading
+		models (or keeping them in memory). Set and range results are
+		copied into temporary key first, so iteration is stable while
+		result changes. """
+
+		if isinstance(self.field, IndexField) and self.field.bitmap:
+			ids = self.field.iterids(self.val, max(chunk // 8, 1))
+			return chunks((str(i) for i in ids), chunk)
+
+		db = self.owner.getdb()
+		key = tempkey(self.owner.getprefix(), '_bulk')
+
+		if isinstance(self.field, RangeIndexField):
+			minval, maxval = [self.field.score(b) for b in self.bounds()]
+			db.execute_command('ZRANGESTORE', key, self.field.idx_key(
+				self.owner.getprefix()), minval, maxval, 'BYSCORE')
+			pop = lambda: db.execute_command('ZPOPMIN', key, chunk)[::2]
+
+		else:
+			db.sunionstore(key, self.field.idx_key(self.owner.getprefix(), self.val))
+			pop = lambda: db.execute_command('SPOP', key, chunk)
+
+		return drain(db, key, pop)
+
+	def delete (self, chunk=1000):
+		""" Delete result models and their index entries inside redis using
+		Lua script for each *chunk* of ids. Return deleted models count. """
+		return self.bulk(None, chunk)
+
+	def update (self, chunk=1000, **fields):
+		""" Set given fields values of result models and update indexes
+		inside redis using Lua script for each *chunk* of ids. Unique fields
+		can not be updated. Return updated models count. """
+		return self.bulk(fields, chunk)
+
+	def bulk (self, fields, chunk):
+		""" Run bulk delete (if *fields* is None) or update script. Model
+		keys of each chunk are passed as script KEYS, but index, ttl,
+		collection and feed keys are derived from them inside script (old
+		index keys depend on stored values). So bulk operations are not
+		supported by redis cluster and ACL rules must allow all keys of
+		model prefix.
+
+		Result ids are streamed by chunks (see iterchunks()), models are
+		never loaded and only ones found in registry are invalidated. Each
+		model is checked to match expression inside script again, so models
+		changed since ids were read are skipped. """
+
+		cls = self.owner
+
+		if type(cls.getstorage()) is not HashStorage:
+			raise Exception('Bulk operations require hash storage')
+
+		prefix = cls.getprefix()
+
+		spec = {
+			'match': self.condition(),
+			'delete': fields is None,
+			'feed': cls.getfeed() or 0,
+			'version': cls.getversionfield(),
+			'collections': [c.field for c in cls.getcollections().values()],
+			'idx': [],
+			'set': dict(),
+			'unset': [],
+		}
+
+		if fields is not None:
+			data = dict()
+
+			for name, value in fields.items():
+				field = cls._fields[name]
+
+				if field.unique:
+					raise Exception('Unique fields can not be bulk updated')
+
+				field.__set__(data, value)
+
+			for name, value in data.items():
+				if value is None:
+					spec['unset'].append(name)
+
+				else:
+					spec['set'][name] = str(value) if PY3K else unicode(value)
+
+		for field in cls.getfields().values():
+			if not field.indexed():
+				continue
+
+			if fields is not None and field.field not in data:
+				continue
+
+			if getattr(field, 'text', False):
+				raise Exception('Text indexes are not supported by bulk operations')
+
+			if isinstance(field, GeoPoint):
+				if fields is not None:
+					raise Exception('Geo fields can not be bulk updated')
+
+				spec['idx'].append([field.field, 'zset', None, None])
+
+			elif isinstance(field, RangeIndexField):
+				if field.partition:
+					raise Exception('Partitioned indexes are not supported by bulk operations')
+
+				val = data.get(field.field) if fields is not None else None
+				score = None if val is None else field.to_db(val)
+				spec['idx'].append([field.field, 'zset', None, score])
+
+			else:
+				kind = 'bitmap' if field.bitmap else 'set'
+				newkey = None if fields is None else \
+					field.idx_key(prefix, data[field.field])
+
+				spec['idx'].append([field.field, kind,
+					field.idx_key(prefix, None), newkey])
+
+		script = cls.getdb().register_script(BULK_SCRIPT)
+		count = 0
+
+		for ids in self.iterchunks(chunk):
+			spec['ids'] = ids
+			count += script(keys=[cls.getstorage().key(cls, i) for i in ids],
+				args=[prefix, json.dumps(spec)])
+
+			objects = cls._objects
+
+			for model in [objects[i] for i in ids if i in objects]:
+				if fields is None:
+					model._diff = dict()
+					model._data = dict()
+					model._exists = False
+
+				else:
+					model.unload()
+
+		self.unload()
+		return count
+
+	def order_by (self, field, desc=False, start=0, limit=None, get=None,
+			ids=False, load=False):
+		""" Return page of result models (or *ids*, or tuples of *get*
+		fields values) sorted by *field* value inside redis (SORT BY). Range
+		fields are sorted numerically and other fields alphanumerically.
+		Supported by equality expressions of set indexes only. """
+
+		cls = self.owner
+
+		if self.operator != self.EQ or not isinstance(self.field, IndexField) \
+				or self.field.bitmap:
+			raise Exception('Sorting is supported by set index equality expressions only')
+
+		if cls.getstorage().whole:
+			raise Exception('Sorting requires hash storage')
+
+		fields = cls.getfields()
+		field = field if isinstance(field, Field) else fields[field]
+		prefix = cls.getprefix()
+		pattern = lambda f: '%s:*->%s' % (prefix, f.field)
+
+		if get is not None:
+			get = [f if isinstance(f, Field) else fields[f] for f in get]
+
+		if limit is not None or start:
+			start, limit = start or 0, -1 if limit is None else limit
+
+		else:
+			start = None
+
+		reply = cls.getdb().sort(self.field.idx_key(prefix, self.val),
+			start=start, num=limit, by=pattern(field), desc=desc,
+			get=None if get is None else [pattern(f) for f in get],
+			alpha=not isinstance(field, RangeIndexField))
+
+		if get is not None:
+			values = [None if v is None else f.from_db(totext(v)) \
+				for f, v in zip(get * len(reply), reply)]
+
+			return [tuple(values[n:n + len(get)]) for n in range(0, len(values), len(get))]
+
+		found = [totext(i) for i in reply]
+
+		if ids:
+			return found
+
+		models = [cls(model_id) for model_id in found]
+
+		if load:
+			hydrate(models)
+
+		return models
+
+	def prefetch (self, *paths):
+		""" Load result models and their references. See prefetch(). """
+
+		self.load()
+		prefetch(self.models, *paths)
+		return self
+
+	def load (self):
+		""" Load result into expression. """
+
+		if self.loaded():
+			return
+
+		if self.operator == self.EQ:
+			self.models = self.field.find(self.val)
+
+		else:
+			minval, maxval = self.bounds()
+			self.models = self.field.range(minval=minval, maxval=maxval)
+
+
+class BitOp (BExpr):
+	""" AND/OR of bitmap index expressions evaluated with BITOP, i.e.
+	(User.active == 1) & (User.admin == 0) | (User.staff == 1). """
+
+	def __init__ (self, operator, *exprs):
+		assert operator in (self.AND, self.OR)
+		owner = exprs[0].field.owner
+
+		for expr in exprs:
+			assert isinstance(expr, BitOp) or \
+				expr.operator == self.EQ and expr.field.bitmap
+
+			assert expr.field.owner is owner
+
+		self.models = None
+		self.operator = operator
+		self.field = exprs[0].field
+		self.val = exprs
+		self.owner = owner
+
+	def bitkey (self, pipe, keys):
+		""" Queue BITOP into *pipe* and return key of result bitmap.
+		Temporary keys are appended to *keys* list. """
+
+		prefix = self.owner.getprefix()
+		srckeys = []
+
+		for expr in self.val:
+			if isinstance(expr, BitOp):
+				srckeys.append(expr.bitkey(pipe, keys))
+
+			else:
+				srckeys.append(expr.field.idx_key(prefix, expr.val))
+
+		key = tempkey(prefix, '_bitop')
+		keys.append(key)
+
+		pipe.bitop(self.operator, key, *srckeys)
+		pipe.expire(key, 60)
+
+		return key
+
+	def execute (self, command):
+		""" Return *command*(pipe, key) result on result bitmap. Bitmap is
+		stored, read and deleted in one transaction. """
+
+		keys = []
+		pipe = self.owner.getdb().pipeline(transaction=True)
+		command(pipe, self.bitkey(pipe, keys))
+		pipe.delete(*keys)
+
+		return pipe.execute()[-2]
+
+	def count (self):
+		if self.loaded():
+			return len(self.models)
+
+		return self.execute(lambda pipe, key: pipe.bitcount(key))
+
+	def iterids (self, chunk=4096):
+		""" Iterate over result ids reading bitmap by *chunk* bytes. """
+
+		keys = []
+		db = self.owner.getdb()
+		pipe = db.pipeline(transaction=True)
+		key = self.bitkey(pipe, keys)
+		pipe.execute()
+
+		try:
+			for model_id in iterbits(db, key, chunk, 60):
+				yield model_id
+
+		finally:
+			db.delete(*keys)
+
+	def condition (self):
+		return [self.operator] + [expr.condition() for expr in self.val]
+
+	def iterchunks (self, chunk=1000):
+		return chunks((str(i) for i in self.iterids(max(chunk // 8, 1))), chunk)
+
+	def load (self):
+		if self.loaded():
+			return
+
+		data = self.execute(lambda pipe, key: pipe.get(key))
+		self.models = [self.owner(model_id) for model_id in bits(data or b'')]
+
+
+class Field (object):
+	def __init__ (self, field, index=False, unique=False, new=None):
+		self.new = new
+		self.index = bool(index)
+		self.unique = bool(unique)
+		self.field = field
+
+	def __get__ (self, model, owner):
+		self.owner = owner
+
+		if model is None:
+			return self
+
+		val = model[self.field]
+		return None if val is None else self.from_db(val)
+
+	def __set__ (self, model, value):
+		model[self.field] = None if value is None else self.to_db(value)
+
+	def indexed (self):
+		""" Check if field is maintained by save_idx() and del_idx(). """
+		return self.index or self.unique
+
+	def prev_idx_val (self, model):
+		""" Get previously indexed value. """
+
+		if not model.exists():
+			return None
+
+		elif model.loaded() and self.field in model._data:
+			return model._data[self.field]
+
+		else:
+			storage = model.getstorage()
+			reply = storage.get(model.__class__, model._id, self.field, model.getdb())
+			return storage.decode_get(reply, self.field)
+
+	def __lt__ (self, other):
+		return BExpr(operator=BExpr.LT, field=self, val=other)
+
+	def __le__ (self, other):
+		return BExpr(operator=BExpr.LE, field=self, val=other)
+
+	def __gt__ (self, other):
+		return BExpr(operator=BExpr.GT, field=self, val=other)
+
+	def __ge__ (self, other):
+		return BExpr(operator=BExpr.GE, field=self, val=other)
+
+	def __eq__ (self, other):
+		return BExpr(operator=BExpr.EQ, field=self, val=other)
+
+	def from_db (self, val):
+		return val
+
+	def to_db (self, val):
+		return str(val) if PY3K else unicode(val)
+
+
+class IndexField (Field):
+	""" Base class for fields with exact indexing. Index is a set of model
+	ids per value or a bitmap of (integer) model ids if *bitmap* is set. """
+
+	def __init__ (self, bitmap=False, **kw):
+		super(IndexField, self).__init__(**kw)
+		assert not (bitmap and self.unique)
+		self.bitmap = bool(bitmap)
+
+	def idx_key (self, prefix, val):
+		val = self.to_db(val)
+		val = str(val) if PY3K else unicode(val)
+		return ':'.join((prefix, self.field, val))
+
+	def find (self, val, children=False):
+		assert self.index or self.unique
+		classes = [self.owner]
+
+		if children:
+			classes += list(self.owner.inheritors())
+
+		def query (cls, pipe):
+			if self.bitmap:
+				pipe.get(self.idx_key(cls.getprefix(), val))
+
+			else:
+				pipe.smembers(self.idx_key(cls.getprefix(), val))
+
+		models = []
+
+		for cls, ids in zip(classes, fanout(classes, query)):
+			if self.bitmap:
+				ids = bits(ids or b'')
+
+			models += [cls(model_id) for model_id in ids]
+
+		return models
+
+	def getids (self, cls, val):
+		""" Return ids of *cls* models indexed with *val*. """
+
+		key = self.idx_key(cls.getprefix(), val)
+
+		if self.bitmap:
+			return list(iterbits(cls.getdb(), key))
+
+		return cls.getdb().smembers(key)
+
+	def iterids (self, val, chunk=4096):
+		""" Iterate over ids of bitmap index reading it by *chunk* bytes. """
+
+		assert self.bitmap
+		key = self.idx_key(self.owner.getprefix(), val)
+		return iterbits(self.owner.getdb(), key, chunk)
+
+	def count (self, val):
+		""" Return count of models indexed with *val*. """
+
+		assert self.index or self.unique
+		key = self.idx_key(self.owner.getprefix(), val)
+		db = self.owner.getdb()
+
+		return db.bitcount(key) if self.bitmap else db.scard(key)
+
+	def find_many (self, vals, load=False):
+		""" Return val -> models dict for each of given values using single
+		pipeline. Model values (references) are replaced with their ids.
+		Optionally *load* found models in one more pipelined batch. """
+
+		assert self.index or self.unique
+		prefix = self.owner.getprefix()
+		vals = [v.getid() if isinstance(v, Model) else v for v in vals]
+		pipe = self.owner.getdb().pipeline(transaction=False)
+
+		for val in vals:
+			if self.bitmap:
+				pipe.get(self.idx_key(prefix, val))
+
+			else:
+				pipe.smembers(self.idx_key(prefix, val))
+
+		found = dict()
+
+		for val, ids in zip(vals, pipe.execute()):
+			if self.bitmap:
+				ids = bits(ids or b'')
+
+			found[val] = [self.owner(model_id) for model_id in ids]
+
+		if load:
+			hydrate([m for models in found.values() for m in models])
+
+		return found
+
+	def count_many (self, vals):
+		""" Return val -> models count dict using pipelined SCARD (or
+		BITCOUNT for bitmap index). """
+
+		assert self.index or self.unique
+		prefix = self.owner.getprefix()
+		vals = [v.getid() if isinstance(v, Model) else v for v in vals]
+		pipe = self.owner.getdb().pipeline(transaction=False)
+
+		for val in vals:
+			if self.bitmap:
+				pipe.bitcount(self.idx_key(prefix, val))
+
+			else:
+				pipe.scard(self.idx_key(prefix, val))
+
+		return dict(zip(vals, pipe.execute()))
+
+	def choice (self, val, count=1):
+		""" Return *count* random model(s) from find() result. """
+
+		assert self.index or self.unique
+		key = self.idx_key(self.owner.getprefix(), val)
+
+		if self.bitmap:
+			ids = self.getids(self.owner, val)
+			ids = sample(ids, min(count, len(ids)))
+
+		else:
+			ids = self.owner.getdb().srandmember(key, count)
+
+		return None if not len(ids) else \
+			[self.owner(model_id) for model_id in ids]
+
+	def save_idx (self, model, pipe=None):
+		prev_idx_val = self.prev_idx_val(model)
+
+		if prev_idx_val == model[self.field]:
+			return # Nothing to do.
+
+		idx_key = self.idx_key(model.getprefix(), model[self.field])
+
+		if self.unique:
+			ids = model.getdb().smembers(idx_key)
+
+			if len(ids):
+				ids.discard(bytes(model._id, 'utf-8') if PY3K else model._id)
+
+				if len(ids):
+					raise Exception('Duplicate key error')
+
+		if model.exists(): # Nothing is indexed before first save.
+			self.unindex(model.getprefix(), model._id, prev_idx_val, pipe,
+				model.getdb())
+
+		if self.bitmap:
+			pipe.setbit(idx_key, bitoffset(model._id), 1)
+
+		else:
+			pipe.sadd(idx_key, model._id)
+
+	def del_idx (self, model, pipe=None):
+		self.unindex(model.getprefix(), model._id, self.prev_idx_val(model), pipe,
+			model.getdb())
+
+	def unindex (self, prefix, model_id, val, pipe, db=None):
+		""" Remove model id indexed with raw *val* from index. Bit of
+		None value is checked (GETBIT) on *db* first if given, because
+		models without value are not indexed unless None is saved and
+		SETBIT allocates bitmap up to model id. """
+
+		if self.bitmap:
+			key = self.idx_key(prefix, val)
+
+			if val is None and db is not None and \
+					not db.getbit(key, bitoffset(model_id)):
+				return
+
+			pipe.setbit(key, bitoffset(model_id), 0)
+
+		else:
+			pipe.srem(self.idx_key(prefix, val), model_id)
+
+
+class RangeIndexField (Field):
+	""" Base class for fields with range indexing. """
+
+	partition = None # See DateTime.
+
+	def idx_key (self, prefix):
+		return ':'.join((prefix, self.field))
+
+	def idx_keys (self, cls, minval='-inf', maxval='+inf'):
+		""" Return keys of *cls* index zsets which may contain scores
+		within given range (see partitioned DateTime). """
+		return [self.idx_key(cls.getprefix())]
+
+	def find (self, val, children=False):
+		return self.range(
+			minval=val,
+			maxval=val,
+			children=children,
+		)
+
+	def range (self, minval='-inf', maxval='+inf', start=None, num=None, children=False):
+		assert self.index or self.unique
+
+		if num is not None and start is None:
+			start = 0
+
+		minval = self.score(minval)
+		maxval = self.score(maxval)
+
+		if not children:
+			ids = self.zrange(self.owner, minval, maxval, start, num)
+			return [self.owner(model_id) for model_id in ids]
+
+		# Query first start + num items of each class and merge them by
+		# score to get global page.
+
+		classes = [self.owner] + list(self.owner.inheritors())
+		limit = None if num is None else start + num
+
+		if self.partition: # Partitions of all classes are listed at once.
+			labels = fanout(classes, lambda cls, pipe: \
+				self.labels(cls, minval, maxval, pipe))
+
+			keys = dict((cls, [self.part_key(cls.getprefix(), totext(label)) \
+				for label in reply]) for cls, reply in zip(classes, labels))
+
+		else:
+			keys = dict((cls, self.idx_keys(cls)) for cls in classes)
+
+		def query (cls, pipe):
+			for key in keys[cls]:
+				pipe.zrangebyscore(key, minval, maxval,
+					start=None if limit is None else 0, num=limit, withscores=True)
+
+		# Partitions are ordered by time, so their replies are just joined.
+		replies = [[item for reply in parts for item in reply] \
+			for parts in fanout(classes, query, many=True)]
+
+		items = [[(score, n, i, cls, model_id) for i, (model_id, score) in enumerate(reply)] \
+			for n, (cls, reply) in enumerate(zip(classes, replies))]
+
+		items = list(merge(*items))
+		items = items[start or 0:limit]
+
+		return [cls(model_id) for score, n, i, cls, model_id in items]
+
+	def zrange (self, cls, minval, maxval, start=None, num=None, withscores=False):
+		""" Return ZRANGEBYSCORE reply of *cls* index. Partitions are
+		counted (pipelined ZCOUNT) first to query only ones overlapping with
+		requested page. """
+
+		keys = self.idx_keys(cls, minval, maxval)
+		db = cls.getdb()
+
+		if len(keys) == 1:
+			return db.zrangebyscore(keys[0], minval, maxval, start=start,
+				num=num, withscores=withscores)
+
+		pipe = db.pipeline(transaction=False)
+
+		for key in keys:
+			pipe.zcount(key, minval, maxval)
+
+		skip = start or 0
+		left = num
+
+		for key, count in zip(keys, pipe.execute()):
+			if left == 0:
+				break
+
+			if skip >= count:
+				skip -= count
+				continue
+
+			take = count - skip if left is None else min(count - skip, left)
+			pipe.zrangebyscore(key, minval, maxval, start=skip, num=take,
+				withscores=withscores)
+
+			left = None if left is None else left - take
+			skip = 0
+
+		return [item for reply in pipe.execute() for item in reply]
+
+	def score (self, val):
+		""" Return index score of value. Strings (i.e. '(10' or '-inf')
+		are passed to redis as is. """
+		return val if type(val) is str else self.to_db(val)
+
+	def count (self, minval='-inf', maxval='+inf'):
+		""" Return count of models within scores range (ZCOUNT). """
+
+		assert self.index or self.unique
+		minval, maxval = self.score(minval), self.score(maxval)
+		keys = self.idx_keys(self.owner, minval, maxval)
+		pipe = self.owner.getdb().pipeline(transaction=False)
+
+		for key in keys:
+			pipe.zcount(key, minval, maxval)
+
+		return sum(pipe.execute())
+
+	def min (self):
+		""" Return minimal indexed value or None if index is empty. """
+		return self.edge(0)
+
+	def max (self):
+		""" Return maximal indexed value or None if index is empty. """
+		return self.edge(-1)
+
+	def edge (self, rank):
+		""" Return indexed value by *rank* (ZRANGE WITHSCORES). """
+
+		assert self.index or self.unique
+		keys = self.idx_keys(self.owner)
+
+		if len(keys) == 1:
+			items = self.owner.getdb().zrange(keys[0], rank, rank, withscores=True)
+			return self.from_db(items[0][1]) if len(items) else None
+
+		return self.byrank(keys, self.cards(keys), [rank])[0]
+
+	def cards (self, keys):
+		""" Return list of index zsets sizes (pipelined ZCARD). """
+
+		pipe = self.owner.getdb().pipeline(transaction=False)
+
+		for key in keys:
+			pipe.zcard(key)
+
+		return pipe.execute()
+
+	def byrank (self, keys, cards, ranks):
+		""" Return list of indexed values by global *ranks* of index zsets
+		*keys* of given sizes. Out of range ranks give None. """
+
+		total = sum(cards)
+		pipe = self.owner.getdb().pipeline(transaction=False)
+		found = []
+
+		for rank in ranks:
+			rank = rank + total if rank < 0 else rank
+			found.append(0 <= rank < total)
+
+			if not found[-1]:
+				continue
+
+			for key, card in zip(keys, cards):
+				if rank < card:
+					pipe.zrange(key, rank, rank, withscores=True)
+					break
+
+				rank -= card
+
+		replies = iter(pipe.execute())
+
+		return [self.from_db(next(replies)[0][1]) if ok else None for ok in found]
+
+	def histogram (self, edges):
+		""" Return list of models counts within [edges[i], edges[i + 1])
+		ranges using pipelined ZCOUNT. """
+
+		assert self.index or self.unique
+		edges = [self.score(edge) for edge in edges]
+		keys = self.idx_keys(self.owner, edges[0], edges[-1])
+		pipe = self.owner.getdb().pipeline(transaction=False)
+
+		for minval, maxval in zip(edges[:-1], edges[1:]):
+			for key in keys:
+				pipe.zcount(key, minval, '(%s' % maxval)
+
+		counts = pipe.execute()
+		n = len(keys)
+
+		return [sum(counts[i:i + n]) for i in range(0, len(counts), n)] \
+			if n else [0] * (len(edges) - 1)
+
+	def quantile (self, q):
+		""" Return approximate (nearest rank) quantile of indexed values. """
+		return self.quantiles([q])[0]
+
+	def quantiles (self, qs):
+		""" Return list of quantile() values using ZCARD and pipelined
+		ZRANGE by rank. """
+
+		assert self.index or self.unique
+		keys = self.idx_keys(self.owner)
+		cards = self.cards(keys)
+		total = sum(cards)
+
+		if not total:
+			return [None] * len(qs)
+
+		for q in qs:
+			assert 0 <= q <= 1
+
+		return self.byrank(keys, cards, [int(round(q * (total - 1))) for q in qs])
+
+	def save_idx (self, model, pipe=None):
+		key = self.idx_key(model.getprefix())
+		val = model[self.field]
+
+		if self.unique:
+			models = self.find(val, val)
+
+			if len(models) > 1 or len(models) == 1 and models[0] is not model:
+				raise Exception('Duplicate key error')
+
+		pipe.zadd(key, **{
+			model._id: self.to_db(val)
+		})
+
+	def del_idx (self, model, pipe=None):
+		self.unindex(model.getprefix(), model._id, None, pipe)
+
+	def unindex (self, prefix, model_id, val, pipe):
+		""" Remove model id from index. """
+		pipe.zrem(self.idx_key(prefix), model_id)
+
+
+class Bool (IndexField):
+	def to_db (self, val):
+		return 1 if (val and val != '0') else 0
+
+	def from_db (self, val):
+		return val == '1' or val == 1
+
+
+class String (IndexField):
+	""" String field. Optional *text* index keeps a set of model ids per
+	(lowercased) word of value and supports search(). """
+
+	TOKEN_REGEXP = re.compile(r'\w+', re.UNICODE)
+
+	def __init__ (self, minlen=None, maxlen=None, text=False, **kw):
+		super(String, self).__init__(**kw)
+
+		if minlen is not None and maxlen is not None:
+			assert minlen < maxlen
+
+		self.minlen = minlen
+		self.maxlen = maxlen
+		self.text = bool(text)
+
+	def indexed (self):
+		return self.text or super(String, self).indexed()
+
+	def tokens (self, val):
+		""" Return set of normalized words of value. """
+		return set() if val is None else set(self.TOKEN_REGEXP.findall(val.lower()))
+
+	def text_key (self, prefix, token):
+		return ':'.join((prefix, '~' + self.field, token))
+
+	def search (self, query, mode='and', start=None, num=None, ids=False, load=False):
+		""" Return models (or *ids*) which values contain all (*mode* is
+		'and') or any ('or') words of query. Matches are intersected or
+		united inside redis and sorted by id for paging. Optionally *load*
+		found models in one pipelined batch. """
+
+		assert self.text
+		assert mode in ('and', 'or')
+
+		prefix = self.owner.getprefix()
+		keys = [self.text_key(prefix, t) for t in sorted(self.tokens(query))]
+
+		if not len(keys):
+			return []
+
+		if num is not None and start is None:
+			start = 0
+
+		pipe = self.owner.getdb().pipeline(transaction=len(keys) > 1)
+		key = keys[0]
+
+		if len(keys) > 1:
+			key = tempkey(prefix, '_search')
+
+			if mode == 'and':
+				pipe.sinterstore(key, keys)
+
+			else:
+				pipe.sunionstore(key, keys)
+
+		pipe.sort(key, start=start, num=num, alpha=True)
+
+		if len(keys) > 1:
+			pipe.delete(key)
+			found = pipe.execute()[-2]
+
+		else:
+			found = pipe.execute()[-1]
+
+		found = [totext(i) for i in found]
+
+		if ids:
+			return found
+
+		models = [self.owner(model_id) for model_id in found]
+
+		if load:
+			hydrate(models)
+
+		return models
+
+	def save_idx (self, model, pipe=None):
+		if self.text:
+			prev_val = self.prev_idx_val(model)
+			prefix = model.getprefix()
+
+			prev_tokens = self.tokens(prev_val)
+			tokens = self.tokens(model[self.field])
+
+			for token in prev_tokens - tokens:
+				pipe.srem(self.text_key(prefix, token), model._id)
+
+			for token in tokens - prev_tokens:
+				pipe.sadd(self.text_key(prefix, token), model._id)
+
+		if super(String, self).indexed():
+			super(String, self).save_idx(model, pipe)
+
+	def unindex (self, prefix, model_id, val, pipe, db=None):
+		for token in self.tokens(val):
+			pipe.srem(self.text_key(prefix, token), model_id)
+
+		if super(String, self).indexed():
+			super(String, self).unindex(prefix, model_id, val, pipe, db)
+
+	def __set__ (self, model, value):
+		if value is not None:
+			value = str(value) if PY3K else unicode(value)
+
+			if self.minlen is not None and len(value) < self.minlen:
+				raise Exception('Minimal length check failed')
+
+			if self.maxlen is not None and len(value) > self.maxlen:
+				raise Exception('Maximum length check failed')
+
+		model[self.field] = value
+
+
+class Email (IndexField):
+	def __set__ (self, model, value):
+		if value is not None:
+			value = value.lower()
+
+			if EMAIL_REGEXP.match(value) == None:
+				raise Exception('Email validation failed')
+
+		return super(Email, self).__set__(model, value)
+
+	def idx_key (self, prefix, val):
+		if val is not None:
+			val = val.lower()
+
+		return super(Email, self).idx_key(prefix, val)
+
+	def find (self, val, children=False):
+		if val is not None:
+			val = val.lower()
+
+		return super(Email, self).find(val, children)
+
+	def choice (self, val, count=1):
+		if val is not None:
+			val = val.lower()
+
+		return super(Email, self).choice(val, count)
+
+
+class Integer (RangeIndexField):
+	def __init__ (self, minval=None, maxval=None, **kw):
+		super(Integer, self).__init__(**kw)
+
+		if minval is not None and maxval is not None:
+			assert minval < maxval
+
+		self.minval = minval
+		self.maxval = maxval
+
+	def __set__ (self, model, value):
+		if value is not None:
+			value = int(value)
+
+			if self.minval is not None and value < self.minval:
+				raise Exception('Minimal value check failed')
+
+			if self.maxval is not None and value > self.maxval:
+				raise Exception('Maximum value check failed')
+
+		model[self.field] = value
+
+	def to_db (self, val):
+		return int(val)
+
+	def from_db (self, val):
+		return int(val)
+
+
+class Counter (RangeIndexField):
+	""" Integer (or *floating*) counter changed atomically by incr(), so
+	concurrent increments are never lost. Range index (if any) is updated
+	within the same transaction. """
+
+	def __init__ (self, floating=False, **kw):
+		super(Counter, self).__init__(**kw)
+		assert not self.unique
+		self.floating = bool(floating)
+
+	def to_db (self, val):
+		return float(val) if self.floating else int(val)
+
+	def from_db (self, val):
+		return float(val) if self.floating else int(val)
+
+	def incr (self, model, n=1, pipe=None):
+		""" Increment counter of *model* by *n* using HINCRBY (HINCRBYFLOAT)
+		and ZINCRBY (if indexed) and return new value. If parent *pipe* is
+		given (or batch is active) increment is queued, model is unloaded
+		and None returned. Version of versioned models is incremented too.
+		Change feed event contains increment as new value. """
+
+		if model.getstorage().whole:
+			raise Exception('Counters require hash storage')
+
+		if self.field in model._diff:
+			raise Exception('Counter has unsaved changes')
+
+		n = self.to_db(n)
+
+		if pipe is None and BATCH.get() is not None:
+			pipe = BATCH.get().pipe(model)
+
+		_pipe = model.getpipe(pipe)
+		key = model.getkey()
+		version = model.getversionfield()
+
+		if self.floating:
+			_pipe.hincrbyfloat(key, self.field, n)
+
+		else:
+			_pipe.hincrby(key, self.field, n)
+
+		if version is not None:
+			_pipe.hincrby(key, version, 1)
+
+		if self.index:
+			_pipe.zincrby(self.idx_key(model.getprefix()), model._id, n)
+
+		if model.getfeed() is not None:
+			model.feed_event(_pipe, 'incr', {self.field: n})
+
+		if pipe is not None:
+			model._exists = None
+			model.unload()
+			return None
+
+		replies = _pipe.execute()
+
+		if model.loaded():
+			model._data[self.field] = self.to_db(replies[0])
+
+			if version is not None:
+				model._data[version] = str(replies[1])
+
+		model._exists = True
+		return self.from_db(replies[0])
+
+
+class DateTime (RangeIndexField):
+	""" Datetime field stored as unix timestamp. Naive datetimes are
+	treated as local time. Optional *partition* ('day', 'week' or 'month')
+	splits range index into zset per (UTC) period, i.e. prefix:field:20240101.
+	Partitions are registered in prefix:field:_parts zset (period start ->
+	label), so range queries touch overlapping partitions only and whole
+	partitions are dropped for retention (see drop()). """
+
+	PARTITIONS = ('day', 'week', 'month')
+
+	def __init__ (self, partition=None, **kw):
+		super(DateTime, self).__init__(**kw)
+		assert partition is None or partition in self.PARTITIONS
+		assert partition is None or not self.unique
+		self.partition = partition
+
+	def to_db (self, val):
+		if not isinstance(val, datetime):
+			return int(val)
+
+		if val.tzinfo is None:
+			return int(mktime(val.timetuple()))
+
+		return timegm(val.utctimetuple())
+
+	def from_db (self, val):
+		return datetime.fromtimestamp(int(val))
+
+	def period (self, ts):
+		""" Return (start, end) timestamps of partition containing *ts*. """
+
+		ts = int(ts)
+
+		if self.partition == 'day':
+			start = ts - ts % 86400
+			return start, start + 86400
+
+		if self.partition == 'week': # Epoch is thursday.
+			start = ts - (ts + 259200) % 604800
+			return start, start + 604800
+
+		t = gmtime(ts)
+		year, month = (t.tm_year + 1, 1) if t.tm_mon == 12 else (t.tm_year, t.tm_mon + 1)
+		return timegm((t.tm_year, t.tm_mon, 1, 0, 0, 0)), timegm((year, month, 1, 0, 0, 0))
+
+	def label (self, start):
+		return strftime('%Y%m%d', gmtime(start))
+
+	def part_key (self, prefix, label):
+		return ':'.join((prefix, self.field, label))
+
+	def parts_key (self, prefix):
+		return ':'.join((prefix, self.field, '_parts'))
+
+	def idx_keys (self, cls, minval='-inf', maxval='+inf'):
+		if not self.partition:
+			return super(DateTime, self).idx_keys(cls, minval, maxval)
+
+		labels = self.labels(cls, minval, maxval, cls.getdb())
+		return [self.part_key(cls.getprefix(), totext(label)) for label in labels]
+
+	def labels (self, cls, minval, maxval, db):
+		""" Return (or queue into pipeline *db*) labels of *cls* partitions
+		which may contain scores within given range. """
+
+		score = scorebound(minval)[0]
+
+		if abs(score) != float('inf'):
+			minval = self.period(score)[0]
+
+		return db.zrangebyscore(self.parts_key(cls.getprefix()), minval, maxval)
+
+	def parts (self):
+		""" Return list of (start datetime, models count) of partitions. """
+
+		assert self.partition
+		prefix = self.owner.getprefix()
+		db = self.owner.getdb()
+		items = db.zrange(self.parts_key(prefix), 0, -1, withscores=True)
+		pipe = db.pipeline(transaction=False)
+
+		for label, start in items:
+			pipe.zcard(self.part_key(prefix, totext(label)))
+
+		return [(self.from_db(start), count) for (label, start), count \
+			in zip(items, pipe.execute())]
+
+	def drop (self, before):
+		""" Drop index partitions which periods end before given datetime
+		(or timestamp). Models themselves are not deleted (use ttl). Return
+		number of dropped partitions. """
+
+		assert self.partition
+		before = self.to_db(before)
+		prefix = self.owner.getprefix()
+		db = self.owner.getdb()
+
+		items = db.zrangebyscore(self.parts_key(prefix), '-inf', before, withscores=True)
+		labels = [totext(l) for l, start in items if self.period(start)[1] <= before]
+
+		if len(labels):
+			pipe = db.pipeline(transaction=True)
+			pipe.delete(*[self.part_key(prefix, label) for label in labels])
+			pipe.zrem(self.parts_key(prefix), *labels)
+			pipe.execute()
+
+		return len(labels)
+
+	def save_idx (self, model, pipe=None):
+		if not self.partition:
+			return super(DateTime, self).save_idx(model, pipe)
+
+		prefix = model.getprefix()
+		prev_val = self.prev_idx_val(model)
+		val = model[self.field]
+
+		if prev_val is not None:
+			self.unindex(prefix, model._id, prev_val, pipe)
+
+		if val is not None:
+			score = self.to_db(val)
+			start = self.period(score)[0]
+			label = self.label(start)
+
+			pipe.zadd(self.parts_key(prefix), **{label: start})
+			pipe.zadd(self.part_key(prefix, label), **{model._id: score})
+
+	def del_idx (self, model, pipe=None):
+		self.unindex(model.getprefix(), model._id, self.prev_idx_val(model), pipe)
+
+	def unindex (self, prefix, model_id, val, pipe):
+		if not self.partition:
+			return super(DateTime, self).unindex(prefix, model_id, val, pipe)
+
+		if val is not None:
+			label = self.label(self.period(self.to_db(val))[0])
+			pipe.zrem(self.part_key(prefix, label), model_id)
+
+
+class MD5Pass (String):
+	def __set__ (self, model, value):
+		super(MD5Pass, self).__set__(model, value)
+
+		if value is not None:
+			val = model[self.field]
+
+			if PY3K:
+				val = val.encode('utf-8')
+
+			model[self.field] = md5(val).hexdigest()
+
+
+class GeoPoint (Field):
+	""" Geographic point field. Accepts and returns (longitude, latitude)
+	tuples. Index is a redis GEO key per field (redis 6.2+ for near()). """
+
+	def idx_key (self, prefix):
+		return ':'.join((prefix, self.field))
+
+	def __set__ (self, model, value):
+		if value is not None:
+			lon, lat = value if isinstance(value, (tuple, list)) else self.from_db(value)
+			lon, lat = float(lon), float(lat)
+
+			if not -180 <= lon <= 180 or not -85.05112878 <= lat <= 85.05112878:
+				raise Exception('Coordinates check failed')
+
+			value = '%r,%r' % (lon, lat)
+
+		model[self.field] = value
+
+	def from_db (self, val):
+		lon, lat = val.split(',')
+		return float(lon), float(lat)
+
+	def near (self, lon, lat, radius, unit='m', count=None, sort='asc',
+			ids=False, load=False, withdist=False):
+		""" Return models (or *ids*) within *radius* (m, km, mi or ft) of
+		point sorted by distance (GEOSEARCH). Optionally *load* found
+		models in one pipelined batch or return (model, distance) pairs
+		if *withdist* is set. """
+
+		assert self.index
+		assert sort in ('asc', 'desc')
+
+		args = ['GEOSEARCH', self.idx_key(self.owner.getprefix()),
+			'FROMLONLAT', lon, lat, 'BYRADIUS', radius, unit, sort.upper()]
+
+		if count is not None:
+			args += ['COUNT', count]
+
+		if withdist:
+			args.append('WITHDIST')
+
+		reply = self.owner.getdb().execute_command(*args)
+		found = [item[0] for item in reply] if withdist else reply
+		found = [totext(i) for i in found]
+
+		if ids:
+			result = found
+
+		else:
+			result = [self.owner(model_id) for model_id in found]
+
+			if load:
+				hydrate(result)
+
+		if withdist:
+			return list(zip(result, [float(item[1]) for item in reply]))
+
+		return result
+
+	def save_idx (self, model, pipe=None):
+		val = model[self.field]
+
+		if val is None:
+			self.del_idx(model, pipe)
+
+		else:
+			lon, lat = self.from_db(val)
+			pipe.execute_command('GEOADD', self.idx_key(model.getprefix()),
+				lon, lat, model._id)
+
+	def del_idx (self, model, pipe=None):
+		self.unindex(model.getprefix(), model._id, None, pipe)
+
+	def unindex (self, prefix, model_id, val, pipe):
+		""" Remove model id from index. """
+		pipe.zrem(self.idx_key(prefix), model_id)
+
+
+class Reference (IndexField):
+	def __init__ (self, cls, **kw):
+		super(Reference, self).__init__(**kw)
+		assert issubclass(cls, Model)
+		self._cls = cls
+
+	def find (self, val, children=False):
+		if isinstance(val, Model):
+			val = val._id
+
+		return super(Reference, self).find(val, children=children)
+
+	def choice (self, val):
+		if isinstance(val, Model):
+			val = val._id
+
+		return super(Reference, self).choice(val)
+
+	def to_db (self, val):
+		return val._id if isinstance(val, Model) else val
+
+	def from_db (self, val):
+		return self._cls(val)
+
+
+class Collection (object):
+	""" Base class of collection descriptors. Collection is stored in its
+	own redis key model_key:field, so it is read by pages and changed by
+	single commands without loading (or saving) model. Values are
+	returned as text or as instances of optional reference *cls*. Write
+	methods accept parent *pipe* (current batch is used by default) and
+	return None if command is queued. """
+
+	def __init__ (self, field, cls=None):
+		self.field = field
+		self._cls = cls
+		self.owner = None
+
+	def __get__ (self, model, owner):
+		self.owner = owner
+
+		if model is None:
+			return self
+
+		return BoundCollection(self, model)
+
+	def __set__ (self, model, value):
+		raise Exception('Collections are changed by their methods only')
+
+	def key (self, model):
+		return ':'.join((model.getkey(), self.field))
+
+	def to_db (self, val):
+		return val._id if isinstance(val, Model) else val
+
+	def from_db (self, val):
+		val = totext(val)
+		return val if self._cls is None else self._cls(val)
+
+	def read (self, model, command, *args, **kw):
+		""" Return reply of read *command* on collection key. """
+		return getattr(model.getdb(), command)(self.key(model), *args, **kw)
+
+	def write (self, model, pipe, command, *args, **kw):
+		""" Run write *command* on collection key or queue it into parent
+		*pipe* (or pipe of current batch). Collections of expiring models
+		(see conf ttl) get model ttl along with each write. """
+
+		if pipe is None and BATCH.get() is not None:
+			pipe = BATCH.get().pipe(model)
+
+		ttl = model.getttl()
+
+		if ttl is None or command == 'delete':
+			db = model.getdb() if pipe is None else pipe
+			reply = getattr(db, command)(self.key(model), *args, **kw)
+			return None if pipe is not None else reply
+
+		_pipe = model.getpipe(pipe)
+		getattr(_pipe, command)(self.key(model), *args, **kw)
+		_pipe.expire(self.key(model), int(ttl))
+
+		return None if pipe is not None else _pipe.execute()[0]
+
+	def clear (self, model, pipe=None):
+		""" Delete collection. """
+		return self.write(model, pipe, 'delete')
+
+
+class BoundCollection (object):
+	""" Collection of given model. Collection methods are called with
+	model as first argument, i.e. post.tags.add('redis'). """
+
+	def __init__ (self, field, model):
+		self.field = field
+		self.model = model
+
+	def __getattr__ (self, name):
+		method = getattr(self.field, name)
+		return lambda *args, **kw: method(self.model, *args, **kw)
+
+	def __len__ (self):
+		return self.field.len(self.model)
+
+	def __iter__ (self):
+		return self.field.iter(self.model)
+
+	def __contains__ (self, val):
+		return self.field.contains(self.model, val)
+
+
+class ListField (Collection):
+	""" Redis list collection. """
+
+	def append (self, model, *vals, **kw):
+		""" Append values to the end of list (RPUSH). """
+		return self.write(model, kw.get('pipe'), 'rpush', *[self.to_db(v) for v in vals])
+
+	def prepend (self, model, *vals, **kw):
+		""" Prepend values to the beginning of list (LPUSH). """
+		return self.write(model, kw.get('pipe'), 'lpush', *[self.to_db(v) for v in vals])
+
+	def remove (self, model, val, count=0, pipe=None):
+		""" Remove *count* (all by default) occurrences of value (LREM). """
+		return self.write(model, pipe, 'lrem', count, self.to_db(val))
+
+	def pop (self, model, left=False):
+		""" Remove and return last (or first) value. Value is popped
+		right now even if batch is active. """
+
+		val = self.read(model, 'lpop' if left else 'rpop')
+		return None if val is None else self.from_db(val)
+
+	def page (self, model, start=0, num=None):
+		""" Return *num* values starting from *start* index (LRANGE). """
+
+		end = -1 if num is None else start + num - 1
+		return [self.from_db(v) for v in self.read(model, 'lrange', start, end)]
+
+	def len (self, model):
+		return self.read(model, 'llen')
+
+	def iter (self, model, chunk=100):
+		""" Iterate over values reading list by *chunk* values. """
+
+		start = 0
+
+		while True:
+			vals = self.page(model, start, chunk)
+
+			for val in vals:
+				yield val
+
+			if len(vals) < chunk:
+				return
+
+			start += chunk
+
+	def contains (self, model, val):
+		val = totext(tobytes(self.to_db(val)))
+		return any(totext(tobytes(self.to_db(v))) == val for v in self.iter(model))
+
+
+class SetField (Collection):
+	""" Redis set collection. """
+
+	def add (self, model, *vals, **kw):
+		""" Add values to set (SADD). """
+		return self.write(model, kw.get('pipe'), 'sadd', *[self.to_db(v) for v in vals])
+
+	def remove (self, model, *vals, **kw):
+		""" Remove values from set (SREM). """
+		return self.write(model, kw.get('pipe'), 'srem', *[self.to_db(v) for v in vals])
+
+	def contains (self, model, val):
+		return bool(self.read(model, 'sismember', self.to_db(val)))
+
+	def members (self, model):
+		""" Return all values of set (SMEMBERS). """
+		return [self.from_db(v) for v in self.read(model, 'smembers')]
+
+	def page (self, model, cursor=0, count=100):
+		""" Return (cursor, values) page of set (SSCAN). Iteration is over
+		when returned cursor is 0. """
+
+		cursor, vals = self.read(model, 'sscan', cursor, count=count)
+		return int(cursor), [self.from_db(v) for v in vals]
+
+	def len (self, model):
+		return self.read(model, 'scard')
+
+	def iter (self, model, chunk=100):
+		""" Iterate over values reading set by SSCAN pages. """
+
+		cursor = None
+
+		while cursor != 0:
+			cursor, vals = self.page(model, cursor or 0, chunk)
+
+			for val in vals:
+				yield val
+
+
+class SortedSetField (Collection):
+	""" Redis sorted set collection. """
+
+	def add (self, model, val, score, pipe=None):
+		""" Add value with given score or update score of value (ZADD). """
+		return self.write(model, pipe, 'zadd', **{totext(tobytes(self.to_db(val))): score})
+
+	def incr (self, model, val, n=1, pipe=None):
+		""" Increment score of value (ZINCRBY). """
+		return self.write(model, pipe, 'zincrby', self.to_db(val), n)
+
+	def remove (self, model, *vals, **kw):
+		""" Remove values from sorted set (ZREM). """
+		return self.write(model, kw.get('pipe'), 'zrem', *[self.to_db(v) for v in vals])
+
+	def contains (self, model, val):
+		return self.score(model, val) is not None
+
+	def score (self, model, val):
+		return self.read(model, 'zscore', self.to_db(val))
+
+	def page (self, model, start=0, num=None, desc=False, withscores=False):
+		""" Return *num* values (or (value, score) pairs) starting from
+		*start* rank (ZRANGE). """
+
+		end = -1 if num is None else start + num - 1
+		reply = self.read(model, 'zrange', start, end, desc=desc, withscores=withscores)
+
+		if withscores:
+			return [(self.from_db(v), s) for v, s in reply]
+
+		return [self.from_db(v) for v in reply]
+
+	def range (self, model, minval='-inf', maxval='+inf', start=None, num=None,
+			withscores=False):
+		""" Return values (or (value, score) pairs) within scores range
+		(ZRANGEBYSCORE). """
+
+		if num is not None and start is None:
+			start = 0
+
+		reply = self.read(model, 'zrangebyscore', minval, maxval, start=start,
+			num=num, withscores=withscores)
+
+		if withscores:
+			return [(self.from_db(v), s) for v, s in reply]
+
+		return [self.from_db(v) for v in reply]
+
+	def len (self, model):
+		return self.read(model, 'zcard')
+
+	def iter (self, model, chunk=100):
+		""" Iterate over values in scores order reading by *chunk* values. """
+
+		start = 0
+
+		while True:
+			vals = self.page(model, start, chunk)
+
+			for val in vals:
+				yield val
+
+			if len(vals) < chunk:
+				return
+
+			start += chunk
+
+
+class HashStorage (object):
+	""" Default storage. Each model is a redis hash with model key.
+	Storage methods return *db* command result, so they work with both
+	connections and pipelines. """
+
+	whole = False # Save requires loaded model data.
+	keytype = b'hash'
+
+	def key (self, cls, model_id):
+		return ':'.join((cls.getprefix(), model_id))
+
+	def scan (self, cls, db, count=1000, cursor=0):
+		""" Iterate over (scan cursor, [(model id, raw data)]) batches of
+		all stored models starting from given SCAN *cursor*. """
+
+		prefix = cls.getprefix()
+
+		while True:
+			cursor, keys = db.scan(cursor, match=prefix + ':*', count=count)
+			keys = [totext(k) for k in keys]
+			ids = [k[len(prefix) + 1:] for k in keys]
+			ids = [i for i in ids if memstat_group(cls, i) == 'hash']
+			pipe = db.pipeline(transaction=False)
+
+			for model_id in ids:
+				pipe.type(self.key(cls, model_id))
+				self.load(cls, model_id, pipe)
+
+			replies = pipe.execute(raise_on_error=False)
+			batch = []
+
+			for model_id, keytype, reply in zip(ids, replies[::2], replies[1::2]):
+				if keytype == self.keytype:
+					batch.append((model_id, self.decode(reply)))
+
+			yield cursor, batch
+
+			if not cursor:
+				return
+
+	def exists (self, cls, model_id, db):
+		return db.exists(self.key(cls, model_id))
+
+	def load (self, cls, model_id, db):
+		return db.hgetall(self.key(cls, model_id))
+
+	def decode (self, reply):
+		""" Return raw data dict of load() reply. Keys are decoded at once
+		but values are decoded on first access (see LazyData). """
+
+		data = LazyData()
+
+		for k, v in reply.items():
+			dict.__setitem__(data, k.decode('utf-8') if type(k) is bytes else k, v)
+
+		return data
+
+	def get (self, cls, model_id, name, db):
+		return db.hget(self.key(cls, model_id), name)
+
+	def decode_get (self, reply, name):
+		""" Return raw value of get() reply. """
+		return totext(reply)
+
+	def save (self, model, db, delkeys):
+		""" Save model diff (without None values) and delete *delkeys*. """
+
+		if model._exists is not False and len(delkeys):
+			db.hdel(model.getkey(), *delkeys)
+
+		if len(model._diff):
+			db.hmset(model.getkey(), model._diff)
+
+	def delete (self, cls, model_id, db):
+		return db.delete(self.key(cls, model_id))
+
+	def expire (self, cls, model_id, db, ttl):
+		return db.expire(self.key(cls, model_id), ttl)
+
+
+class BucketStorage (HashStorage):
+	""" Memory-efficient storage for large amounts of small models with
+	integer ids. Models are packed into bucket hashes *prefix:_b:N* of
+	*size* models (N is id // size) as compact JSON values, so buckets
+	may use listpack (ziplist) encoding. Keep *size* and encoded models
+	below hash-max-listpack-entries and hash-max-listpack-value. Changes
+	are merged into stored record by Lua script, so concurrent saves of
+	other fields (or other models of bucket) are kept. """
+
+	whole = True
+
+	SCRIPT = """
+local data = redis.call('HGET', KEYS[1], ARGV[1])
+data = data and cjson.decode(data) or {}
+
+for name, value in pairs(cjson.decode(ARGV[2])) do
+	data[name] = value
+end
+
+for i = 3, #ARGV do
+	data[ARGV[i]] = nil
+end
+
+if next(data) == nil then
+	redis.call('HDEL', KEYS[1], ARGV[1])
+
+else
+	redis.call('HSET', KEYS[1], ARGV[1], cjson.encode(data))
+end
+
+return 1
+"""
+
+	def __init__ (self, size=100):
+		assert size > 0
+		self.size = size
+
+	def bucket (self, cls, model_id):
+		""" Return (bucket key, hash field) pair of model. """
+
+		try:
+			num = int(model_id)
+
+		except ValueError:
+			num = -1
+
+		if num < 0:
+			raise Exception('Bucket storage requires non-negative integer ids')
+
+		return ':'.join((cls.getprefix(), '_b', str(num // self.size))), str(num)
+
+	def key (self, cls, model_id):
+		return self.bucket(cls, model_id)[0]
+
+	def scan (self, cls, db, count=1000, cursor=0):
+		match = ':'.join((cls.getprefix(), '_b', '*'))
+
+		while True:
+			cursor, keys = db.scan(cursor, match=match, count=count)
+			pipe = db.pipeline(transaction=False)
+
+			for key in keys:
+				pipe.hgetall(key)
+
+			batch = []
+
+			for bucket in pipe.execute():
+				for model_id, reply in bucket.items():
+					model_id = totext(model_id)
+					batch.append((model_id, self.decode(reply)))
+
+			yield cursor, batch
+
+			if not cursor:
+				return
+
+	def exists (self, cls, model_id, db):
+		return db.hexists(*self.bucket(cls, model_id))
+
+	def load (self, cls, model_id, db):
+		return db.hget(*self.bucket(cls, model_id))
+
+	def decode (self, reply):
+		return dict() if reply is None else json.loads(totext(reply))
+
+	def get (self, cls, model_id, name, db):
+		return self.load(cls, model_id, db)
+
+	def decode_get (self, reply, name):
+		return self.decode(reply).get(name)
+
+	def save (self, model, db, delkeys):
+		key, name = self.bucket(model.__class__, model._id)
+		diff = dict((k, str(v) if PY3K else unicode(v)) for k, v in model._diff.items())
+		evalscript(db, self.SCRIPT, [key], [name, json.dumps(diff,
+			separators=(',', ':'))] + list(delkeys), self.emulate)
+
+	def emulate (self, db, keys, args):
+		""" Python version of merge script (see evalscript()). """
+
+		data = db.hget(keys[0], args[0])
+		data = dict() if data is None else json.loads(totext(data))
+		data.update(json.loads(args[1]))
+
+		for name in args[2:]:
+			data.pop(name, None)
+
+		if not len(data):
+			db.hdel(keys[0], args[0])
+
+		else:
+			db.hset(keys[0], args[0], json.dumps(data, separators=(',', ':')))
+
+		return 1
+
+	def delete (self, cls, model_id, db):
+		return db.hdel(*self.bucket(cls, model_id))
+
+	def expire (self, cls, model_id, db, ttl):
+		raise Exception('Bucket storage does not support ttl')
+
+
+class StructCodec (object):
+	""" Compact typed binary codec of raw model data. Each item is encoded
+	as length-prefixed key followed by type tag and value: int64 ('i'),
+	double ('d') or length-prefixed utf-8 text ('s'). """
+
+	U8 = Struct('<B')
+	U32 = Struct('<I')
+	I64 = Struct('<q')
+	F64 = Struct('<d')
+
+	# Lua split(blob) returns list of {packed key, packed item} pairs and
+	# join(items) packs them back (see BlobStorage).
+	LUA = """
+local function split (blob)
+	local items, pos = {}, 1
+
+	while pos <= #blob do
+		local start = pos
+		pos = pos + 1 + string.byte(blob, pos)
+		local key = string.sub(blob, start, pos - 1)
+
+		if string.sub(blob, pos, pos) == 's' then
+			pos = pos + 5 + struct.unpack('<I4', blob, pos + 1)
+
+		else
+			pos = pos + 9
+		end
+
+		table.insert(items, {key, string.sub(blob, start, pos - 1)})
+	end
+
+	return items
+end
+
+local function join (items)
+	local chunks = {}
+
+	for _, item in ipairs(items) do
+		table.insert(chunks, item[2])
+	end
+
+	return table.concat(chunks)
+end
+"""
+
+	def packkey (self, name):
+		""" Return packed key as it is packed by pack(). """
+
+		name = name.encode('utf-8')
+		return self.U8.pack(len(name)) + name
+
+	def pack (self, data):
+		chunks = []
+
+		for k, v in data.items():
+			k = k.encode('utf-8')
+			chunks.append(self.U8.pack(len(k)))
+			chunks.append(k)
+
+			if type(v) in (int, bool) and -1 << 63 <= v < 1 << 63:
+				chunks.append(b'i')
+				chunks.append(self.I64.pack(v))
+
+			elif type(v) is float:
+				chunks.append(b'd')
+				chunks.append(self.F64.pack(v))
+
+			else:
+				v = (str(v) if PY3K else unicode(v)).encode('utf-8')
+				chunks.append(b's')
+				chunks.append(self.U32.pack(len(v)))
+				chunks.append(v)
+
+		return b''.join(chunks)
+
+	def unpack (self, blob):
+		""" Decode blob without copying (memoryview slices). """
+
+		view = memoryview(blob)
+		data = dict()
+		pos = 0
+
+		while pos < len(view):
+			size = self.U8.unpack_from(blob, pos)[0]
+			k = utf_8_decode(view[pos + 1:pos + 1 + size])[0]
+			pos += 1 + size
+			tag = blob[pos:pos + 1]
+
+			if tag == b'i':
+				data[k] = self.I64.unpack_from(blob, pos + 1)[0]
+				pos += 9
+
+			elif tag == b'd':
+				data[k] = self.F64.unpack_from(blob, pos + 1)[0]
+				pos += 9
+
+			else:
+				size = self.U32.unpack_from(blob, pos + 1)[0]
+				data[k] = utf_8_decode(view[pos + 5:pos + 5 + size])[0]
+				pos += 5 + size
+
+		return data
+
+
+class MsgpackCodec (object):
+	""" Msgpack codec of raw model data (requires msgpack package). """
+
+	# Items are split by msgpack type bytes, so values are never decoded
+	# by Lua (its numbers are doubles).
+	LUA = """
+local SIZES = {[0xca] = 5, [0xcb] = 9, [0xcc] = 2, [0xcd] = 3, [0xce] = 5,
+	[0xcf] = 9, [0xd0] = 2, [0xd1] = 3, [0xd2] = 5, [0xd3] = 9}
+
+local function skip (blob, pos)
+	local b = string.byte(blob, pos)
+
+	if b <= 0x7f or b >= 0xe0 or b == 0xc0 or b == 0xc2 or b == 0xc3 then
+		return pos + 1
+
+	elseif b >= 0xa0 and b <= 0xbf then
+		return pos + 1 + b - 0xa0
+
+	elseif b == 0xd9 or b == 0xc4 then
+		return pos + 2 + string.byte(blob, pos + 1)
+
+	elseif b == 0xda or b == 0xc5 then
+		return pos + 3 + struct.unpack('>I2', blob, pos + 1)
+
+	elseif b == 0xdb or b == 0xc6 then
+		return pos + 5 + struct.unpack('>I4', blob, pos + 1)
+	end
+
+	return pos + SIZES[b]
+end
+
+local function split (blob)
+	local items, b = {}, string.byte(blob, 1)
+	local count, pos
+
+	if b >= 0x80 and b <= 0x8f then
+		count, pos = b - 0x80, 2
+
+	elseif b == 0xde then
+		count, pos = struct.unpack('>I2', blob, 2), 4
+
+	else
+		count, pos = struct.unpack('>I4', blob, 2), 6
+	end
+
+	for i = 1, count do
+		local start = pos
+		local value = skip(blob, pos)
+		pos = skip(blob, value)
+		table.insert(items, {string.sub(blob, start, value - 1),
+			string.sub(blob, start, pos - 1)})
+	end
+
+	return items
+end
+
+local function join (items)
+	local n = #items
+	local chunks = {}
+
+	if n < 16 then
+		chunks[1] = string.char(0x80 + n)
+
+	elseif n < 65536 then
+		chunks[1] = struct.pack('>BI2', 0xde, n)
+
+	else
+		chunks[1] = struct.pack('>BI4', 0xdf, n)
+	end
+
+	for _, item in ipairs(items) do
+		table.insert(chunks, item[2])
+	end
+
+	return table.concat(chunks)
+end
+"""
+
+	def __init__ (self):
+		assert msgpack is not None, 'msgpack is not installed'
+
+	def pack (self, data):
+		return msgpack.packb(data, use_bin_type=True)
+
+	def packkey (self, name):
+		return msgpack.packb(name, use_bin_type=True)
+
+	def unpack (self, blob):
+		return msgpack.unpackb(blob, raw=False)
+
+
+class BlobStorage (HashStorage):
+	""" Storage which keeps each model as single packed string (GET/SET)
+	at model key. Typed values (i.e. Integer, DateTime or Bool fields)
+	are stored and loaded as is, so they are not parsed from text. Uses
+	StructCodec unless *codec* is given. Changes are merged into stored
+	blob by Lua script using codec LUA split() and join() functions (and
+	packkey() of deleted keys). Requires redis 6.0+ (KEEPTTL). """
+
+	whole = True
+	keytype = b'string'
+
+	SCRIPT = """
+local blob = redis.call('GET', KEYS[1])
+local items, index, merged, dropped = {}, {}, {}, {}
+
+local function put (item)
+	if index[item[1]] then
+		items[index[item[1]]] = item
+
+	else
+		table.insert(items, item)
+		index[item[1]] = #items
+	end
+end
+
+for _, item in ipairs(blob and split(blob) or {}) do
+	put(item)
+end
+
+for _, item in ipairs(split(ARGV[1])) do
+	put(item)
+end
+
+for i = 2, #ARGV do
+	dropped[ARGV[i]] = true
+end
+
+for _, item in ipairs(items) do
+	if not dropped[item[1]] then
+		table.insert(merged, item)
+	end
+end
+
+if #merged == 0 then
+	redis.call('DEL', KEYS[1])
+
+else
+	redis.call('SET', KEYS[1], join(merged), 'KEEPTTL')
+end
+
+return 1
+"""
+
+	def __init__ (self, codec=None):
+		self.codec = StructCodec() if codec is None else codec
+
+	def load (self, cls, model_id, db):
+		return db.get(self.key(cls, model_id))
+
+	def decode (self, reply):
+		return dict() if reply is None else self.codec.unpack(reply)
+
+	def get (self, cls, model_id, name, db):
+		return self.load(cls, model_id, db)
+
+	def decode_get (self, reply, name):
+		return self.decode(reply).get(name)
+
+	def save (self, model, db, delkeys):
+		diff, delkeys = model._diff.copy(), list(delkeys)
+		args = [self.codec.pack(diff)] + [self.codec.packkey(k) for k in delkeys]
+
+		evalscript(db, self.codec.LUA + self.SCRIPT, [model.getkey()], args,
+			lambda engine, keys, args: self.emulate(engine, keys[0], diff, delkeys))
+
+	def emulate (self, db, key, diff, delkeys):
+		""" Python version of merge script (see evalscript()). """
+
+		data = self.decode(db.get(key))
+		data.update(diff)
+
+		for name in delkeys:
+			data.pop(name, None)
+
+		if not len(data):
+			db.delete(key)
+
+		else:
+			db.execute_command('SET', key, self.codec.pack(data), 'KEEPTTL')
+
+		return 1
+
+
+def tobytes (val):
+	""" Encode command argument the same way as redis-py does. """
+
+	if type(val) is bytes:
+		return val
+
+	if type(val) is float:
+		val = repr(val)
+
+	elif type(val) is not type(u''):
+		val = str(val)
+
+	return val.encode('utf-8')
+
+
+def scorebound (val):
+	""" Return (score, exclusive) of ZRANGEBYSCORE-like *val* bound. """
+
+	val = totext(val) if type(val) is bytes else val
+
+	if isinstance(val, str if PY3K else basestring) and val.startswith('('):
+		return float(val[1:]), True
+
+	return float(val), False
+
+
+class MemorySortedSet (object):
+	""" Sorted set of in-process engine: member -> score dict along with
+	sorted list of (score, member) pairs. """
+
+	def __init__ (self):
+		self.scores = dict()
+		self.items = []
+
+	def __len__ (self):
+		return len(self.items)
+
+	def add (self, member, score):
+		""" Add or update member. Return True if member is new. """
+
+		old = self.scores.get(member)
+
+		if old is not None:
+			if old == score:
+				return False
+
+			self.items.pop(bisect_left(self.items, (old, member)))
+
+		self.scores[member] = score
+		insort(self.items, (score, member))
+		return old is None
+
+	def remove (self, member):
+		""" Remove member. Return True if member existed. """
+
+		score = self.scores.pop(member, None)
+
+		if score is None:
+			return False
+
+		self.items.pop(bisect_left(self.items, (score, member)))
+		return True
+
+	def range (self, minval, maxval):
+		""" Return (score, member) pairs with scores between bounds. """
+
+		minval, minexcl = scorebound(minval)
+		maxval, maxexcl = scorebound(maxval)
+		n = bisect_left(self.items, (minval,))
+		items = []
+
+		while n < len(self.items):
+			score, member = self.items[n]
+			n += 1
+
+			if minexcl and score == minval:
+				continue
+
+			if score > maxval or (maxexcl and score == maxval):
+				break
+
+			items.append((score, member))
+
+		return items
+
+
+class MemoryPipeline (object):
+	""" Pipeline of in-process engine. Commands are queued and executed
+	atomically by execute(). Commands called after watch() (and before
+	multi()) are executed immediately like redis-py does. """
+
+	def __init__ (self, db, transaction=True):
+		self.db = db
+		self.transaction = transaction
+		self.commands = []
+		self.watching = None
+		self.explicit = False
+
+	def __len__ (self):
+		return len(self.commands)
+
+	def __enter__ (self):
+		return self
+
+	def __exit__ (self, exc_type, exc_value, traceback):
+		self.reset()
+
+	def __getattr__ (self, name):
+		method = getattr(self.db, name)
+
+		def command (*args, **kwargs):
+			if self.watching is not None and not self.explicit:
+				return method(*args, **kwargs)
+
+			self.commands.append((method, args, kwargs))
+			return self
+
+		return command
+
+	def watch (self, *names):
+		self.watching = self.watching or dict()
+
+		for name in names:
+			name = tobytes(name)
+			self.watching[name] = self.db._versions.get(name, 0)
+
+	def unwatch (self):
+		self.watching = None
+
+	def multi (self):
+		self.explicit = True
+
+	def reset (self):
+		self.commands = []
+		self.watching = None
+		self.explicit = False
+
+	def execute (self, raise_on_error=True):
+		with self.db._lock:
+			for name, version in (self.watching or dict()).items():
+				if self.db._versions.get(name, 0) != version:
+					self.reset()
+					raise WatchError('Watched variable changed.')
+
+			replies = []
+
+			for method, args, kwargs in self.commands:
+				try:
+					replies.append(method(*args, **kwargs))
+
+				except ResponseError as e:
+					replies.append(e)
+
+		self.reset()
+
+		if raise_on_error:
+			for reply in replies:
+				if isinstance(reply, ResponseError):
+					raise reply
+
+		return replies
+
+
+class MemoryRedis (object):
+	""" In-process engine implementing (StrictRedis compatible) subset of
+	commands used by redisca: keys, strings and bitmaps, hashes, sets,
+	lists, sorted sets, SORT and pipelines with WATCH. Every command runs
+	under engine lock, so it is atomic across threads. Lua scripts (except
+	emulated ones, see evalscript()), geo and streams are not supported.
+	Use it for tests or to measure ORM
+	overhead without network cost: conf(db=MemoryRedis()). """
+
+	TYPES = {
+		bytes: b'string',
+		list: b'list',
+		dict: b'hash',
+		set: b'set',
+		MemorySortedSet: b'zset',
+	}
+
+	def __init__ (self):
+		self._keys = dict()
+		self._expires = dict()
+		self._versions = dict()
+		self._lock = RLock()
+
+	def _get (self, name, kind=None, write=False):
+		""" Return value of key *name* (created if *write* and *kind*
+		given) checking its type and expiration. """
+
+		name = tobytes(name)
+		deadline = self._expires.get(name)
+
+		if deadline is not None and deadline <= time():
+			self._delete(name)
+
+		val = self._keys.get(name)
+
+		if val is None:
+			if write and kind is not None:
+				val = self._keys[name] = kind()
+
+		elif kind is not None and type(val) is not kind:
+			raise ResponseError('WRONGTYPE Operation against a key holding the wrong kind of value')
+
+		if write:
+			self._versions[name] = self._versions.get(name, 0) + 1
+
+		return val
+
+	def _delete (self, name):
+		self._expires.pop(name, None)
+		self._versions[name] = self._versions.get(name, 0) + 1
+		return self._keys.pop(name, None) is not None
+
+	def _clean (self, name):
+		""" Delete key *name* if its value is empty. """
+
+		name = tobytes(name)
+
+		if not len(self._keys.get(name, b'-')):
+			self._delete(name)
+
+	def pipeline (self, transaction=True, shard_hint=None):
+		return MemoryPipeline(self, transaction)
+
+	def register_script (self, script):
+		raise Exception('Lua scripts are not supported by memory backend')
+
+	def emulate (self, func, keys, args):
+		""" Run python emulation of Lua script (see evalscript()). """
+		return func(self, keys, args)
+
+	def execute_command (self, *args):
+		command = totext(tobytes(args[0])).upper()
+
+		if command == 'SET':
+			opts = [totext(tobytes(a)).upper() for a in args[3:]]
+			keepttl = 'KEEPTTL' in opts
+			return self.set(args[1], args[2], keepttl=keepttl)
+
+		raise ResponseError("unknown command '%s'" % command)
+
+	def ping (self):
+		return True
+
+	def flushdb (self):
+		with self._lock:
+			for name in list(self._keys):
+				self._delete(name)
+
+		return True
+
+	# Keys.
+
+	def delete (self, *names):
+		return sum(self._delete(tobytes(n)) for n in names if self._get(n) is not None)
+
+	def exists (self, name):
+		return self._get(name) is not None
+
+	def type (self, name):
+		val = self._get(name)
+		return b'none' if val is None else self.TYPES[type(val)]
+
+	def expire (self, name, time_):
+		if self._get(name) is None:
+			return False
+
+		self._expires[tobytes(name)] = time() + int(time_)
+		return True
+
+	def ttl (self, name):
+		if self._get(name) is None:
+			return -2
+
+		deadline = self._expires.get(tobytes(name))
+		return -1 if deadline is None else int(round(deadline - time()))
+
+	def keys (self, pattern='*'):
+		pattern = totext(tobytes(pattern))
+
+		return [n for n in list(self._keys) if self._get(n) is not None and \
+			fnmatchcase(totext(n), pattern)]
+
+	def scan (self, cursor=0, match=None, count=None):
+		""" Return (cursor, keys) iterating over keys in sorted order,
+		so keys existing during whole iteration are returned once. """
+
+		names = sorted(self._keys)
+		cursor = int(cursor)
+		batch = names[cursor:cursor + (count or 10)]
+		cursor = 0 if cursor + len(batch) >= len(names) else cursor + len(batch)
+		pattern = match and totext(tobytes(match))
+
+		return cursor, [n for n in batch if self._get(n) is not None and \
+			(pattern is None or fnmatchcase(totext(n), pattern))]
+
+	def scan_iter (self, match=None, count=None):
+		cursor = None
+
+		while cursor != 0:
+			cursor, names = self.scan(cursor or 0, match=match, count=count)
+
+			for name in names:
+				yield name
+
+	# Strings and bitmaps.
+
+	def get (self, name):
+		return self._get(name, bytes)
+
+	def set (self, name, value, ex=None, keepttl=False):
+		name = tobytes(name)
+		self._get(name)
+
+		if not keepttl:
+			self._expires.pop(name, None)
+
+		self._keys[name] = tobytes(value)
+		self._versions[name] = self._versions.get(name, 0) + 1
+
+		if ex is not None:
+			self.expire(name, ex)
+
+		return True
+
+	def getrange (self, key, start, end):
+		val = self._get(key, bytes) or b''
+		start, end = self._slice(len(val), start, end)
+		return val[start:end]
+
+	def _slice (self, length, start, end):
+		""" Convert inclusive (possibly negative) redis range to slice. """
+
+		if start < 0:
+			start = max(length + start, 0)
+
+		if end < 0:
+			end = length + end
+
+		return start, max(min(end, length - 1) + 1, start)
+
+	def incrby (self, name, amount=1):
+		val = int(self._get(name, bytes) or 0) + amount
+		self.set(name, val, keepttl=True)
+		return val
+
+	def setbit (self, name, offset, value):
+		data = bytearray(self._get(name, bytes) or b'')
+		byte, bit = offset // 8, 0x80 >> (offset % 8)
+
+		if len(data) <= byte:
+			data.extend(b'\x00' * (byte + 1 - len(data)))
+
+		old = int(bool(data[byte] & bit))
+
+		if value:
+			data[byte] |= bit
+
+		else:
+			data[byte] &= ~bit
+
+		self.set(name, bytes(data), keepttl=True)
+		return old
+
+	def getbit (self, name, offset):
+		data = bytearray(self._get(name, bytes) or b'')
+		byte = offset // 8
+
+		return int(byte < len(data) and bool(data[byte] & (0x80 >> (offset % 8))))
+
+	def bitcount (self, key, start=None, end=None):
+		data = bytearray(self._get(key, bytes) or b'')
+
+		if start is not None:
+			start, end = self._slice(len(data), start, end)
+			data = data[start:end]
+
+		return sum(bin(byte).count('1') for byte in data)
+
+	def bitpos (self, key, bit, start=None, end=None):
+		data = bytearray(self._get(key, bytes) or b'')
+		first, last = self._slice(len(data), start or 0,
+			-1 if end is None else end)
+
+		for n in range(first, last):
+			byte = data[n] if bit else ~data[n] & 0xff
+
+			if byte:
+				for offset in range(8):
+					if byte & (0x80 >> offset):
+						return n * 8 + offset
+
+		return len(data) * 8 if not bit and end is None else -1
+
+	def bitop (self, operation, dest, *keys):
+		datas = [bytearray(self._get(k, bytes) or b'') for k in keys]
+		length = max(len(d) for d in datas)
+		operation = operation.upper()
+
+		for data in datas:
+			data.extend(b'\x00' * (length - len(data)))
+
+		result = datas[0]
+
+		for data in datas[1:]:
+			for n in range(length):
+				if operation == 'AND':
+					result[n] &= data[n]
+
+				elif operation == 'OR':
+					result[n] |= data[n]
+
+				else:
+					result[n] ^= data[n]
+
+		if operation == 'NOT':
+			result = bytearray(~byte & 0xff for byte in result)
+
+		if length:
+			self.set(dest, bytes(result))
+
+		else:
+			self.delete(dest)
+
+		return length
+
+	# Hashes.
+
+	def hget (self, name, key):
+		return (self._get(name, dict) or dict()).get(tobytes(key))
+
+	def hgetall (self, name):
+		return dict(self._get(name, dict) or dict())
+
+	def hmget (self, name, keys, *args):
+		data = self._get(name, dict) or dict()
+		keys = list(keys) + list(args) if isinstance(keys, (list, tuple)) else [keys] + list(args)
+		return [data.get(tobytes(k)) for k in keys]
+
+	def hkeys (self, name):
+		return list(self._get(name, dict) or dict())
+
+	def hlen (self, name):
+		return len(self._get(name, dict) or dict())
+
+	def hexists (self, name, key):
+		return tobytes(key) in (self._get(name, dict) or dict())
+
+	def hset (self, name, key, value):
+		data = self._get(name, dict, True)
+		new = tobytes(key) not in data
+		data[tobytes(key)] = tobytes(value)
+		return int(new)
+
+	def hmset (self, name, mapping):
+		data = self._get(name, dict, True)
+
+		for key, value in mapping.items():
+			data[tobytes(key)] = tobytes(value)
+
+		return True
+
+	def hdel (self, name, *keys):
+		data = self._get(name, dict, True)
+		count = sum(data.pop(tobytes(k), None) is not None for k in keys)
+		self._clean(name)
+		return count
+
+	def hincrby (self, name, key, amount=1):
+		val = int(self.hget(name, key) or 0) + amount
+		self.hset(name, key, val)
+		return val
+
+	def hincrbyfloat (self, name, key, amount=1.0):
+		val = float(self.hget(name, key) or 0) + amount
+		self.hset(name, key, val)
+		return val
+
+	# Sets.
+
+	def sadd (self, name, *values):
+		data = self._get(name, set, True)
+		values = set(tobytes(v) for v in values)
+		count = len(values - data)
+		data.update(values)
+		return count
+
+	def srem (self, name, *values):
+		data = self._get(name, set, True)
+		values = set(tobytes(v) for v in values)
+		count = len(values & data)
+		data.difference_update(values)
+		self._clean(name)
+		return count
+
+	def smembers (self, name):
+		return set(self._get(name, set) or set())
+
+	def scard (self, name):
+		return len(self._get(name, set) or set())
+
+	def sismember (self, name, value):
+		return tobytes(value) in (self._get(name, set) or set())
+
+	def srandmember (self, name, number=None):
+		members = list(self._get(name, set) or set())
+
+		if number is None:
+			return members[randint(0, len(members) - 1)] if members else None
+
+		if number < 0:
+			return [members[randint(0, len(members) - 1)] for n in range(-number)] \
+				if members else []
+
+		return sample(members, min(number, len(members)))
+
+	def sinter (self, keys, *args):
+		keys = list(keys) + list(args) if isinstance(keys, (list, tuple)) else [keys] + list(args)
+		datas = [self._get(k, set) or set() for k in keys]
+		return set.intersection(*datas)
+
+	def sunion (self, keys, *args):
+		keys = list(keys) + list(args) if isinstance(keys, (list, tuple)) else [keys] + list(args)
+		return set().union(*[self._get(k, set) or set() for k in keys])
+
+	def sinterstore (self, dest, keys, *args):
+		return self._store(dest, self.sinter(keys, *args))
+
+	def sunionstore (self, dest, keys, *args):
+		return self._store(dest, self.sunion(keys, *args))
+
+	def _store (self, dest, members):
+		self.delete(dest)
+
+		if members:
+			self._get(dest, set, True).update(members)
+
+		return len(members)
+
+	def sscan (self, name, cursor=0, match=None, count=None):
+		members = sorted(self._get(name, set) or set())
+		cursor = int(cursor)
+		batch = members[cursor:cursor + (count or 10)]
+		cursor = 0 if cursor + len(batch) >= len(members) else cursor + len(batch)
+		return cursor, batch
+
+	# Lists.
+
+	def rpush (self, name, *values):
+		data = self._get(name, list, True)
+		data.extend(tobytes(v) for v in values)
+		return len(data)
+
+	def lpush (self, name, *values):
+		data = self._get(name, list, True)
+		data[:0] = [tobytes(v) for v in reversed(values)]
+		return len(data)
+
+	def lpop (self, name):
+		data = self._get(name, list, True)
+		val = data.pop(0) if data else None
+		self._clean(name)
+		return val
+
+	def rpop (self, name):
+		data = self._get(name, list, True)
+		val = data.pop() if data else None
+		self._clean(name)
+		return val
+
+	def lrem (self, name, count, value):
+		data = self._get(name, list, True)
+		value = tobytes(value)
+		indexes = [n for n, v in enumerate(data) if v == value]
+
+		if count < 0:
+			indexes = indexes[::-1][:-count]
+
+		elif count > 0:
+			indexes = indexes[:count]
+
+		for n in sorted(indexes, reverse=True):
+			del data[n]
+
+		self._clean(name)
+		return len(indexes)
+
+	def lrange (self, name, start, end):
+		data = self._get(name, list) or []
+		start, end = self._slice(len(data), start, end)
+		return data[start:end]
+
+	def llen (self, name):
+		return len(self._get(name, list) or [])
+
+	# Sorted sets.
+
+	def zadd (self, name, *args, **kwargs):
+		data = self._get(name, MemorySortedSet, True)
+		pairs = list(zip(args[1::2], args[::2])) + list(kwargs.items())
+		count = sum(data.add(tobytes(m), float(s)) for m, s in pairs)
+		self._clean(name)
+		return count
+
+	def zincrby (self, name, value, amount=1):
+		data = self._get(name, MemorySortedSet, True)
+		score = data.scores.get(tobytes(value), 0.0) + amount
+		data.add(tobytes(value), score)
+		return score
+
+	def zrem (self, name, *values):
+		data = self._get(name, MemorySortedSet, True)
+		count = sum(data.remove(tobytes(v)) for v in values)
+		self._clean(name)
+		return count
+
+	def zscore (self, name, value):
+		return (self._get(name, MemorySortedSet) or MemorySortedSet()).scores.get(tobytes(value))
+
+	def zcard (self, name):
+		return len(self._get(name, MemorySortedSet) or MemorySortedSet())
+
+	def zcount (self, name, min, max):
+		data = self._get(name, MemorySortedSet) or MemorySortedSet()
+		return len(data.range(min, max))
+
+	def zrange (self, name, start, end, desc=False, withscores=False,
+			score_cast_func=float):
+		items = (self._get(name, MemorySortedSet) or MemorySortedSet()).items
+
+		if desc:
+			items = items[::-1]
+
+		start, end = self._slice(len(items), start, end)
+		return self._zreply(items[start:end], withscores, score_cast_func)
+
+	def zrevrange (self, name, start, end, withscores=False, score_cast_func=float):
+		return self.zrange(name, start, end, True, withscores, score_cast_func)
+
+	def zrangebyscore (self, name, min, max, start=None, num=None,
+			withscores=False, score_cast_func=float):
+		items = (self._get(name, MemorySortedSet) or MemorySortedSet()).range(min, max)
+		return self._zreply(self._limit(items, start, num), withscores, score_cast_func)
+
+	def zrevrangebyscore (self, name, max, min, start=None, num=None,
+			withscores=False, score_cast_func=float):
+		items = (self._get(name, MemorySortedSet) or MemorySortedSet()).range(min, max)
+		return self._zreply(self._limit(items[::-1], start, num), withscores, score_cast_func)
+
+	def _limit (self, items, start, num):
+		if start is None:
+			return items
+
+		return items[start:] if num is None or num < 0 else items[start:start + num]
+
+	def _zreply (self, items, withscores, score_cast_func):
+		if withscores:
+			return [(m, score_cast_func(tobytes(s))) for s, m in items]
+
+		return [m for s, m in items]
+
+	def sort (self, name, start=None, num=None, by=None, get=None, desc=False,
+			alpha=False, store=None, groups=False):
+		if store is not None:
+			raise Exception('SORT STORE is not supported by memory backend')
+
+		data = self._get(name)
+
+		if data is None:
+			return []
+
+		if type(data) is MemorySortedSet:
+			members = [m for s, m in data.items]
+
+		elif type(data) is set:
+			members = list(data)
+
+		else:
+			raise ResponseError('WRONGTYPE Operation against a key holding the wrong kind of value')
+
+		if by is None or b'nosort' not in tobytes(by):
+			weights = dict((m, m if by is None else self._lookup(by, m)) for m in members)
+
+			if alpha:
+				key = lambda m: (weights[m] or b'', m)
+
+			else:
+				try:
+					floats = dict((m, float(weights[m] or 0)) for m in members)
+
+				except ValueError:
+					raise ResponseError("One or more scores can't be converted into double")
+
+				key = lambda m: (floats[m], m)
+
+			members.sort(key=key, reverse=desc)
+
+		members = self._limit(members, start, num)
+
+		if get is None:
+			return members
+
+		get = [get] if isinstance(get, (bytes, type(u''))) else get
+		return [m if tobytes(g) == b'#' else self._lookup(g, m) \
+			for m in members for g in get]
+
+	def _lookup (self, pattern, member):
+		""" Return value of SORT BY/GET *pattern* for given *member*. """
+
+		pattern = tobytes(pattern).replace(b'*', member, 1)
 
-	def find (self, val, children=False):
-		if isinstance(val, Model):
-			val = val._id
+		if b'->' in pattern:
+			name, key = pattern.rsplit(b'->', 1)
+			return self.hget(name, key)
 
-		return super(Reference, self).find(val, children=children)
+		return self.get(pattern)
 
-	def choice (self, val):
-		if isinstance(val, Model):
-			val = val._id
 
-		return super(Reference, self).choice(val)
+def locked (method):
+	""" Wrap MemoryRedis command to run it under engine lock. """
 
-	def to_db (self, val):
-		return val._id if isinstance(val, Model) else val
+	@wraps(method)
+	def command (self, *args, **kw):
+		with self._lock:
+			return method(self, *args, **kw)
 
-	def from_db (self, val):
-		return self._cls(val)
+	return command
+
+
+for name, member in list(vars(MemoryRedis).items()):
+	if isfunction(member) and not name.startswith('_') and \
+			name not in ('pipeline', 'register_script', 'scan_iter'):
+		setattr(MemoryRedis, name, locked(member))
 
 
 class MetaModel (type):
 	def __new__ (mcs, name, bases, dct):
 		cls = super(MetaModel, mcs).__new__(mcs, name, bases, dct)
-		cls._objects = dict() # id -> model objects registry.
 		cls._fields = dict()
+		cls._collections = dict()
 
 		for name in dir(cls):
 			member = getattr(cls, name)
@@ -416,12 +3778,18 @@ class MetaModel (type):
 			if isinstance(member, Field):
 				cls._fields[name] = member
 
+			elif isinstance(member, Collection):
+				cls._collections[name] = member
+
 		return cls
 
 	def __setattr__ (cls, name, val):
 		if isinstance(val, Field):
 			cls._fields[name] = val
 
+		elif isinstance(val, Collection):
+			cls._collections[name] = val
+
 		super(MetaModel, cls).__setattr__(name, val)
 
 	def __call__ (cls, model_id, *args, **kw):
@@ -429,31 +3797,89 @@ class MetaModel (type):
 			model_id = ''
 
 		elif PY3K and type(model_id) is bytes:
-			model_id = model_id.decode('utf-8')
+			model_id = totext(model_id)
 
 		else:
 			model_id = str(model_id)
 
-		if model_id not in cls._objects:
-			cls._objects[model_id] = object.__new__(cls, *args, **kw)
-			cls._objects[model_id].__init__(model_id)
+		objects = cls._objects
 
-		return cls._objects[model_id]
+		if model_id in objects:
+			return objects[model_id]
+
+		model = object.__new__(cls, *args, **kw)
+		model.__init__(model_id)
+
+		return objects.setdefault(model_id, model)
+
+	@property
+	def _objects (cls):
+		""" Id -> model objects registry of current unit of work. """
+
+		registry = UNIT.get()
+
+		if registry is None:
+			registry = REGISTRY
+
+		if cls not in registry:
+			return registry.setdefault(cls, dict())
+
+		return registry[cls]
+
+	@_objects.setter
+	def _objects (cls, objects):
+		registry = UNIT.get()
+		(REGISTRY if registry is None else registry)[cls] = objects
 
 
 class conf (object):
 	""" Configuration storage and model decorator. """
 
-	db = StrictRedis()
+	db = PoolClient() # Client (or pool name, see Pools).
+	idgen = None
+	storage = HashStorage()
 
-	def __init__ (self, prefix=None, db=None):
+	def __init__ (self, prefix=None, db=None, idgen=None, ttl=None, storage=None,
+			feed=None, feed_values=None, version=None, retries=None, backoff=None):
 		self._prefix = prefix
 		self._db = db
+		self._idgen = idgen
+		self._ttl = ttl
+		self._storage = storage
+		self._feed = feed
+		self._feed_values = feed_values
+		self._version = version
+		self._retries = retries
+		self._backoff = backoff
 
 	def __call__ (self, cls):
 		if self._db is not None:
 			cls._db = self._db
 
+		if self._idgen is not None:
+			cls._idgen = staticmethod(self._idgen)
+
+		if self._ttl is not None:
+			cls._ttl = self._ttl
+
+		if self._storage is not None:
+			cls._storage = self._storage
+
+		if self._feed is not None:
+			cls._feed = FEED_MAXLEN if self._feed is True else self._feed
+
+		if self._feed_values is not None:
+			cls._feed_values = bool(self._feed_values)
+
+		if self._version is not None:
+			cls._version = VERSION_FIELD if self._version is True else self._version
+
+		if self._retries is not None:
+			cls._retries = self._retries
+
+		if self._backoff is not None:
+			cls._backoff = self._backoff
+
 		if self._prefix is not None:
 			Model._cls2prefix[cls] = self._prefix
 
@@ -485,14 +3911,14 @@ class Model (BaseModel):
 		if name in self._diff:
 			return True
 
-		self.load()
+		self.fetch()
 		return name in self._data
 
 	def __getitem__ (self, name):
 		if name in self._diff:
 			return self._diff[name]
 
-		self.load()
+		self.fetch()
 		return self._data[name] if name in self._data else None
 
 	def __setitem__ (self, name, value):
@@ -509,6 +3935,37 @@ class Model (BaseModel):
 	def get (self, name, default=None):
 		return self[name] if name in self else default
 
+	def getraw (self, fields):
+		""" Return list of (field, raw value) pairs of given *fields*.
+		Values which are neither changed nor loaded are read by single
+		pipeline, so model is not loaded. """
+
+		values = dict()
+		missing = []
+
+		for field in fields:
+			if field.field in self._diff:
+				values[field.field] = self._diff[field.field]
+
+			elif self.loaded() or self._exists is False:
+				values[field.field] = (self._data or dict()).get(field.field)
+
+			else:
+				missing.append(field.field)
+
+		if len(missing):
+			cls = self.__class__
+			storage = self.getstorage()
+			pipe = self.getdb().pipeline(transaction=False)
+
+			for name in missing:
+				storage.get(cls, self._id, name, pipe)
+
+			for name, reply in zip(missing, pipe.execute()):
+				values[name] = storage.decode_get(reply, name)
+
+		return [(field, values[field.field]) for field in fields]
+
 	def pop (self, name, default=None):
 		val = self.get(name, default)
 		del self[name]
@@ -517,8 +3974,12 @@ class Model (BaseModel):
 	def exists (self):
 		""" Check if model key exists. """
 
-		if self._exists is None:
-			self._exists = self.getdb().exists(self._key)
+		if self._exists is None and BATCH.get() is not None:
+			self.fetch()
+
+		elif self._exists is None:
+			reply = self.getstorage().exists(self.__class__, self._id, self.getdb())
+			self._exists = bool(reply)
 
 		return self._exists
 
@@ -530,22 +3991,43 @@ class Model (BaseModel):
 		return self._diff.copy()
 
 	def getorigin (self):
-		self.load()
+		self.fetch()
 		return self._data.copy()
 
 	@classmethod
 	def getdb (cls):
+		return connection(getattr(cls, '_db', None))
+
+	@classmethod
+	def getidgen (cls):
+		""" Return model id generator (hexid by default). """
+
+		try:
+			return cls._idgen
+
+		except AttributeError:
+			return hexid if conf.idgen is None else conf.idgen
+
+	@classmethod
+	def getstorage (cls):
+		""" Return model storage (conf.storage by default). """
+
 		try:
-			return cls._db
-		
-		except:
-			return conf.db
+			return cls._storage
+
+		except AttributeError:
+			return conf.storage
 
 	@classmethod
 	def getfields (cls):
 		""" Return name -> field dict of registered fields. """
 		return cls._fields.copy()
 
+	@classmethod
+	def getcollections (cls):
+		""" Return name -> collection dict of registered collections. """
+		return cls._collections.copy()
+
 	def getid (self):
 		return self._id
 
@@ -559,6 +4041,56 @@ class Model (BaseModel):
 
 		return Model._cls2prefix[cls]
 
+	@classmethod
+	def getttl (cls):
+		""" Return configured model ttl in seconds (None by default). """
+
+		try:
+			return cls._ttl
+
+		except AttributeError:
+			return None
+
+	@classmethod
+	def getfeed (cls):
+		""" Return change feed stream MAXLEN or None if feed is disabled. """
+
+		try:
+			return cls._feed or None
+
+		except AttributeError:
+			return None
+
+	@classmethod
+	def getversionfield (cls):
+		""" Return raw name of version field or None if saves are not
+		versioned. """
+
+		try:
+			return cls._version or None
+
+		except AttributeError:
+			return None
+
+	def getversion (self):
+		""" Return model version (0 if model was never saved). """
+		return int(self[self.getversionfield()] or 0)
+
+	@classmethod
+	def getfeedkey (cls):
+		""" Return key of change feed stream. """
+		return ':'.join((cls.getprefix(), '_feed'))
+
+	@classmethod
+	def getttlkey (cls, field=None):
+		""" Return key of expiry index (deadline -> id zset) or key of
+		indexed *field* values hash of expiring models. """
+
+		if field is None:
+			return ':'.join((cls.getprefix(), '_ttl'))
+
+		return ':'.join((cls.getprefix(), '_ttl', field.field))
+
 	@classmethod
 	def getpipe (cls, pipe=None):
 		return cls.getdb().pipeline(transaction=True) if pipe is None else pipe
@@ -566,19 +4098,26 @@ class Model (BaseModel):
 	@classmethod
 	def new (cls, model_id=None):
 		""" Return new model with given id and field.new values.
-		If model id is None hexid() will be used instead.
-		Exception raised if model already exists.
+		If model id is None model id generator will be used instead.
+		Exception raised if model already exists. Existence check is
+		skipped for ids produced by unique generators.
 
 		Notice: if model with such id was initialized previously (already in
 		registry) this method will overwrite it with field.new values. """
 
 		if model_id is None:
-			model_id = hexid()
+			idgen = cls.getidgen()
+			model = cls(idgen())
 
-		model = cls(model_id)
+			if getattr(idgen, 'unique', False):
+				model._exists = False
+				return model.fill_new()
+
+		else:
+			model = cls(model_id)
 
 		if model.exists():
-			raise Exception('%s(%s) already exists' % (cls.__name__, model_id))
+			raise Exception('%s(%s) already exists' % (cls.__name__, model.getid()))
 
 		return model.fill_new()
 
@@ -613,22 +4152,42 @@ class Model (BaseModel):
 		return data
 
 	def load (self):
-		""" Load data into hash if needed. """
+		""" Load data into hash if needed. Loading is deferred within
+		batch until first data access. """
+
+		batch = BATCH.get()
+
+		if batch is not None and not self.loaded():
+			batch.defer(self)
+
+		else:
+			self.fetch()
+
+	def fetch (self):
+		""" Load data into hash right now if needed. All deferred loads
+		of current batch are resolved by the same pipeline. """
 
 		if self.loaded():
 			return
 
-		self._data = dict()
+		batch = BATCH.get()
+
+		if batch is not None:
+			batch.defer(self)
+			batch.resolve()
+			return
 
 		if self._exists is False:
+			self._data = dict()
 			return
 
-		for k, v in self.getdb().hgetall(self._key).items():
-			k = k.decode(encoding='UTF-8')
-			v = v.decode(encoding='UTF-8')
+		storage = self.getstorage()
+		self._fill(storage.load(self.__class__, self._id, self.getdb()))
 
-			self._data[k] = v
+	def _fill (self, reply):
+		""" Fill model data with storage load() reply. """
 
+		self._data = self.getstorage().decode(reply)
 		self._exists = bool(len(self._data))
 
 	def loaded (self):
@@ -642,14 +4201,27 @@ class Model (BaseModel):
 	def delete (self, pipe=None):
 		""" Delete model (optionally within given parent pipe). """
 
+		if pipe is None and BATCH.get() is not None:
+			pipe = BATCH.get().pipe(self)
+
 		_pipe = self.getpipe(pipe)
 
 		for field in self.getfields().values():
-			if field.index or field.unique:
+			if field.indexed():
 				field.del_idx(self, _pipe)
+				_pipe.hdel(self.getttlkey(field), self._id)
+
+		_pipe.zrem(self.getttlkey(), self._id)
+
+		for collection in self.getcollections().values():
+			_pipe.delete(collection.key(self))
 
 		if self._exists is not False:
-			_pipe.delete(self._key)
+			self.getstorage().delete(self.__class__, self._id, _pipe)
+
+			if self.getfeed() is not None:
+				old = self._data if self.loaded() else dict()
+				self.feed_event(_pipe, 'delete', dict.fromkeys(old), old)
 
 			self._diff = dict()
 			self._data = dict()
@@ -658,12 +4230,111 @@ class Model (BaseModel):
 		if pipe is None and len(_pipe):
 			_pipe.execute()
 
-	def save (self, pipe=None):
-		if not len(self._diff):
+	def save (self, pipe=None, ttl=None):
+		""" Save model changes (optionally within given parent pipe).
+		Model expires in *ttl* seconds (conf ttl is used by default).
+		Unchanged model is saved only if *ttl* is given explicitly.
+
+		Saves of versioned models (see conf version) are always executed
+		by own transaction (parent pipe is ignored), see save_versioned(). """
+
+		if not len(self._diff) and ttl is None:
 			return
 
+		if self.getversionfield() is not None:
+			return self.save_versioned(ttl)
+
+		self._save(pipe, ttl)
+
+	def save_versioned (self, ttl=None):
+		""" Save model within WATCH/MULTI transaction incrementing its
+		version. Conflict is detected if stored version differs from loaded
+		one or model key is changed during save. On conflict model data is
+		reloaded and local changes are applied again after backoff delay.
+		ConflictError raised when retries are over. """
+
+		cls = self.__class__
+		name = self.getversionfield()
+		storage = self.getstorage()
+		retries = getattr(cls, '_retries', VERSION_RETRIES)
+		backoff = getattr(cls, '_backoff', VERSION_BACKOFF)
+
+		for attempt in range(retries + 1):
+			diff = self._diff.copy()
+			pipe = self.getdb().pipeline(transaction=True)
+
+			try:
+				pipe.watch(storage.key(cls, self._id))
+				reply = storage.get(cls, self._id, name, pipe)
+				current = storage.decode_get(reply, name)
+				loaded = self.loaded() and self._data.get(name) or None
+
+				if not self.loaded() or loaded == current:
+					pipe.multi()
+					self[name] = str(int(current or 0) + 1)
+					self._save(pipe, ttl)
+					pipe.execute()
+					return
+
+			except WatchError:
+				pass
+
+			except:
+				self._diff = diff
+				raise
+
+			finally:
+				pipe.reset()
+
+			METRICS.incr('version_conflicts')
+			self._diff = diff
+			self._exists = None
+			self.unload()
+
+			if attempt == retries:
+				break
+
+			METRICS.incr('version_retries')
+			sleep(backoff * (2 ** attempt) * random())
+			self.fetch()
+
+		raise ConflictError('%s(%s) was changed concurrently' % (cls.__name__, self._id))
+
+	def _save (self, pipe, ttl):
+		""" Write model changes (see save()). """
+
+		changed = bool(len(self._diff))
+
+		if ttl is None:
+			ttl = self.getttl()
+
 		fields = [f for f in self.getfields().values() \
-			if f.field in self._diff and (f.index or f.unique)]
+			if f.field in self._diff and f.indexed()]
+
+		if ttl is not None:
+			indexed = self.getraw([f for f in self.getfields().values() \
+				if f.indexed()])
+
+		# Model saved with explicit ttl once keeps its expiry index values
+		# in sync, otherwise sweep() would unindex outdated values.
+		elif len(fields) and self._exists is not False and \
+				self.getdb().zscore(self.getttlkey(), self._id) is not None:
+			indexed = [(f, self._diff[f.field]) for f in fields]
+
+		else:
+			indexed = None
+
+		if changed and self.getfeed() is not None:
+			diff = self.getdiff()
+			old = self._data.copy() if self.loaded() else None
+
+		storage = self.getstorage()
+
+		if storage.whole:
+			self.fetch()
+
+		if pipe is None and BATCH.get() is not None:
+			pipe = BATCH.get().pipe(self)
 
 		_pipe = self.getpipe(pipe)
 
@@ -681,11 +4352,16 @@ class Model (BaseModel):
 				if loaded and key in self._data:
 					del self._data[key]
 
-		if self._exists is not False and len(delkeys):
-			_pipe.hdel(self._key, *delkeys)
+		storage.save(self, _pipe, delkeys)
+
+		if changed and self.getfeed() is not None:
+			self.feed_event(_pipe, 'save', diff, old)
 
-		if len(self._diff):
-			_pipe.hmset(self._key, self._diff)
+		if ttl is not None:
+			self.save_ttl(ttl, indexed, _pipe)
+
+		elif indexed is not None:
+			self.save_ttl_idx(indexed, _pipe)
 
 		if pipe is None and len(_pipe):
 			_pipe.execute()
@@ -693,9 +4369,125 @@ class Model (BaseModel):
 		if loaded:
 			self._data.update(self._diff)
 
-		self._exists = True
+		if changed:
+			self._exists = True
+
 		self._diff = dict()
 
+	def save_ttl (self, ttl, indexed, pipe):
+		""" Set model expiration and register it in expiry index along
+		with *indexed* list of (field, raw value) pairs. """
+
+		self.getstorage().expire(self.__class__, self._id, pipe, int(ttl))
+
+		for collection in self.getcollections().values():
+			pipe.expire(collection.key(self), int(ttl))
+
+		pipe.zadd(self.getttlkey(), **{
+			self._id: time() + ttl,
+		})
+
+		self.save_ttl_idx(indexed, pipe)
+
+	def save_ttl_idx (self, indexed, pipe):
+		""" Save *indexed* list of (field, raw value) pairs into expiry
+		index (see sweep()). """
+
+		for field, val in indexed:
+			if val is None:
+				pipe.hdel(self.getttlkey(field), self._id)
+
+			else:
+				pipe.hset(self.getttlkey(field), self._id, val)
+
+	def feed_event (self, pipe, op, diff, old=None):
+		""" Append change event to feed stream. Event contains operation,
+		model id, changed fields and optionally (see conf feed_values)
+		JSON-encoded new and old (if known) values of changed fields. """
+
+		args = ['op', op, 'id', self._id, 'fields', ','.join(sorted(diff))]
+
+		if getattr(self, '_feed_values', False):
+			args += ['new', json.dumps(diff)]
+
+			if old is not None:
+				args += ['old', json.dumps(dict((k, old.get(k)) for k in diff))]
+
+		pipe.execute_command('XADD', self.getfeedkey(), 'MAXLEN', '~',
+			self.getfeed(), '*', *args)
+
+	@classmethod
+	def sweep (cls, count=1000, now=None):
+		""" Remove expired models from indexes and delete their collections
+		using pipelined batches of *count* ids. Return number of swept
+		models. """
+
+		db = cls.getdb()
+		key = cls.getttlkey()
+		prefix = cls.getprefix()
+		now = time() if now is None else now
+
+		fields = [f for f in cls.getfields().values() if f.indexed()]
+		collections = cls.getcollections().values()
+		start = swept = 0
+
+		while True:
+			ids = db.zrangebyscore(key, '-inf', now, start=start, num=count)
+			ids = [totext(i) for i in ids]
+
+			if not len(ids):
+				break
+
+			pipe = db.pipeline(transaction=False)
+			storage = cls.getstorage()
+
+			for model_id in ids:
+				storage.exists(cls, model_id, pipe)
+
+			for field in fields:
+				pipe.hmget(cls.getttlkey(field), ids)
+
+			for field in fields: # None bits of bitmaps (see IndexField.unindex).
+				if getattr(field, 'bitmap', False):
+					for model_id in ids:
+						pipe.getbit(field.idx_key(prefix, None), bitoffset(model_id))
+
+			replies = pipe.execute()
+			alive = replies[:len(ids)]
+			values = replies[len(ids):len(ids) + len(fields)]
+			nonebits = iter(replies[len(ids) + len(fields):])
+			nonebits = [[next(nonebits) for i in ids] if getattr(f, 'bitmap', False) \
+				else None for f in fields]
+			pipe = db.pipeline(transaction=True)
+
+			for n, model_id in enumerate(ids):
+				if alive[n]: # Not expired by redis yet.
+					start += 1
+					continue
+
+				for field, vals, bits in zip(fields, values, nonebits):
+					val = totext(vals[n])
+
+					if val is not None or bits is None or bits[n]:
+						field.unindex(prefix, model_id, val, pipe)
+
+					pipe.hdel(cls.getttlkey(field), model_id)
+
+				for collection in collections:
+					pipe.delete(':'.join((prefix, model_id, collection.field)))
+
+				pipe.zrem(key, model_id)
+				cls._objects.pop(model_id, None)
+				swept += 1
+
+			if len(pipe):
+				pipe.execute()
+
+			if len(ids) < count:
+				break
+
+		return swept
+
 	@classmethod
 	def save_all (cls, pipe=None):
 		""" Save all known models. Deleted models ignored by empty diff. """
@@ -703,7 +4495,7 @@ class Model (BaseModel):
 		if cls is not Model:
 			_pipe = cls.getpipe(pipe)
 
-			for model in cls._objects.values():
+			for model in list(cls._objects.values()):
 				model.save(_pipe)
 
 			if pipe is None and len(_pipe):
@@ -712,8 +4504,121 @@ class Model (BaseModel):
 		for child in cls.__subclasses__():
 			child.save_all()
 
+	@classmethod
+	def dump (cls, stream, format='json', count=1000, cursor=0, progress=None):
+		""" Write all stored models of class into *stream* as newline
+		delimited JSON (text stream) or msgpack (binary stream) records of
+		model id and raw data. Models are read by SCAN batches of about
+		*count* keys starting from *cursor*. Optional *progress* callback
+		is called with SCAN cursor and records count after each batch, so
+		interrupted dump may be resumed. Return records count. """
+
+		assert format in ('json', 'msgpack')
+		written = 0
+
+		for cursor, batch in cls.getstorage().scan(cls, cls.getdb(), count, cursor):
+			for model_id, data in batch:
+				if format == 'json':
+					stream.write(json.dumps([model_id, data]) + '\n')
+
+				else:
+					stream.write(msgpack.packb([model_id, data], use_bin_type=True))
+
+			written += len(batch)
+
+			if progress is not None:
+				progress(cursor, written)
+
+		return written
+
+	@classmethod
+	def load_dump (cls, stream, format='json', count=1000, workers=1, skip=0):
+		""" Import dump() records from *stream*. Records are saved (and
+		indexed) by pipelined batches of *count* models using *workers*
+		threads. First *skip* records are ignored (use it to resume
+		interrupted import). Return imported records count. """
+
+		assert format in ('json', 'msgpack')
+
+		if format == 'json':
+			records = (json.loads(line) for line in stream if line.strip())
+
+		else:
+			records = msgpack.Unpacker(stream, raw=False)
+
+		queue = Queue(workers * 2)
+		errors = []
+
+		def worker ():
+			while True:
+				batch = queue.get()
+
+				if batch is None:
+					return
+
+				try:
+					if not errors:
+						cls.restore(batch)
+
+				except Exception as e:
+					errors.append(e)
+
+		threads = [Thread(target=worker) for n in range(workers)]
+
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+
+		batch = []
+		imported = 0
+
+		for n, record in enumerate(records):
+			if n < skip:
+				continue
+
+			batch.append(record)
+
+			if len(batch) == count:
+				queue.put(batch)
+				imported += len(batch)
+				batch = []
+
+		if len(batch):
+			queue.put(batch)
+			imported += len(batch)
+
+		for thread in threads:
+			queue.put(None)
+
+		for thread in threads:
+			thread.join()
+
+		if errors:
+			raise errors[0]
+
+		return imported
+
+	@classmethod
+	def restore (cls, records):
+		""" Save (model id, raw data) records and update indexes using
+		single pipelined load and single transaction. """
+
+		with Model.unit():
+			models = [cls(model_id) for model_id, data in records]
+			hydrate(models)
+			pipe = cls.getpipe()
+
+			for model, (model_id, data) in zip(models, records):
+				for k, v in data.items():
+					model[k] = v
+
+				model.save(pipe)
+
+			if len(pipe):
+				pipe.execute()
+
 	def free (self):
-		del self.__class__._objects[self._id]
+		self.__class__._objects.pop(self._id, None)
 
 	@classmethod
 	def free_all (cls):
@@ -724,6 +4629,16 @@ class Model (BaseModel):
 		for child in cls.__subclasses__():
 			child.free_all()
 
+	@staticmethod
+	def unit ():
+		""" Return new unit of work (context-local models registry). """
+		return Unit()
+
+	@staticmethod
+	def batch ():
+		""" Return new implicit batching context (see Batch). """
+		return Batch()
+
 	@classmethod
 	def inheritors (cls):
 		""" Get model inheritors. """
@@ -742,9 +4657,191 @@ class Model (BaseModel):
 		return subclasses
 
 
+def memstat (cls=None, rate=1.0, count=1000):
+	""" Sample redis memory usage of *cls* (all models by default) and its
+	inheritors with SCAN and MEMORY USAGE. Return JSON-serializable report:
+	class name -> {prefix, total, groups: group -> stats}. Group is one of
+	'hash' (model hashes), 'bucket' (see BucketStorage), 'index:<field>'
+	(exact index sets), 'text:<field>' (full-text index sets), 'range:<field>'
+	(range index zsets), 'geo:<field>' (geo index), 'ttl' (expiry index) or
+	'feed' (change feed stream). Stats are estimated by
+	sampling *rate* part of keys. Each SCAN batch is measured as it
+	arrives, so key names are never collected in memory. """
+
+	assert 0 < rate <= 1
+	classes = Model.inheritors() if cls is None else set([cls]) | cls.inheritors()
+	report = dict()
+
+	for cls in sorted(classes, key=lambda c: c.__name__):
+		prefix = cls.getprefix()
+		db = cls.getdb()
+		groups = dict()
+		cursor = None
+
+		while cursor != 0:
+			cursor, keys = db.scan(cursor or 0, match=prefix + ':*', count=count)
+			batch = [totext(k) for k in keys if rate == 1 or random() < rate]
+
+			if not len(batch):
+				continue
+
+			pipe = db.pipeline(transaction=False)
+
+			for key in batch:
+				pipe.execute_command('MEMORY USAGE', key)
+				pipe.object('encoding', key)
+
+			replies = pipe.execute()
+
+			for key, size, encoding in zip(batch, replies[::2], replies[1::2]):
+				group = memstat_group(cls, key[len(prefix) + 1:])
+
+				if group not in groups:
+					groups[group] = dict(sampled=0, keys=0, bytes=0, encoding=dict())
+
+				stats = groups[group]
+				encoding = str(totext(encoding))
+
+				stats['sampled'] += 1
+				stats['bytes'] += size or 0
+				stats['encoding'][encoding] = stats['encoding'].get(encoding, 0) + 1
+
+		total = dict(sampled=0, keys=0, bytes=0)
+
+		for stats in groups.values():
+			total['sampled'] += stats['sampled']
+			total['bytes'] += stats['bytes']
+
+			stats['keys'] = int(stats['sampled'] / rate)
+			stats['bytes'] = int(stats['bytes'] / rate)
+
+		total['keys'] = int(total['sampled'] / rate)
+		total['bytes'] = int(total['bytes'] / rate)
+
+		report[cls.__name__] = dict(prefix=prefix, total=total, groups=groups)
+
+	return report
+
+
+def memstat_group (cls, name):
+	""" Return memstat() group of key *name* (without model prefix). """
+
+	if name == '_ttl' or name.startswith('_ttl:'):
+		return 'ttl'
+
+	if name.startswith('_b:'):
+		return 'bucket'
+
+	if name == '_feed':
+		return 'feed'
+
+	for collection in cls.getcollections().values():
+		if name.endswith(':' + collection.field):
+			return 'collection:' + collection.field
+
+	for field in cls.getfields().values():
+		if not field.indexed():
+			continue
+
+		if getattr(field, 'text', False) and name.startswith('~' + field.field + ':'):
+			return 'text:' + field.field
+
+		if isinstance(field, RangeIndexField) and (name == field.field or \
+				field.partition and name.startswith(field.field + ':')):
+			return 'range:' + field.field
+
+		if isinstance(field, GeoPoint) and name == field.field:
+			return 'geo:' + field.field
+
+		if isinstance(field, IndexField) and name.startswith(field.field + ':'):
+			return 'index:' + field.field
+
+	return 'hash'
+
+
+def memstat_table (report):
+	""" Format memstat() report as text table. """
+
+	row = '%-20s %-20s %12s %14s  %s'
+	lines = [row % ('MODEL', 'GROUP', 'KEYS', 'BYTES', 'ENCODING')]
+
+	for name in sorted(report):
+		groups = report[name]['groups']
+
+		for group in sorted(groups):
+			stats = groups[group]
+			encoding = ', '.join('%s: %d' % i for i in sorted(stats['encoding'].items()))
+			lines.append(row % (name, group, stats['keys'], stats['bytes'], encoding))
+
+		total = report[name]['total']
+		lines.append(row % (name, 'TOTAL', total['keys'], total['bytes'], ''))
+
+	return '\n'.join(lines)
+
+
+class FeedReader (object):
+	""" Consumer group reader of model class change feed (see conf feed).
+	Group is created (starting with new events) if it does not exist. """
+
+	def __init__ (self, cls, group, consumer, count=100, block=None):
+		self.cls = cls
+		self.group = group
+		self.consumer = consumer
+		self.count = count
+		self.block = block
+
+		try:
+			cls.getdb().execute_command('XGROUP', 'CREATE',
+				cls.getfeedkey(), group, '$', 'MKSTREAM')
+
+		except ResponseError as e:
+			if not str(e).startswith('BUSYGROUP'):
+				raise
+
+	def read (self, pending=False):
+		""" Return list of up to *count* events dicts (stream id, op, id,
+		fields list and optionally new and old values dicts). Events
+		delivered before but not acknowledged are returned if *pending*. """
+
+		args = ['XREADGROUP', 'GROUP', self.group, self.consumer, 'COUNT', self.count]
+
+		if self.block is not None:
+			args += ['BLOCK', self.block]
+
+		args += ['STREAMS', self.cls.getfeedkey(), '0' if pending else '>']
+		reply = self.cls.getdb().execute_command(*args)
+		events = []
+
+		for stream, items in reply or []:
+			for stream_id, values in items:
+				if values is None: # Trimmed by MAXLEN.
+					continue
+
+				values = [totext(v) for v in values]
+				event = dict(zip(values[::2], values[1::2]))
+				event['stream_id'] = totext(stream_id)
+				event['fields'] = event['fields'].split(',') if event['fields'] else []
+
+				for name in ('new', 'old'):
+					if name in event:
+						event[name] = json.loads(event[name])
+
+				events.append(event)
+
+		return events
+
+	def ack (self, events):
+		""" Acknowledge processed events. """
+
+		if len(events):
+			self.cls.getdb().execute_command('XACK', self.cls.getfeedkey(),
+				self.group, *[e['stream_id'] for e in events])
+
+
 class FlaskRedisca (object):
 	def __init__ (self, app=None, autosave=False):
 		self.autosave = autosave
+		self._unit = ContextLocal('redisca_flask_unit')
 
 		if app is not None:
 			self.init_app(app)
@@ -752,15 +4849,22 @@ class FlaskRedisca (object):
 	def init_app (self, app):
 		self.app = app
 
-		conf.db = StrictRedis(**self.app.config['REDISCA'])
+		POOLS.configure('default', **self.app.config['REDISCA'])
+		conf.db = PoolClient()
 		self.app.before_request(self.before_request)
 		self.app.teardown_request(self.after_request)
 
 	def before_request (self):
-		pass
+		self._unit.set(Model.unit().open())
 
 	def after_request (self, exc):
-		if exc is None and self.autosave:
-			Model.save_all()
+		unit = self._unit.get()
+
+		try:
+			if exc is None and self.autosave:
+				Model.save_all()
 
-		Model.free_all()
+		finally:
+			if unit is not None:
+				self._unit.set(None)
+				unit.close()
@@ -1,9 +1,22 @@
 # -*- coding: utf-8 -
 
+import os
+import json
+
 from unittest import TestCase
 from datetime import datetime
+from datetime import timedelta
+from datetime import tzinfo
 from time import time
+from threading import Thread
 from redis import Redis
+from redis import StrictRedis
+
+try:
+	from StringIO import StringIO # Accepts json.dumps() str of python 2.
+
+except ImportError:
+	from io import StringIO
 
 from redisca import PY3K
 from redisca import Model
@@ -17,12 +30,81 @@ from redisca import DateTime
 from redisca import Reference
 from redisca import hexid
 from redisca import intid
+from redisca import SnowflakeId
+from redisca import BlockId
+from redisca import prefetch
+from redisca import memstat
+from redisca import memstat_table
+from redisca import memstat_group
+from redisca import hydrate
+from redisca import BucketStorage
+from redisca import BlobStorage
+from redisca import StructCodec
+from redisca import FeedReader
+from redisca import GeoPoint
+from redisca import Counter
+from redisca import ListField
+from redisca import SetField
+from redisca import SortedSetField
+from redisca import MemoryRedis
+from redisca import ConflictError
+from redisca import METRICS
+from redisca import POOLS
+from redisca import PoolClient
+from redisca import connection
 from redisca import conf
+from redisca import msgpack
+from redisca import MsgpackCodec
 
 NOW_TS = int(time())
 NOW = datetime.fromtimestamp(NOW_TS)
 
 
+class UTC (tzinfo):
+	""" UTC timezone (datetime.timezone is python 3 only). """
+
+	def utcoffset (self, dt):
+		return timedelta(0)
+
+	def dst (self, dt):
+		return timedelta(0)
+
+	def tzname (self, dt):
+		return 'UTC'
+
+
+def inchild (func):
+	""" Return JSON-serializable result of func() called in forked process. """
+
+	rfd, wfd = os.pipe()
+	pid = os.fork()
+
+	if pid == 0:
+		os.close(rfd)
+
+		try:
+			os.write(wfd, json.dumps(func()).encode('utf-8'))
+
+		finally:
+			os._exit(0)
+
+	os.close(wfd)
+	data = b''
+
+	while True:
+		chunk = os.read(rfd, 4096)
+
+		if not chunk:
+			break
+
+		data += chunk
+
+	os.close(rfd)
+	os.waitpid(pid, 0)
+
+	return json.loads(data.decode('utf-8'))
+
+
 redis0 = Redis(db=0)
 redis1 = Redis(db=1)
 
@@ -92,6 +174,14 @@ class SubUser (User):
 	pass
 
 
+class Order (Model):
+	user = Reference(
+		User,
+		field='user',
+		index=True,
+	)
+
+
 class SubLang (Language):
 	pass
 
@@ -111,6 +201,7 @@ class ModelTestCase (TestCase):
 	def tearDown (self):
 		User.free_all()
 		Language.free_all()
+		Order.free_all()
 
 	def test_prefix (self):
 		self.assertEqual(User.getprefix(), 'u')
@@ -681,3 +772,1322 @@ class ModelTestCase (TestCase):
 		user1.email = 'foo@bar.com'
 		self.assertEqual(user1.email, 'foo@bar.com')
 		self.assertEqual(user1._diff, dict())
+
+	def test_snowflake_id (self):
+		idgen = SnowflakeId(worker=3)
+		ids = [idgen() for i in range(10000)]
+
+		self.assertEqual(len(set(ids)), len(ids))
+		self.assertEqual(ids, sorted(ids))
+		self.assertEqual(ids[0] >> SnowflakeId.SEQUENCE_BITS & 1023, 3)
+
+		def child ():
+			try:
+				idgen()
+
+			except Exception:
+				return 'refused'
+
+		self.assertEqual(inchild(child), 'refused')
+
+		idgen = SnowflakeId(worker=lambda: os.getpid() % 1024)
+		parent = idgen()
+		child, pid = inchild(lambda: [idgen(), os.getpid()])
+		self.assertEqual(parent >> SnowflakeId.SEQUENCE_BITS & 1023, os.getpid() % 1024)
+		self.assertEqual(child >> SnowflakeId.SEQUENCE_BITS & 1023, pid % 1024)
+
+	def test_block_id (self):
+		idgen = BlockId('ids', size=10, db=redis1)
+		ids = [idgen() for i in range(25)]
+
+		self.assertEqual(ids, list(range(1, 26)))
+		self.assertEqual(redis1.get('ids'), b'30')
+
+		child = inchild(lambda: [idgen(), idgen()])
+		self.assertEqual(child, [31, 32])
+		self.assertEqual([idgen(), idgen()], [26, 27])
+
+	def test_new_idgen (self):
+		@conf(idgen=SnowflakeId(worker=1))
+		class Token (Model):
+			created = DateTime(field='created', new=NOW)
+
+		token = Token.new()
+		self.assertTrue(token.getid().isdigit())
+		self.assertFalse(token.exists())
+		self.assertEqual(token.created, NOW)
+		self.assertTrue(Token.getidgen() is not User.getidgen())
+
+	def test_prefetch (self):
+		for i in range(1, 4):
+			lang = Language(i)
+			lang.name = 'lang%d' % i
+			lang.save()
+
+			user = User(i)
+			user.lang = lang
+			user.save()
+
+			for j in range(2):
+				Order(i * 10 + j).user = user
+
+		Order.save_all()
+		Model.free_all()
+
+		orders = Order.user.find(User(2)) + Order.user.find(User(3))
+		self.assertEqual(prefetch(orders, 'user', 'user.lang'), orders)
+
+		for order in orders:
+			self.assertTrue(order.loaded())
+			self.assertTrue(order.user.loaded())
+			self.assertTrue(order.user.lang.loaded())
+			self.assertEqual(order.user.lang.name, 'lang%s' % order.user.getid())
+
+		self.assertFalse(User(1).loaded())
+		self.assertFalse(Language(1).loaded())
+
+		orders = (Order.user == User(1)).prefetch('user')
+		self.assertEqual(len(orders), 2)
+		self.assertTrue(User(1).loaded())
+
+		with self.assertRaises(Exception):
+			prefetch(orders, 'user.name')
+
+	def test_find_many (self):
+		for i in range(1, 7):
+			Order(i).user = User(i % 3)
+
+		Order.save_all()
+		Order.free_all()
+
+		found = Order.user.find_many([User(0), User(1), '3'], load=True)
+		self.assertEqual(set(found), set(['0', '1', '3']))
+		self.assertEqual(set(found['0']), set([Order(3), Order(6)]))
+		self.assertEqual(set(found['1']), set([Order(1), Order(4)]))
+		self.assertEqual(found['3'], [])
+		self.assertTrue(Order(3).loaded())
+		self.assertFalse(Order(2).loaded())
+
+		counts = Order.user.count_many([User(0), User(2), User(3)])
+		self.assertEqual(counts, {'0': 2, '2': 2, '3': 0})
+
+	def test_unit (self):
+		user = User(1)
+		user.name = 'John Smith'
+
+		with Model.unit():
+			self.assertTrue(User(1) is not user)
+			self.assertEqual(User(1).name, None)
+			self.assertTrue(User(1) is User(1))
+
+			unit_user = User(2)
+			Model.free_all()
+			self.assertTrue(User(2) is not unit_user)
+
+		self.assertTrue(User(1) is user)
+		self.assertEqual(User(1).name, 'John Smith')
+		self.assertFalse('2' in User._objects)
+
+		seen = dict()
+
+		def worker (n):
+			with Model.unit():
+				seen[n] = User(1)
+				User(1).name = 'Worker %d' % n
+				seen[n] = seen[n] is User(1) and User(1).name
+
+		threads = [Thread(target=worker, args=(n,)) for n in range(4)]
+
+		for thread in threads:
+			thread.start()
+
+		for thread in threads:
+			thread.join()
+
+		self.assertEqual(seen, dict((n, 'Worker %d' % n) for n in range(4)))
+		self.assertEqual(User(1).name, 'John Smith')
+
+	def test_batch (self):
+		for n in range(1, 4):
+			user = User(n)
+			user.name = 'User %d' % n
+			user.age = n
+
+		User(1).save()
+		User(2).save()
+
+		with Model.batch():
+			for n in range(1, 4):
+				User(n).save()
+
+			user = User(4)
+			user.name = 'John Smith'
+			user.save()
+			User(2).delete()
+
+			self.assertFalse(redis0.exists('u:3'))
+			self.assertTrue(redis0.exists('u:2'))
+
+		self.assertEqual(redis0.hget('u:3', 'name'), b'User 3')
+		self.assertEqual(redis0.hget('u:4', 'name'), b'John Smith')
+		self.assertFalse(redis0.exists('u:2'))
+		self.assertEqual(User.age.range(), [User(1), User(3)])
+
+		Model.free_all()
+
+		with Model.batch():
+			users = [User(n) for n in range(1, 5)]
+
+			for user in users:
+				user.load()
+
+			self.assertFalse(any(user.loaded() for user in users))
+			self.assertEqual(users[0].name, 'User 1')
+			self.assertTrue(all(user.loaded() for user in users))
+			self.assertEqual([user.exists() for user in users], [True, False, True, True])
+
+		try:
+			with Model.batch():
+				User(1).name = 'Changed'
+				User(1).save()
+				raise ValueError()
+
+		except ValueError:
+			pass
+
+		self.assertEqual(redis0.hget('u:1', 'name'), b'User 1')
+		self.assertFalse(User(1).loaded())
+		self.assertEqual(User(1).name, 'User 1')
+
+	def test_ttl (self):
+		@conf(prefix='sess', ttl=60)
+		class Session (Model):
+			user = Reference(User, field='user', index=True)
+			seen = Integer(field='seen', index=True)
+
+		session = Session(1)
+		session.user = User(1)
+		session.seen = 10
+		session.save()
+
+		self.assertTrue(0 < redis0.ttl('sess:1') <= 60)
+		self.assertEqual(redis0.hget('sess:_ttl:user', '1'), b'1')
+		self.assertEqual(redis0.zcard('sess:_ttl'), 1)
+
+		user = User(2)
+		user.name = 'John Smith'
+		user.save(ttl=30)
+		self.assertTrue(0 < redis0.ttl('u:2') <= 30)
+
+		user.save()
+		self.assertEqual(Session.sweep(now=time() + 100), 0)
+
+		redis0.delete('sess:1') # Expire it.
+		self.assertEqual(Session.sweep(now=time() + 100), 1)
+		self.assertFalse(redis0.exists('sess:user:1'))
+		self.assertFalse(redis0.exists('sess:seen'))
+		self.assertFalse(redis0.exists('sess:_ttl'))
+		self.assertFalse(redis0.exists('sess:_ttl:user'))
+
+		user.delete()
+		self.assertFalse(redis0.exists('u:_ttl'))
+		self.assertFalse(redis0.exists('u:_ttl:name'))
+
+		user = User(3)
+		user.name = 'Alice'
+		user.save(ttl=60)
+		User.free_all()
+
+		user = User(3)
+		user.name = 'Bobby'
+		user.save()
+		self.assertFalse(user.loaded())
+		self.assertEqual(redis0.hget('u:_ttl:name', '3'), b'Bobby')
+
+		redis0.delete('u:3') # Expire it.
+		self.assertEqual(User.sweep(now=time() + 100), 1)
+		self.assertFalse(redis0.sismember('u:name:Alice', '3'))
+		self.assertFalse(redis0.sismember('u:name:Bobby', '3'))
+
+		User.free_all()
+		user = User(4)
+		user.name = 'Carol'
+		user.save()
+		User.free_all()
+		User(4).save(ttl=60)
+		self.assertFalse(User(4).loaded())
+		self.assertEqual(redis0.hget('u:_ttl:name', '4'), b'Carol')
+
+	def test_memstat (self):
+		for i in range(1, 11):
+			user = User(i)
+			user.name = 'John Smith'
+			user.age = i
+			user.save()
+
+		user.save(ttl=60)
+		report = memstat(User)
+
+		self.assertEqual(set(report), set(['User', 'SubUser']))
+		self.assertEqual(report['SubUser']['total']['keys'], 0)
+
+		groups = report['User']['groups']
+		self.assertEqual(set(groups), set(['hash', 'index:name', 'range:age', 'ttl']))
+		self.assertEqual(groups['hash']['keys'], 10)
+		self.assertEqual(groups['index:name']['keys'], 1)
+		self.assertEqual(groups['ttl']['keys'], 3)
+		self.assertTrue(groups['hash']['bytes'] > 0)
+		self.assertEqual(sum(groups['hash']['encoding'].values()), 10)
+		self.assertEqual(report['User']['total']['keys'], 15)
+		self.assertEqual(memstat(User, count=2)['User']['total']['keys'], 15)
+
+		table = memstat_table(report)
+		self.assertTrue('index:name' in table)
+		self.assertEqual(len(table.splitlines()), 7)
+
+	def test_bitmap (self):
+		class Flags (Model):
+			active = Bool(field='active', index=True, bitmap=True)
+			admin = Bool(field='admin', index=True, bitmap=True)
+			kind = String(field='kind', index=True, bitmap=True)
+
+		for i in range(100):
+			flags = Flags(i)
+			flags.active = i % 2
+			flags.admin = i % 3 == 0
+			flags.kind = 'abc'[i % 3]
+
+		Flags.save_all()
+		Flags.free_all()
+
+		self.assertEqual(redis0.type('flags:active:1'), b'string')
+		self.assertEqual(redis0.bitcount('flags:active:1'), 50)
+		self.assertEqual(Flags.active.count(True), 50)
+		self.assertEqual((Flags.kind == 'a').count(), 34)
+		self.assertEqual(len(Flags.active == 0), 50)
+		self.assertEqual(set(Flags.active.find(0)), set(Flags(i) for i in range(0, 100, 2)))
+		self.assertEqual(list(Flags.active.iterids(1, chunk=2)), list(range(1, 100, 2)))
+		self.assertEqual(Flags.kind.count_many(['a', 'b', 'z']), {'a': 34, 'b': 33, 'z': 0})
+		self.assertEqual(Flags.kind.find_many(['c'])['c'][:2], [Flags(2), Flags(5)])
+
+		expr = (Flags.active == 1) & (Flags.admin == 1)
+		self.assertEqual(expr.count(), 17)
+		self.assertEqual(list(expr.iterids()), list(range(3, 100, 6)))
+		self.assertEqual(list(expr), [Flags(i) for i in range(3, 100, 6)])
+
+		ids = expr.iterids(chunk=1)
+		self.assertEqual(next(ids), 3)
+		key = redis0.keys('flags:_bitop:*')[0]
+		self.assertEqual(len(key), len('flags:_bitop:') + 32)
+		redis0.expire(key, 1)
+		self.assertEqual(next(ids), 9)
+		self.assertTrue(redis0.ttl(key) > 1)
+		ids.close()
+		self.assertFalse(redis0.exists(key))
+
+		expr = (Flags.admin == 1) | (Flags.kind == 'b') & (Flags.active == 0)
+		self.assertEqual(expr.count(), 34 + 16)
+
+		Flags(3).active = False
+		Flags(3).save()
+		Flags(9).delete()
+		self.assertEqual(((Flags.active == 1) & (Flags.admin == 1)).count(), 15)
+		self.assertEqual(redis0.keys('flags:_bitop:*'), [])
+
+		flags = Flags(10000000)
+		flags.active = True
+		flags.save()
+		self.assertFalse(redis0.exists('flags:active:None'))
+
+		self.assertEqual((Flags.admin == True).update(kind='z'), 33)
+		self.assertEqual((Flags.kind == 'z').count(), 33)
+		self.assertFalse(redis0.exists('flags:kind:None'))
+		self.assertEqual((Flags.active == True).update(admin=True), 49)
+		self.assertFalse(redis0.exists('flags:admin:None'))
+		self.assertEqual(((Flags.active == True) & (Flags.kind == 'b')).update(kind='c', chunk=5), 17)
+		self.assertEqual(((Flags.active == True) & (Flags.kind == 'b')).count(), 0)
+
+		flags = Flags(8000000)
+		flags.active = True
+		flags.save()
+		Flags.free_all()
+		flags = Flags(8000000)
+		flags.kind = 'a'
+		flags.save()
+		Flags(9000000).active = True
+		Flags(9000000).save(ttl=60)
+		Flags.free_all()
+		Flags(9000000).delete()
+		Flags(10000000).save(ttl=60)
+		redis0.delete('flags:10000000') # Expired by redis.
+		self.assertEqual(Flags.sweep(now=time() + 60), 1)
+		self.assertFalse(redis0.exists('flags:kind:None'))
+		self.assertFalse(redis0.exists('flags:admin:None'))
+
+		Flags(7).kind = None
+		Flags(7).save()
+		self.assertEqual((Flags.kind == None).count(), 1)
+		Flags(7).kind = 'b'
+		Flags(7).save()
+		self.assertEqual((Flags.kind == None).count(), 0)
+
+		with self.assertRaises(Exception):
+			Flags('abc').active = True
+			Flags('abc').save()
+
+	def test_bucket_storage (self):
+		@conf(prefix='tiny', storage=BucketStorage(size=10))
+		class Tiny (Model):
+			name = String(field='name', index=True)
+			num = Integer(field='num', index=True)
+
+		for i in range(25):
+			tiny = Tiny.new(i)
+			tiny.name = 'tiny%d' % (i % 2)
+			tiny.num = i
+			tiny['note'] = 'note'
+
+		Tiny.save_all()
+		Tiny.free_all()
+
+		self.assertEqual(set(redis0.keys('tiny:_b:*')), set([b'tiny:_b:0', b'tiny:_b:1', b'tiny:_b:2']))
+		self.assertEqual(redis0.hlen('tiny:_b:1'), 10)
+		self.assertEqual(redis0.object('encoding', 'tiny:_b:1'), b'ziplist')
+		self.assertFalse(redis0.exists('tiny:1'))
+
+		self.assertTrue(Tiny(12).exists())
+		self.assertFalse(Tiny(99).exists())
+		self.assertEqual(Tiny(12).name, 'tiny0')
+		self.assertEqual(Tiny(12).num, 12)
+		self.assertEqual(len(Tiny.name == 'tiny1'), 12)
+
+		tiny = Tiny(13)
+		tiny.name = 'foo'
+		del tiny['note']
+		tiny.save()
+		Tiny.free_all()
+
+		self.assertEqual(Tiny(13).getorigin(), {'name': 'foo', 'num': '13'})
+		self.assertEqual(Tiny.name.find('foo'), [Tiny(13)])
+		self.assertEqual(len(Tiny.name == 'tiny1'), 11)
+
+		Tiny.free_all()
+		Tiny(13).delete()
+		self.assertEqual(Tiny.name.find('foo'), [])
+		self.assertEqual(redis0.hlen('tiny:_b:1'), 9)
+
+		Tiny.free_all()
+		models = [Tiny(i) for i in range(10, 15)]
+		hydrate(models)
+		self.assertEqual([m.num for m in models], [10, 11, 12, None, 14])
+		self.assertEqual(models[0]['note'], 'note')
+		self.assertFalse(Tiny(13).exists())
+
+		with self.assertRaises(Exception):
+			tiny.save(ttl=10)
+
+	def test_struct_codec (self):
+		codec = StructCodec()
+		data = {'a': 1, 'b': -2 ** 63, 'c': 2 ** 70, 'd': 0.5, 'e': 'Вася', '': ''}
+
+		if not PY3K:
+			data['e'] = data['e'].decode('utf-8')
+
+		blob = codec.pack(data)
+		data['c'] = str(2 ** 70)
+
+		self.assertEqual(codec.unpack(blob), data)
+		self.assertEqual(codec.unpack(bytearray(blob)), data)
+		self.assertEqual(codec.unpack(b''), dict())
+
+	def test_blob_storage (self):
+		@conf(prefix='blob', storage=BlobStorage())
+		class Blob (Model):
+			name = String(field='name', index=True)
+			age = Integer(field='age', index=True)
+			created = DateTime(field='created', new=NOW)
+			active = Bool(field='active', index=True)
+
+		blob = Blob.new(1)
+		blob.name = 'John Smith'
+		blob.age = 26
+		blob.active = True
+		blob.save(ttl=60)
+		Blob.free_all()
+
+		self.assertEqual(redis0.type('blob:1'), b'string')
+		self.assertEqual(Blob(1).getorigin(), {'name': 'John Smith', 'age': 26, 'created': NOW_TS, 'active': 1})
+		self.assertEqual(Blob(1).created, NOW)
+		self.assertTrue(Blob(1).active is True)
+		self.assertEqual(Blob.name.find('John Smith'), [Blob(1)])
+		self.assertEqual(Blob.active.find(True), [Blob(1)])
+
+		Blob.free_all()
+		blob = Blob(1)
+		blob.age = 27
+		blob.save()
+		self.assertEqual(Blob.age.find(26), [])
+		self.assertEqual(Blob.age.find(27), [blob])
+		self.assertTrue(0 < redis0.ttl('blob:1') <= 60)
+
+		blob.delete()
+		self.assertFalse(redis0.exists('blob:1'))
+		self.assertFalse(Blob.name.find('John Smith'))
+
+	def test_whole_storage_merge (self):
+		storages = [BucketStorage(size=10), BlobStorage()]
+
+		if msgpack is not None:
+			storages.append(BlobStorage(MsgpackCodec()))
+
+		for db in (StrictRedis(db=0), MemoryRedis()):
+			for storage in storages:
+				@conf(prefix='whole', storage=storage, db=db)
+				class Whole (Model):
+					name = String(field='name', index=True)
+					age = Integer(field='age', index=True)
+
+				whole = Whole.new(1)
+				whole.name = 'John'
+				whole.age = 2 ** 60
+				whole['note'] = 'x' * 300
+				whole.save()
+				Whole.free_all()
+
+				first = Whole(1)
+				first.getorigin()
+				Whole.free_all()
+				second = Whole(1)
+				second.getorigin()
+
+				first.name = 'Jane'
+				del first['note']
+				first.save()
+				second.age = 27
+				second.save()
+				Whole.free_all()
+
+				self.assertEqual(Whole(1).getorigin(), {'name': 'Jane', 'age': '27' \
+					if isinstance(storage, BucketStorage) else 27})
+				self.assertEqual(Whole.name.find('Jane'), [Whole(1)])
+				self.assertEqual(Whole.name.find('John'), [])
+				self.assertEqual(Whole.age.find(27), [Whole(1)])
+				self.assertEqual(Whole.age.find(2 ** 60), [])
+
+				Whole.free_all()
+				Whole(1).age = 2 ** 60
+				Whole(1).save()
+				Whole.free_all()
+				self.assertEqual(Whole(1).age, 2 ** 60)
+
+				pipe = Whole.getpipe()
+				Whole(2).name = 'Piped'
+				Whole.save_all(pipe)
+				Whole.free_all()
+				self.assertFalse(Whole(2).exists())
+
+				pipe.execute()
+				Whole.free_all()
+				self.assertEqual(Whole(2).name, 'Piped')
+
+				try:
+					with Model.batch():
+						Whole(3).name = 'Batched'
+						Whole(3).save()
+						raise ValueError()
+
+				except ValueError:
+					pass
+
+				Whole.free_all()
+				self.assertFalse(Whole(3).exists())
+				self.assertEqual(Whole.name.find('Batched'), [])
+
+				db.flushdb()
+				Whole.free_all()
+
+	def test_dump (self):
+		for i in range(1, 51):
+			user = User.new(i)
+			user.name = 'user%d' % (i % 5)
+			user.age = i
+
+		User.save_all()
+		User(1).save(ttl=60)
+		redis0.sadd('u:1:tags', 'foo')
+
+		stream = StringIO()
+		progress = []
+		self.assertEqual(User.dump(stream, count=10, progress=lambda *a: progress.append(a)), 50)
+		self.assertEqual(progress[-1], (0, 50))
+
+		redis0.flushdb()
+		User.free_all()
+		stream.seek(0)
+
+		self.assertEqual(User.load_dump(stream, count=7, workers=3, skip=10), 40)
+		restored = [User(i) for i in range(1, 51) if User(i).exists()]
+		self.assertEqual(len(restored), 40)
+		self.assertEqual(restored[0].age, int(restored[0].getid()))
+		self.assertEqual(restored[0].created, NOW)
+		self.assertEqual(len(User.age >= 0), 40)
+		self.assertEqual(sum(User.name.count_many(['user%d' % i for i in range(5)]).values()), 40)
+		self.assertFalse(redis0.exists('u:1:tags'))
+
+	def test_dump_bucket (self):
+		@conf(prefix='tiny', storage=BucketStorage(size=10))
+		class Tiny (Model):
+			num = Integer(field='num', index=True)
+
+		for i in range(30):
+			Tiny(i).num = i
+
+		Tiny.save_all()
+		stream = StringIO()
+		self.assertEqual(Tiny.dump(stream), 30)
+
+		redis0.flushdb()
+		Tiny.free_all()
+		stream.seek(0)
+
+		self.assertEqual(Tiny.load_dump(stream), 30)
+		self.assertEqual(Tiny(25).num, 25)
+		self.assertEqual(len(Tiny.num < 10), 10)
+
+	def test_feed (self):
+		@conf(prefix='item', feed=100, feed_values=True)
+		class Item (Model):
+			name = String(field='name', index=True)
+			price = Integer(field='price')
+
+		reader = FeedReader(Item, 'indexer', 'worker1', count=2)
+		self.assertEqual(reader.read(), [])
+
+		item = Item(1)
+		item.name = 'foo'
+		item.price = 10
+		item.save()
+
+		item.load()
+		item.name = 'bar'
+		item['extra'] = None
+		item.save()
+		item.delete()
+
+		events = reader.read()
+		self.assertEqual(len(events), 2)
+		self.assertEqual(events[0]['op'], 'save')
+		self.assertEqual(events[0]['id'], '1')
+		self.assertEqual(events[0]['fields'], ['name', 'price'])
+		self.assertEqual(events[0]['new'], {'name': 'foo', 'price': 10})
+		self.assertFalse('old' in events[0])
+		self.assertEqual(events[1]['fields'], ['extra', 'name'])
+		self.assertEqual(events[1]['new'], {'name': 'bar', 'extra': None})
+		self.assertEqual(events[1]['old'], {'name': 'foo', 'extra': None})
+
+		reader.ack(events[:1])
+		self.assertEqual(reader.read(pending=True), events[1:])
+		reader.ack(events[1:])
+
+		events = reader.read()
+		self.assertEqual(len(events), 1)
+		self.assertEqual(events[0]['op'], 'delete')
+		self.assertEqual(events[0]['old'], {'name': 'bar', 'price': '10'})
+
+		reader = FeedReader(Item, 'indexer', 'worker2')
+		self.assertEqual(reader.read(), [])
+		self.assertFalse(User.getfeed())
+
+	def test_bulk (self):
+		for i in range(1, 21):
+			user = User.new(i)
+			user.name = 'user%d' % (i % 2)
+			user.age = i
+			user.lang = Language(i % 3)
+			user.email = 'user%d@example.com' % i
+
+		User.save_all()
+		User(1).save(ttl=60)
+
+		users = User.name == 'user1'
+		self.assertEqual(users.update(chunk=3, age=50, lang=None), 10)
+		self.assertFalse(User(1).loaded())
+		self.assertEqual(User(1).age, 50)
+		self.assertEqual(User(1).lang, None)
+		self.assertEqual(User(1).name, 'user1')
+		self.assertEqual(len(User.age == 50), 10)
+		self.assertEqual(len(User.lang == Language(1)), 3)
+		self.assertEqual(len(User.lang == None), 10)
+		self.assertEqual(redis0.hget('u:_ttl:age', '1'), b'50')
+		self.assertFalse(redis0.hexists('u:_ttl:lang', '1'))
+
+		with self.assertRaises(Exception):
+			users.update(email='foo@bar.com')
+
+		stale = User.age > 10
+		stale.iterchunks = lambda chunk: iter([['2', '12']]) # 2 does not match.
+		self.assertEqual(stale.update(name='stale'), 1)
+		self.assertEqual(User.name.find('stale'), [User(12)])
+
+		User.free_all()
+		touched = User(12)
+		users = User.age > 10
+		self.assertEqual(users.delete(chunk=4), 15)
+		self.assertEqual(list(User._objects), ['12'])
+		self.assertFalse(touched.exists())
+		self.assertEqual(redis0.keys('u:_bulk:*'), [])
+		self.assertFalse(User(1).exists())
+		self.assertEqual(User(1).name, None)
+		self.assertFalse(redis0.exists('u:1'))
+		self.assertEqual(redis0.scard('u:name:user1'), 0)
+		self.assertEqual(redis0.smembers('u:name:user0'), set([b'2', b'4', b'6', b'8', b'10']))
+		self.assertFalse(redis0.exists('u:eml:user1@example.com'))
+		self.assertEqual(redis0.zcard('u:age'), 5)
+		self.assertFalse(redis0.exists('u:_ttl'))
+		self.assertFalse(redis0.exists('u:lang:None'))
+
+	def test_aggregates (self):
+		self.assertEqual(User.age.min(), None)
+		self.assertEqual(User.age.quantile(0.5), None)
+
+		for i in range(1, 101):
+			User.new(i).age = i % 100
+
+		User.save_all()
+
+		self.assertEqual(User.age.min(), 0)
+		self.assertEqual(User.age.max(), 99)
+		self.assertEqual(User.age.count(), 100)
+		self.assertEqual(User.age.count(10, 19), 10)
+		self.assertEqual(User.age.count('(10', 19), 9)
+		self.assertEqual((User.age >= 90).count(), 10)
+		self.assertEqual((User.age < 90).count(), 90)
+		self.assertEqual((User.age == 5).count(), 1)
+		self.assertEqual(User.age.histogram([0, 10, 50, 100]), [10, 40, 50])
+		self.assertEqual(User.age.quantile(0.5), 50)
+		self.assertEqual(User.age.quantiles([0, 0.9, 1]), [0, 89, 99])
+
+	def test_range_children (self):
+		for i in range(10):
+			User(i).age = i * 2
+			SubUser(i).age = i * 2 + 1
+
+		User.save_all()
+		SubUser.save_all()
+
+		users = User.age.range(children=True)
+		self.assertEqual([u.age for u in users], list(range(20)))
+		self.assertEqual(users[:2], [User(0), SubUser(0)])
+
+		users = User.age.range(5, 15, start=2, num=4, children=True)
+		self.assertEqual([u.age for u in users], [7, 8, 9, 10])
+
+		users = User.age.range(start=18, num=5, children=True)
+		self.assertEqual([u.age for u in users], [18, 19])
+
+		users = User.age.range(5, 8, children=True)
+		self.assertEqual([u.age for u in users], [5, 6, 7, 8])
+
+		users = User.age.range(5, 8)
+		self.assertEqual([u.age for u in users], [6, 8])
+
+		users = User.age.find(3, children=True)
+		self.assertEqual(users, [SubUser(1)])
+
+		users = User.name.find(None, children=True)
+		self.assertEqual(len(users), 0)
+
+	def test_geo (self):
+		class Venue (Model):
+			location = GeoPoint(field='loc', index=True)
+
+		Venue(1).location = (13.361389, 38.115556) # Palermo
+		Venue(2).location = '15.087269,37.502669'  # Catania
+		Venue(3).location = (2.352222, 48.856613)  # Paris
+		Venue.save_all()
+		Venue.free_all()
+
+		self.assertEqual(Venue(1).location, (13.361389, 38.115556))
+
+		with self.assertRaises(Exception):
+			Venue(1).location = (13, 90)
+
+		Venue.free_all()
+		venues = Venue.location.near(15, 37, 200, 'km')
+		self.assertEqual(venues, [Venue(2), Venue(1)])
+		self.assertFalse(Venue(1).loaded())
+
+		venues = Venue.location.near(15, 37, 200, 'km', count=1, sort='desc', load=True)
+		self.assertEqual(venues, [Venue(1)])
+		self.assertTrue(Venue(1).loaded())
+
+		self.assertEqual(Venue.location.near(15, 37, 2000, 'km', ids=True), ['2', '1', '3'])
+
+		venues = Venue.location.near(15, 37, 100, 'km', withdist=True)
+		self.assertEqual(venues[0][0], Venue(2))
+		self.assertAlmostEqual(venues[0][1], 56.4413, 3)
+
+		Venue(2).location = (2.35, 48.85)
+		Venue(2).save()
+		Venue(3).delete()
+		self.assertEqual(Venue.location.near(2.35, 48.85, 10, 'km'), [Venue(2)])
+
+		Venue(2).location = None
+		Venue(2).save()
+		self.assertEqual(Venue.location.near(2.35, 48.85, 10, 'km'), [])
+
+	def test_text (self):
+		class Article (Model):
+			title = String(field='title', text=True)
+			tag = String(field='tag', text=True, index=True)
+
+		Article(1).title = 'Redis as a Database'
+		Article(2).title = 'Python, Redis & ORM'
+		Article(3).title = 'Python tips'
+		Article(3).tag = 'Python'
+		Article.save_all()
+		Article.free_all()
+
+		self.assertEqual(redis0.smembers('article:~title:redis'), set([b'1', b'2']))
+		self.assertFalse(redis0.exists('article:title:Python tips'))
+		self.assertEqual(Article.title.search('REDIS'), [Article(1), Article(2)])
+		self.assertEqual(Article.title.search('python redis'), [Article(2)])
+		self.assertEqual(Article.title.search('python redis', mode='or', ids=True), ['1', '2', '3'])
+		self.assertEqual(Article.title.search('python redis', mode='or', start=1, num=1), [Article(2)])
+		self.assertEqual(Article.title.search('mongo redis'), [])
+		self.assertEqual(Article.title.search('...'), [])
+		self.assertFalse(Article(1).loaded())
+		self.assertEqual(Article.title.search('database', load=True), [Article(1)])
+		self.assertTrue(Article(1).loaded())
+		self.assertEqual(Article.tag.search('python'), [Article(3)])
+		self.assertEqual(Article.tag.find('Python'), [Article(3)])
+		self.assertEqual(redis0.keys('article:_search:*'), [])
+
+		Article.free_all()
+		article = Article(2)
+		article.title = 'Python ORM'
+		article.save()
+		self.assertEqual(Article.title.search('redis'), [Article(1)])
+		self.assertEqual(Article.title.search('python orm'), [Article(2)])
+
+		article.delete()
+		Article(3).delete()
+		self.assertEqual(Article.title.search('python', mode='or'), [])
+		self.assertEqual(Article.tag.find('Python'), [])
+
+		with self.assertRaises(Exception):
+			(Article.tag == 'Python').delete()
+
+	def test_lazy_load (self):
+		user = User(1)
+		user.name = 'John Smith'
+		user.email = 'foo@bar.com'
+		user.save()
+		user.free()
+
+		user = User(1)
+		user.load()
+		self.assertEqual(dict.__getitem__(user._data, 'name'), b'John Smith')
+		self.assertEqual(user.name, 'John Smith')
+		self.assertEqual(dict.__getitem__(user._data, 'name'), 'John Smith')
+		self.assertEqual(dict.__getitem__(user._data, 'eml'), b'foo@bar.com')
+		self.assertEqual(user.getorigin(), {'name': 'John Smith', 'eml': 'foo@bar.com'})
+		self.assertEqual(user.raw_export(), {'name': 'John Smith', 'eml': 'foo@bar.com'})
+
+		user.name = 'John Smith'
+		self.assertEqual(user.getdiff(), dict())
+
+	def test_decode_responses (self):
+		@conf(prefix='u', db=Redis(db=0, decode_responses=True))
+		class TextUser (Model):
+			name = String(field='name', index=True)
+			age = Integer(field='age', index=True)
+
+		user = TextUser(1)
+		user.name = 'John Smith'
+		user.age = 20
+		user.save()
+		TextUser.free_all()
+
+		self.assertTrue(TextUser(1).exists())
+		self.assertEqual(TextUser(1).name, 'John Smith')
+		self.assertEqual(TextUser.name.find('John Smith'), [TextUser(1)])
+		self.assertEqual(TextUser.age.range(10), [TextUser(1)])
+
+		TextUser.free_all()
+		user = TextUser(1)
+		user.name = 'Steve Gobs'
+		user.save()
+		self.assertEqual(TextUser.name.find('John Smith'), [])
+		self.assertEqual(User(1).name, 'Steve Gobs')
+
+	def test_memory_backend (self):
+		memory = MemoryRedis()
+
+		commands = [
+			('hmset', 'h', {'a': 1, 'b': 'x'}), ('hset', 'h', 'c', 2.5),
+			('hdel', 'h', 'a', 'z'), ('hgetall', 'h'), ('hmget', 'h', ['b', 'z']),
+			('sadd', 's1', 1, 2, 3), ('sadd', 's2', 3, 4), ('srem', 's1', 1),
+			('sinterstore', 's3', ['s1', 's2']), ('sunionstore', 's4', ['s1', 's2']),
+			('smembers', 's4'), ('scard', 's3'), ('srem', 's3', 3), ('exists', 's3'),
+			('zadd', 'z', {'c': 3, 'a': 1}), ('zadd', 'z', {'b': 2, 'd': 2}), ('zrem', 'z', 'x'),
+			('zrange', 'z', 0, -2, False, True), ('zrangebyscore', 'z', '(1', '+inf', 1, 2),
+			('zcount', 'z', '-inf', '(2'), ('zcard', 'z'), ('zscore', 'z', 'b'),
+			('setbit', 'bm', 3, 1), ('setbit', 'bm', 17, 1), ('setbit', 'bm2', 17, 1),
+			('bitop', 'AND', 'bm3', 'bm', 'bm2'), ('bitcount', 'bm'), ('bitpos', 'bm', 1, 1),
+			('getrange', 'bm', 1, -1), ('get', 'bm3'), ('incrby', 'n', 5),
+			('sort', 's4', None, None, 'h->*'), ('sort', 'z', 1, 2, None, None, True, True),
+			('hset', 'h:3', 'n', 'b'), ('hset', 'h:4', 'n', 'a'),
+			('sort', 's4', None, None, 'h:*->n', ['#', 'h:*->n'], False, True),
+			('type', 'z'), ('type', 'bm'), ('type', 'none'), ('delete', 'z', 'h', 'none'),
+			('expire', 'n', 100), ('ttl', 'n'), ('keys', 's*'),
+		]
+
+		for command in commands:
+			name, args, kwargs = command[0], command[1:], dict()
+
+			if args and type(args[-1]) is dict and name != 'hmset':
+				args, kwargs = args[:-1], args[-1]
+
+			reply = getattr(redis0, name)(*args, **kwargs)
+			self.assertEqual(getattr(memory, name)(*args, **kwargs),
+				sorted(reply) if name == 'keys' else reply, command)
+
+		memory.flushdb()
+
+		@conf(prefix='u', db=memory)
+		class MemUser (Model):
+			name = String(field='name', index=True)
+			age = Integer(field='age', index=True)
+			active = Bool(field='active', index=True, bitmap=True)
+			title = String(field='title', text=True)
+
+		for n in range(1, 6):
+			user = MemUser(n)
+			user.name = 'User %d' % (n % 2)
+			user.age = n * 10
+			user.active = n > 2
+			user.title = 'Memory user %d' % n
+
+		MemUser.save_all()
+		MemUser.free_all()
+
+		self.assertEqual(redis0.keys('u:*'), [])
+		self.assertEqual(MemUser(1).name, 'User 1')
+		self.assertEqual(sorted(m.getid() for m in MemUser.name.find('User 1')), ['1', '3', '5'])
+		self.assertEqual(MemUser.age.range(20, 40), [MemUser(2), MemUser(3), MemUser(4)])
+		self.assertEqual((MemUser.age >= 30).count(), 3)
+		self.assertEqual(MemUser.active.count(True), 3)
+		self.assertEqual(((MemUser.active == True) | (MemUser.active == False)).count(), 5)
+		self.assertEqual(MemUser.title.search('user 2'), [MemUser(2)])
+
+		with MemUser.batch():
+			MemUser(1).delete()
+			MemUser(2).name = 'User 2'
+			MemUser(2).save()
+
+		self.assertFalse(memory.exists('u:1'))
+		self.assertEqual(MemUser.name.find('User 0'), [MemUser(4)])
+		batches = MemUser.getstorage().scan(MemUser, memory, count=2)
+		ids = [model_id for cursor, batch in batches for model_id, data in batch]
+		self.assertEqual(sorted(ids), ['2', '3', '4', '5'])
+
+		with self.assertRaises(Exception):
+			(MemUser.age >= 10).delete()
+
+	def test_memory_threads (self):
+		memory = MemoryRedis()
+
+		def work ():
+			for i in range(5000):
+				memory.incrby('hits', 1)
+				memory.hincrby('stats', 'hits', 1)
+				memory.zincrby('top', 'page', 1)
+				memory.rpush('log', i)
+
+		threads = [Thread(target=work) for i in range(4)]
+
+		for thread in threads:
+			thread.start()
+
+		for thread in threads:
+			thread.join()
+
+		self.assertEqual(memory.get('hits'), b'20000')
+		self.assertEqual(memory.hget('stats', 'hits'), b'20000')
+		self.assertEqual(memory.zscore('top', 'page'), 20000)
+		self.assertEqual(memory.llen('log'), 20000)
+
+	def test_version (self):
+		@conf(prefix='u', version=True, retries=1, backoff=0)
+		class VerUser (Model):
+			name = String(field='name', index=True)
+			age = Integer(field='age')
+
+		user = VerUser(1)
+		user.name = 'John Smith'
+		user.save()
+		self.assertEqual(redis0.hget('u:1', '_ver'), b'1')
+		self.assertEqual(user.getversion(), 1)
+
+		VerUser.free_all()
+		user = VerUser(1)
+		user.load()
+
+		redis0.hmset('u:1', {'age': 30, '_ver': 2})
+		METRICS.reset()
+
+		user.name = 'Steve Gobs'
+		user.save()
+
+		self.assertEqual(METRICS.snapshot(), {'version_conflicts': 1, 'version_retries': 1})
+		self.assertEqual(user.getversion(), 3)
+		self.assertEqual(user.age, 30)
+		self.assertEqual(redis0.hgetall('u:1'), {b'name': b'Steve Gobs', b'age': b'30', b'_ver': b'3'})
+		self.assertEqual(VerUser.name.find('Steve Gobs'), [user])
+		self.assertEqual(VerUser.name.find('John Smith'), [])
+
+		VerUser.free_all()
+		user = VerUser(1)
+		user.load()
+		user.name = 'Bill Gates'
+		redis0.hset('u:1', '_ver', 10)
+		VerUser._retries = 0
+
+		with self.assertRaises(ConflictError):
+			user.save()
+
+		self.assertEqual(user.getdiff(), {'name': 'Bill Gates'})
+		self.assertEqual(METRICS.get('version_conflicts'), 2)
+		self.assertEqual(redis0.hget('u:1', 'name'), b'Steve Gobs')
+
+		user.save()
+		self.assertEqual(redis0.hget('u:1', 'name'), b'Bill Gates')
+		self.assertEqual(user.getversion(), 11)
+
+		VerUser.free_all()
+		stale = VerUser(1)
+		stale.load()
+		VerUser.free_all()
+		VerUser._retries = 1
+
+		self.assertEqual((VerUser.name == 'Bill Gates').update(name='Bill Bulk'), 1)
+		self.assertEqual(redis0.hget('u:1', '_ver'), b'12')
+
+		stale.name = 'Steve Stale'
+		stale.save()
+		self.assertEqual(stale.getversion(), 13)
+		self.assertEqual(VerUser.name.find('Steve Stale'), [VerUser(1)])
+		self.assertEqual(VerUser.name.find('Bill Bulk'), [])
+		self.assertEqual(VerUser.name.find('Bill Gates'), [])
+
+	def test_order_by (self):
+		lang = Language(1)
+
+		for n, name in enumerate(['Steve', 'Bill', 'John', 'Alan', 'Linus']):
+			user = User(n + 1)
+			user.name = name
+			user.age = 100 - n * 10 if n != 2 else 5
+			user.lang = lang
+
+		User.save_all()
+		User(6).name = 'Other'
+		User(6).save()
+
+		users = User.lang == lang
+		self.assertEqual(users.order_by('name', ids=True), ['4', '2', '3', '5', '1'])
+		self.assertEqual(users.order_by('name', desc=True, limit=2), [User(1), User(5)])
+		self.assertEqual(users.order_by(User.age, start=1, limit=3, ids=True), ['5', '4', '2'])
+		self.assertEqual(users.order_by('age', start=3, ids=True), ['2', '1'])
+		self.assertEqual(users.order_by('age', limit=2, get=['name', 'age']), [('John', 5), ('Linus', 60)])
+		self.assertEqual(users.order_by('name', limit=1, get=['lang']), [(lang,)])
+		self.assertFalse(User(3).loaded())
+		self.assertEqual(users.order_by('age', limit=1, load=True), [User(3)])
+		self.assertTrue(User(3).loaded())
+
+		with self.assertRaises(Exception):
+			(User.age > 10).order_by('name')
+
+	def test_partition (self):
+		class Event (Model):
+			created = DateTime(field='created', index=True, partition='day')
+
+		day = 86400
+		base = 1704067200 # 2024-01-01 00:00:00 UTC, monday.
+
+		for n in range(10):
+			Event(n + 1).created = base + n * day // 2
+
+		Event.save_all()
+
+		self.assertEqual(redis0.zrange('event:created:_parts', 0, -1),
+			[b'20240101', b'20240102', b'20240103', b'20240104', b'20240105'])
+		self.assertEqual(redis0.zcard('event:created:20240103'), 2)
+		self.assertFalse(redis0.exists('event:created'))
+
+		ids = lambda models: [m.getid() for m in models]
+		self.assertEqual(ids(Event.created.range()), [str(n) for n in range(1, 11)])
+		self.assertEqual(ids(Event.created.range(base + day // 2, base + 2 * day)), ['2', '3', '4', '5'])
+		self.assertEqual(ids(Event.created.range(start=3, num=4)), ['4', '5', '6', '7'])
+		self.assertEqual(ids(Event.created.range('(%d' % base, start=1, num=2)), ['3', '4'])
+		self.assertEqual(ids(Event.created >= base + 4 * day), ['9', '10'])
+		self.assertEqual(Event.created.count(base, '(%d' % (base + day)), 2)
+		self.assertEqual(Event.created.min(), datetime.fromtimestamp(base))
+		self.assertEqual(Event.created.max(), datetime.fromtimestamp(base + 9 * day // 2))
+		self.assertEqual(Event.created.quantile(0.5), datetime.fromtimestamp(base + 2 * day))
+		self.assertEqual(Event.created.histogram([base, base + day, base + 4 * day]), [2, 6])
+
+		event = Event(1)
+		event.created = base + 3 * day
+		event.save()
+		self.assertEqual(redis0.zcard('event:created:20240101'), 1)
+		self.assertEqual(ids(Event.created.range(base + 3 * day, base + 3 * day)), ['1', '7'])
+
+		Event(2).delete()
+		self.assertEqual(redis0.zcard('event:created:20240101'), 0)
+
+		self.assertEqual(Event.created.drop(base + 2 * day + 1), 2)
+		self.assertEqual([count for start, count in Event.created.parts()], [2, 3, 2])
+		self.assertEqual(ids(Event.created.range()), ['5', '6', '1', '7', '8', '9', '10'])
+
+		class SubEvent (Event):
+			pass
+
+		SubEvent(11).created = base + 3 * day + 1
+		SubEvent(11).save()
+		self.assertEqual(ids(Event.created.range(start=2, num=3, children=True)), ['1', '7', '11'])
+		self.assertEqual(ids(Event.created.range(base + 4 * day, children=True)), ['9', '10'])
+
+		with self.assertRaises(Exception):
+			(Event.created > base).delete()
+
+		week = DateTime(field='w', partition='week')
+		month = DateTime(field='m', partition='month')
+		self.assertEqual(week.period(base + 6 * day + 1), (base, base + 7 * day))
+		self.assertEqual(month.period(base + 40 * day), (base + 31 * day, base + 60 * day))
+		self.assertEqual(week.to_db(datetime(2024, 1, 1, tzinfo=UTC())), base)
+		self.assertEqual(week.to_db(NOW), NOW_TS)
+
+	def test_pools (self):
+		POOLS.configure('test', db=1, max_connections=2, timeout=0.05)
+
+		@conf(db='test')
+		class PoolUser (Model):
+			name = String(field='name', index=True)
+
+		db = PoolUser.getdb()
+		self.assertTrue(db is POOLS.get('test'))
+		self.assertEqual(db.connection_pool.connection_kwargs['db'], 1)
+
+		user = PoolUser(1)
+		user.name = 'John Smith'
+		user.save()
+
+		self.assertEqual(redis1.hget('pooluser:1', 'name'), b'John Smith')
+		self.assertEqual(POOLS.metrics('test')['in_use'], 0)
+		self.assertEqual(POOLS.metrics('test')['created'], 1)
+		self.assertTrue(POOLS.metrics('test')['checkouts'] >= 2)
+
+		pool = db.connection_pool
+		held = [pool.get_connection('GET'), pool.get_connection('GET')]
+		self.assertEqual(POOLS.metrics('test')['in_use'], 2)
+
+		with self.assertRaises(Exception):
+			db.ping()
+
+		self.assertEqual(POOLS.metrics('test')['timeouts'], 1)
+		self.assertTrue(POOLS.metrics('test')['wait_max'] >= 0.05)
+
+		for conn in held:
+			pool.release(conn)
+
+		self.assertEqual(POOLS.metrics('test')['in_use'], 0)
+		self.assertEqual(POOLS.metrics('test')['created'], 2)
+
+		self.assertEqual(inchild(lambda: [PoolUser.getdb() is not db,
+			PoolUser.getdb().hget('pooluser:1', 'name').decode('utf-8')]), [True, 'John Smith'])
+
+		self.assertTrue(PoolUser.getdb() is db)
+		POOLS._pid = -1 # Simulate fork on python < 3.7.
+		POOLS.forked()
+		self.assertTrue(PoolUser.getdb() is not db)
+		self.assertEqual(POOLS.metrics('test')['created'], 0)
+		self.assertEqual(PoolUser(2).exists(), False)
+
+		with self.assertRaises(Exception):
+			POOLS.get('unknown')
+
+		self.assertTrue(connection(redis0) is redis0)
+
+		POOLS.configure('unbounded', db=1)
+		pool = POOLS.get('unbounded').connection_pool
+		held = [pool.get_connection('GET') for i in range(60)]
+
+		for conn in held:
+			pool.release(conn)
+
+		self.assertEqual(POOLS.metrics('unbounded')['created'], 60)
+		self.assertEqual(POOLS.metrics('unbounded')['in_use'], 0)
+		pool.disconnect()
+
+		default = conf.__dict__['db']
+		conf.db = PoolClient()
+		self.assertTrue(conf.db is POOLS.get('default'))
+		self.assertTrue(hasattr(conf.db, 'pipeline'))
+		conf.db = default
+
+	def test_counter (self):
+		@conf(prefix='post')
+		class Post (Model):
+			views = Counter(field='views', index=True)
+			rating = Counter(field='rating', floating=True)
+
+		post = Post(1)
+		post.load()
+		self.assertEqual(Post.views.incr(post), 1)
+		self.assertEqual(Post.views.incr(post, 10), 11)
+		self.assertEqual(post.views, 11)
+		self.assertTrue(post.exists())
+		self.assertEqual(Post.rating.incr(post, 0.5), 0.5)
+		self.assertEqual(Post.rating.incr(post, -1.25), -0.75)
+		self.assertEqual(post.getdiff(), dict())
+		self.assertEqual(redis0.hgetall('post:1'), {b'views': b'11', b'rating': b'-0.75'})
+		self.assertEqual(redis0.zscore('post:views', '1'), 11)
+
+		def worker ():
+			for n in range(50):
+				Post.views.incr(Post(2))
+
+		threads = [Thread(target=worker) for n in range(4)]
+
+		for thread in threads:
+			thread.start()
+
+		for thread in threads:
+			thread.join()
+
+		self.assertEqual(redis0.hget('post:2', 'views'), b'200')
+		self.assertEqual(Post.views.range(100), [Post(2)])
+		self.assertEqual(Post.views.max(), 200)
+
+		pipe = redis0.pipeline()
+		self.assertEqual(Post.views.incr(post, 5, pipe), None)
+		self.assertFalse(post.loaded())
+		pipe.execute()
+		self.assertEqual(post.views, 16)
+
+		with Model.batch():
+			Post.views.incr(post, 4)
+			self.assertEqual(redis0.hget('post:1', 'views'), b'16')
+
+		self.assertEqual(post.views, 20)
+		self.assertEqual(redis0.zscore('post:views', '1'), 20)
+
+		post.views = 1
+
+		with self.assertRaises(Exception):
+			Post.views.incr(post)
+
+		post.save()
+		self.assertEqual(Post.views.incr(post), 2)
+
+		@conf(prefix='vpost', version=True)
+		class VerPost (Model):
+			views = Counter(field='views')
+
+		post = VerPost(1)
+		post.load()
+		VerPost.views.incr(post, 3)
+		self.assertEqual(post.getversion(), 1)
+		post.views = 10
+		post.save()
+		self.assertEqual(redis0.hgetall('vpost:1'), {b'views': b'10', b'_ver': b'2'})
+
+	def test_collections (self):
+		for db in (StrictRedis(db=0), MemoryRedis()):
+			@conf(prefix='post', db=db)
+			class Post (Model):
+				title = String(field='title', index=True)
+				comments = ListField('comments')
+				tags = SetField('tags')
+				likes = SortedSetField('likes', cls=User)
+
+			self.assertEqual(sorted(Post.getcollections()), ['comments', 'likes', 'tags'])
+
+			post = Post(1)
+			post.title = 'Hello'
+			post.save()
+
+			self.assertEqual(post.comments.append('first', 'second'), 2)
+			post.comments.prepend('zero')
+			post.comments.append('second')
+			self.assertEqual(db.lrange('post:1:comments', 0, -1), [b'zero', b'first', b'second', b'second'])
+			self.assertEqual(post.comments.page(1, 2), ['first', 'second'])
+			self.assertEqual(post.comments.remove('second'), 2)
+			self.assertEqual(list(post.comments.iter(chunk=1)), ['zero', 'first'])
+			self.assertEqual(len(post.comments), 2)
+			self.assertTrue('first' in post.comments)
+			self.assertEqual(post.comments.pop(), 'first')
+
+			post.tags.add('redis', 'python', 'orm')
+			post.tags.remove('orm')
+			self.assertEqual(sorted(post.tags.members()), ['python', 'redis'])
+			self.assertEqual(sorted(post.tags.iter(chunk=1)), ['python', 'redis'])
+			self.assertTrue('redis' in post.tags)
+			self.assertFalse('orm' in post.tags)
+			self.assertEqual(len(post.tags), 2)
+
+			post.likes.add(User(1), 10)
+			post.likes.add(User(2), 5)
+			post.likes.incr(User(2), 10)
+			self.assertEqual(post.likes.page(), [User(1), User(2)])
+			self.assertEqual(post.likes.page(0, 1, desc=True, withscores=True), [(User(2), 15)])
+			self.assertEqual(post.likes.range(11), [User(2)])
+			self.assertEqual(post.likes.score(User(1)), 10)
+			self.assertTrue(User(1) in post.likes)
+			self.assertFalse(post.loaded() and 'likes' in post._data)
+
+			post.likes.add(5, 1.5)
+			self.assertEqual(post.likes.score(5), 1.5)
+			post.likes.remove(5)
+
+			with Model.batch():
+				post.tags.add('batch')
+				self.assertFalse(post.tags.contains('batch'))
+				self.assertEqual(post.comments.pop(left=True), 'zero')
+				self.assertEqual(len(post.comments), 0)
+
+			self.assertTrue(post.tags.contains('batch'))
+
+			pipe = db.pipeline()
+			self.assertEqual(post.likes.remove(User(1), pipe=pipe), None)
+			pipe.execute()
+			self.assertEqual(len(post.likes), 1)
+
+			with self.assertRaises(Exception):
+				post.tags = ['redis']
+
+			post.delete()
+			self.assertEqual(db.keys('post:1*'), [])
+			Post.free_all()
+
+		self.assertEqual(memstat_group(Post, '1:tags'), 'collection:tags')
+
+	def test_collections_ttl (self):
+		@conf(prefix='post', ttl=60)
+		class Post (Model):
+			title = String(field='title', index=True)
+			tags = SetField('tags')
+
+		post = Post(1)
+		post.tags.add('redis')
+		self.assertTrue(0 < redis0.ttl('post:1:tags') <= 60)
+
+		post.title = 'Hello'
+		post.save()
+		redis0.delete('post:1') # Expired by redis.
+		Post.free_all()
+
+		self.assertEqual(Post.sweep(now=time() + 60), 1)
+		self.assertFalse(redis0.exists('post:1:tags'))
+		self.assertEqual(Post.title.find('Hello'), [])